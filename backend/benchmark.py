@@ -0,0 +1,425 @@
+"""
+Banco de pruebas de carga para los servicios de autenticación, almacenamiento
+y mensajería, que deben estar corriendo (python main.py ...).
+
+Mide la latencia p50/p95/p99 de cada operación, el rendimiento de cada fase y
+si todos los mensajes llegaron, tanto a destinatarios conectados como a los
+que se conectan después (mensajes pendientes), y escribe el resultado en
+JSON para comparar corridas entre commits:
+
+    python benchmark.py --clients 50 --messages 20 --sizes 32,1024 --output base.json
+    python benchmark.py --compare base.json nuevo.json
+"""
+import argparse
+import json
+import math
+import queue
+import secrets
+import socket
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from comun.pool import ConnectionPool
+
+PERCENTILES = (50, 95, 99)
+ACK_PREFIXES = ("Mensaje procesado", "Error")
+
+def percentile(sorted_samples, p):
+    """Percentil `p` por rango más cercano de una lista ya ordenada."""
+    if not sorted_samples:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+class LatencyRecorder:
+    """Latencias y errores por operación, y duración de cada fase."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.phases = {}
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self.samples[operation].append(seconds)
+
+    def error(self, operation):
+        with self._lock:
+            self.errors[operation] += 1
+
+    @contextmanager
+    def measure(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.error(operation)
+            raise
+        self.record(operation, time.perf_counter() - start)
+
+    @contextmanager
+    def phase(self, name, counted):
+        """Mide la fase; su rendimiento cuenta las operaciones que empiezan con `counted`."""
+        def completed():
+            return sum(len(samples) for op, samples in self.samples.items() if op.startswith(counted))
+
+        start, before = time.perf_counter(), completed()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            done = completed() - before
+            self.phases[name] = {
+                "seconds": round(elapsed, 4),
+                "operations": done,
+                "throughput": round(done / elapsed, 2) if elapsed else None,
+            }
+
+    def summary(self):
+        operations = {}
+        for operation in sorted(set(self.samples) | set(self.errors)):
+            samples = sorted(self.samples.get(operation, ()))
+            stats = {"count": len(samples), "errors": self.errors[operation]}
+            if samples:
+                stats["mean_ms"] = round(sum(samples) / len(samples) * 1000, 3)
+                for p in PERCENTILES:
+                    stats[f"p{p}_ms"] = round(percentile(samples, p) * 1000, 3)
+                stats["max_ms"] = round(samples[-1] * 1000, 3)
+            operations[operation] = stats
+        return operations
+
+class DeliveryTracker:
+    """Mensajes que cada destinatario debería recibir y los que recibió."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self._next_id = 0
+        self.expected = {}
+        self.received = Counter()
+        # Faltantes por tipo y por (tipo, destinatario)
+        self.missing = Counter()
+        self._arrived = threading.Condition()
+
+    def expect(self, recipient, kind):
+        with self._arrived:
+            self._next_id += 1
+            self.expected[self._next_id] = (recipient, kind)
+            self.missing[kind] += 1
+            self.missing[kind, recipient] += 1
+            return self._next_id
+
+    def delivered(self, recipient, content):
+        try:
+            message_id, sent_at, _ = content.split(':', 2)
+            message_id, sent_at = int(message_id), float(sent_at)
+        except ValueError:
+            return
+        with self._arrived:
+            expected = self.expected.get(message_id)
+            if expected is None or expected[0] != recipient:
+                return
+            self.received[message_id] += 1
+            first = self.received[message_id] == 1
+            if first:
+                self.missing[expected[1]] -= 1
+                self.missing[expected[1], recipient] -= 1
+                self._arrived.notify_all()
+        if first:
+            self.recorder.record(f"deliver_{expected[1]}", time.perf_counter() - sent_at)
+
+    def wait(self, kind, timeout, recipient=None):
+        """Espera hasta `timeout` segundos a que lleguen todos los mensajes de ese tipo."""
+        key = kind if recipient is None else (kind, recipient)
+        with self._arrived:
+            return self._arrived.wait_for(lambda: self.missing[key] <= 0, timeout)
+
+    def summary(self):
+        report = {}
+        for kind in sorted({kind for _, kind in self.expected.values()}):
+            ids = [message_id for message_id, (_, k) in self.expected.items() if k == kind]
+            delivered = sum(1 for message_id in ids if self.received[message_id])
+            report[kind] = {
+                "expected": len(ids),
+                "delivered": delivered,
+                "duplicates": sum(max(0, self.received[message_id] - 1) for message_id in ids),
+                "completeness": round(delivered / len(ids), 4) if ids else None,
+            }
+        return report
+
+class BenchmarkClient:
+    """Cliente de mensajería: un hilo lee las líneas y las reparte."""
+
+    def __init__(self, username, host, port, tracker, timeout):
+        self.username = username
+        self.tracker = tracker
+        self.timeout = timeout
+        self.acks = queue.Queue()
+        self.ready = threading.Event()
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.settimeout(None)
+        self.reader = threading.Thread(target=self._read_lines, daemon=True)
+        self.reader.start()
+
+    def authenticate(self, token):
+        """Se autentica y espera la lista de usuarios: la conexión ya está lista para enviar."""
+        self.sock.sendall(f"AUTH|{token}\nGET_USERS\n".encode())
+        if not self.ready.wait(self.timeout):
+            raise TimeoutError(f"{self.username} no recibió USER_LIST")
+
+    def send_message(self, recipient, content):
+        self.sock.sendall(f"SEND|{recipient}|{content}\n".encode())
+        ack = self.acks.get(timeout=self.timeout)
+        if not ack.startswith("Mensaje procesado"):
+            raise RuntimeError(ack)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _read_lines(self):
+        buffer = b""
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                self._handle_line(line.decode(errors="replace"))
+
+    def _handle_line(self, line):
+        if line.startswith("USER_LIST|"):
+            self.ready.set()
+        elif line.startswith(ACK_PREFIXES):
+            self.acks.put(line)
+        elif " dice: " in line:
+            self.tracker.delivered(self.username, line.split(" dice: ", 1)[1])
+
+def make_content(message_id, size):
+    """Contenido <id>:<enviado>:<relleno> de `size` bytes; no lleva '|' ni saltos de línea."""
+    header = f"{message_id}:{time.perf_counter():.6f}:"
+    return header + "x" * max(0, size - len(header))
+
+def run_concurrently(function, items, concurrency):
+    """Aplica `function` a cada elemento con a lo sumo `concurrency` hilos."""
+    pending = queue.SimpleQueue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                function(item)
+            except Exception as e:
+                print(f"Error en {function.__name__}({item!r}): {e}")
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(config):
+    """
+    Corre todas las fases con la configuración de `parse_args` y devuelve el
+    resultado como diccionario serializable a JSON.
+    """
+    recorder = LatencyRecorder()
+    tracker = DeliveryTracker(recorder)
+    prefix = config.prefix or f"bench{secrets.token_hex(3)}_"
+    online = [f"{prefix}{i}" for i in range(config.clients)]
+    offline = [f"{prefix}off{i}" for i in range(config.offline_users)]
+    auth = ConnectionPool(config.auth_host, config.auth_port, max_size=config.concurrency)
+    storage = ConnectionPool(config.storage_host, config.storage_port, max_size=config.concurrency)
+    tokens = {}
+    clients = {}
+
+    def register(username):
+        with recorder.measure("auth_register"):
+            response = auth.request({"action": "registrar_usuario", "username": username, "password": config.password})
+            if response["status"] != "success":
+                raise RuntimeError(response.get("message"))
+
+    def login(username):
+        with recorder.measure("auth_login"):
+            response = auth.request({"action": "iniciar_sesion", "username": username, "password": config.password})
+            if response["status"] != "success":
+                raise RuntimeError(response.get("message"))
+        # Sin clave de sesión (modo heredado) el nombre hace de credencial
+        tokens[username] = response.get("token", username)
+
+    def query_storage(index):
+        username = online[index % len(online)]
+        with recorder.measure("storage_get_user"):
+            response = storage.request({"action": "obtener_usuario", "username": username})
+            if response["status"] != "success":
+                raise RuntimeError(response.get("message"))
+        with recorder.measure("storage_history"):
+            response = storage.request({
+                "action": "get_conversation_history", "user1": username,
+                "user2": online[(index + 1) % len(online)], "limit": 50,
+            })
+            if response["status"] != "success":
+                raise RuntimeError(response.get("message"))
+
+    def connect(username):
+        with recorder.measure("messaging_connect"):
+            client = BenchmarkClient(username, config.messaging_host, config.messaging_port, tracker, config.timeout)
+            try:
+                client.authenticate(tokens[username])
+            except Exception:
+                client.close()
+                raise
+        clients[username] = client
+
+    def send_all(username):
+        client = clients[username]
+        peers = [user for user in online if user != username and user in clients] or [username]
+        for i in range(config.messages):
+            # Reparte la fracción offline_ratio de los mensajes de forma pareja
+            to_offline = bool(offline) and int((i + 1) * config.offline_ratio) > int(i * config.offline_ratio)
+            recipient = offline[i % len(offline)] if to_offline else peers[i % len(peers)]
+            kind = "offline" if to_offline else "online"
+            size = config.sizes[i % len(config.sizes)]
+            content = make_content(tracker.expect(recipient, kind), size)
+            with recorder.measure(f"messaging_send_{size}b"):
+                client.send_message(recipient, content)
+
+    def drain(username):
+        # Desde el AUTH hasta recibir todos los pendientes del usuario
+        start = time.perf_counter()
+        connect(username)
+        if not tracker.wait("offline", config.timeout, recipient=username):
+            recorder.error("messaging_drain_pending")
+            return
+        recorder.record("messaging_drain_pending", time.perf_counter() - start)
+
+    started_at = time.time()
+    try:
+        with recorder.phase("auth", "auth_"):
+            run_concurrently(register, online + offline, config.concurrency)
+            run_concurrently(login, online + offline, config.concurrency)
+        with recorder.phase("storage", "storage_"):
+            run_concurrently(query_storage, range(config.storage_requests), config.concurrency)
+        with recorder.phase("connect", "messaging_connect"):
+            run_concurrently(connect, [user for user in online if user in tokens], config.concurrency)
+        with recorder.phase("send", "messaging_send"):
+            # Un hilo por cliente: cada uno envía sus mensajes de a uno, esperando la confirmación
+            run_concurrently(send_all, list(clients), len(clients))
+        with recorder.phase("deliver_online", "deliver_online"):
+            tracker.wait("online", config.timeout)
+        for client in list(clients.values()):
+            client.close()
+        with recorder.phase("deliver_offline", "deliver_offline"):
+            run_concurrently(drain, [user for user in offline if user in tokens], config.concurrency)
+    finally:
+        for client in clients.values():
+            client.close()
+        auth.close()
+        storage.close()
+
+    return {
+        "commit": current_commit(),
+        "started_at": started_at,
+        "config": {key: value for key, value in vars(config).items() if key not in ("output", "compare")},
+        "phases": recorder.phases,
+        "operations": recorder.summary(),
+        "delivery": tracker.summary(),
+    }
+
+def print_report(result):
+    print(f"\n--- Resultados (commit {result['commit']}) ---")
+    for name, phase in result["phases"].items():
+        print(f"{name:16} {phase['seconds']:8.2f} s  {phase['operations']:7} ops  {phase['throughput'] or 0:10.1f} ops/s")
+    print(f"\n{'operación':26} {'n':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in result["operations"].items():
+        print(f"{name:26} {stats['count']:6} {stats['errors']:5} "
+              f"{stats.get('p50_ms', 0):9.2f} {stats.get('p95_ms', 0):9.2f} {stats.get('p99_ms', 0):9.2f}")
+    for kind, delivery in result["delivery"].items():
+        print(f"\nEntrega {kind}: {delivery['delivered']}/{delivery['expected']} "
+              f"({delivery['completeness']:.2%}), duplicados: {delivery['duplicates']}")
+
+def compare_results(base, new):
+    """Imprime la variación de p50/p95/p99 por operación entre dos corridas."""
+    print(f"Comparando {base['commit']} -> {new['commit']}")
+    print(f"{'operación':26} " + " ".join(f"{f'p{p}':>20}" for p in PERCENTILES))
+    for name in sorted(set(base["operations"]) | set(new["operations"])):
+        cells = []
+        for p in PERCENTILES:
+            before = base["operations"].get(name, {}).get(f"p{p}_ms")
+            after = new["operations"].get(name, {}).get(f"p{p}_ms")
+            if before is None or after is None:
+                cells.append(f"{'-':>20}")
+            else:
+                change = (after - before) / before if before else 0
+                cells.append(f"{before:7.2f}->{after:7.2f} {change:+5.0%}")
+        print(f"{name:26} " + " ".join(cells))
+    for kind in sorted(set(base["delivery"]) | set(new["delivery"])):
+        before = base["delivery"].get(kind, {}).get("completeness")
+        after = new["delivery"].get(kind, {}).get("completeness")
+        print(f"Entrega {kind}: {before} -> {after}")
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",")]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=30, help="clientes conectados a la vez")
+    parser.add_argument("--messages", type=int, default=10, help="mensajes que envía cada cliente")
+    parser.add_argument("--sizes", type=parse_sizes, default=[32, 256, 1024],
+                        help="tamaños de mensaje en bytes, separados por comas (se alternan)")
+    parser.add_argument("--offline-users", type=int, default=5, help="destinatarios que se conectan al final")
+    parser.add_argument("--offline-ratio", type=float, default=0.2,
+                        help="fracción de los mensajes dirigida a destinatarios desconectados")
+    parser.add_argument("--storage-requests", type=int, default=200, help="consultas directas al almacenamiento")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="hilos para registrar, iniciar sesión, consultar y conectar")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--prefix", default=None, help="prefijo de los usuarios (por defecto, uno aleatorio)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="espera máxima por respuesta o entrega")
+    parser.add_argument("--auth-host", default="127.0.0.1")
+    parser.add_argument("--auth-port", type=int, default=7000)
+    parser.add_argument("--storage-host", default="127.0.0.1")
+    parser.add_argument("--storage-port", type=int, default=8000)
+    parser.add_argument("--messaging-host", default="127.0.0.1")
+    parser.add_argument("--messaging-port", type=int, default=5001)
+    parser.add_argument("--output", help="archivo JSON donde guardar el resultado")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NUEVO"), help="compara dos resultados guardados")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    config = parse_args(argv)
+    if config.compare:
+        with open(config.compare[0]) as base, open(config.compare[1]) as new:
+            compare_results(json.load(base), json.load(new))
+        return
+    result = run_benchmark(config)
+    print_report(result)
+    if config.output:
+        with open(config.output, "w") as output:
+            json.dump(result, output, indent=2)
+        print(f"\nResultado guardado en {config.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+from .metrics import REGISTRY
+
+# Registros que esperan al hilo escritor; con la cola llena se descartan
+LOG_QUEUE_SIZE = 10000
+# Fracción de los logs por solicitud (log_request) que se escriben
+REQUEST_SAMPLE_RATE = 1.0
+
+DROPPED = REGISTRY.counter("log_dropped_total", "Registros de log descartados con la cola llena")
+
+# Atributos propios de LogRecord: el resto son campos pasados en `extra`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_state = {"pid": None, "listener": None, "handler": None, "sample_rate": REQUEST_SAMPLE_RATE}
+
+class JSONFormatter(logging.Formatter):
+    """Un objeto JSON por línea, con los campos de `extra` al mismo nivel que el mensaje."""
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__(f"%(asctime)s %(levelname)s {service} %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Encola el registro sin formatearlo y vuelve enseguida: el formateo y la
+    escritura los hace el hilo del QueueListener. Si la cola está llena el
+    registro se descarta (y se cuenta) en lugar de frenar la solicitud.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+def configure_logging(service, level=None, json_output=None, stream=None, sample_rate=None):
+    """
+    Configura el logger raíz del proceso para escribir a través de la cola.
+    Los valores por omisión salen de LOG_LEVEL (INFO), LOG_FORMAT ("json" o
+    "text") y LOG_SAMPLE_RATE. Solo tiene efecto una vez por proceso (un
+    hijo de fork vuelve a configurarlo: el hilo escritor no se hereda), así
+    que cada servicio lo llama al iniciar aunque compartan proceso.
+    """
+    if _state["pid"] == os.getpid():
+        return
+    if json_output is None:
+        json_output = os.environ.get("LOG_FORMAT", "json") != "text"
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", REQUEST_SAMPLE_RATE))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter(service) if json_output else TextFormatter(service))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    if _state["handler"] is not None:
+        root.removeHandler(_state["handler"])
+    handler = NonBlockingQueueHandler(log_queue)
+    root.addHandler(handler)
+    _state.update(pid=os.getpid(), listener=listener, handler=handler, sample_rate=sample_rate)
+    set_level(level or os.environ.get("LOG_LEVEL", "INFO"))
+
+def set_level(level):
+    logging.getLogger().setLevel(level.upper() if isinstance(level, str) else level)
+
+def set_sample_rate(rate):
+    _state["sample_rate"] = min(max(float(rate), 0.0), 1.0)
+
+def log_request(logger, message, *args, **fields):
+    """
+    Log de una solicitud individual: va en DEBUG y solo se escribe una
+    fracción `sample_rate` de ellos. Con DEBUG apagado cuesta una comparación.
+    """
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < _state["sample_rate"]:
+        logger.debug(message, *args, extra=fields)
+
+def log_config(request):
+    """
+    Respuesta a la acción `log_config`: cambia en caliente el nivel
+    ("level") y la fracción de logs por solicitud ("sample_rate") del
+    proceso, y devuelve los valores vigentes.
+    """
+    try:
+        if request.get("level"):
+            set_level(request["level"])
+        if request.get("sample_rate") is not None:
+            set_sample_rate(request["sample_rate"])
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+    return {
+        "status": "success",
+        "level": logging.getLevelName(logging.getLogger().level),
+        "sample_rate": _state["sample_rate"],
+    }
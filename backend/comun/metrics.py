@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites (segundos) de los histogramas de latencia
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def set_function(self, function, **labels):
+        """El valor de esas etiquetas se calcula con `function()` al exportar."""
+        with self._lock:
+            self._values[self._key(labels)] = function
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            yield self.name, key, (), value
+
+class Counter(_Metric):
+    """Valor que solo crece (solicitudes atendidas, errores...)."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """Valor que sube y baja (conexiones abiertas, profundidad de colas...)."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Distribución de observaciones en buckets acumulados, con su suma y cantidad."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield f"{self.name}_sum", key, (), total
+            yield f"{self.name}_count", key, (), count
+
+class MetricsRegistry:
+    """
+    Métricas de un proceso. Pedir dos veces una métrica con el mismo nombre
+    devuelve la misma instancia, así que cada módulo declara las suyas al
+    importarse sin coordinarse con los demás.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, help_text, labels, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"{name} ya está registrada como {metric.kind}")
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        """Todas las métricas en el formato de texto de Prometheus."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(metric.labels, key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+def track_caches(prefix, caches, registry=REGISTRY):
+    """
+    Exporta aciertos, fallos y tasa de aciertos de cachés con `stats()` al
+    estilo de LRUCache; `caches` es {nombre: caché}.
+    """
+    hits = registry.counter(f"{prefix}_cache_hits_total", "Aciertos de la caché", ("cache",))
+    misses = registry.counter(f"{prefix}_cache_misses_total", "Fallos de la caché", ("cache",))
+    ratio = registry.gauge(f"{prefix}_cache_hit_ratio", "Aciertos sobre consultas de la caché", ("cache",))
+    size = registry.gauge(f"{prefix}_cache_entries", "Entradas en la caché", ("cache",))
+
+    def hit_ratio(stats):
+        lookups = stats["hits"] + stats["misses"]
+        return stats["hits"] / lookups if lookups else 0.0
+
+    for name, cache in caches.items():
+        hits.set_function(lambda cache=cache: cache.stats()["hits"], cache=name)
+        misses.set_function(lambda cache=cache: cache.stats()["misses"], cache=name)
+        ratio.set_function(lambda cache=cache: hit_ratio(cache.stats()), cache=name)
+        size.set_function(lambda cache=cache: cache.stats()["size"], cache=name)
+
+class RequestMetrics:
+    """
+    Latencia y errores por acción de un servicio JSON. Las acciones que no
+    están en `actions` se agrupan como "otra" para que un cliente no pueda
+    crear series sin límite.
+    """
+
+    def __init__(self, prefix, actions, registry=REGISTRY):
+        self.actions = frozenset(actions)
+        self.seconds = registry.histogram(f"{prefix}_request_seconds", "Latencia de las solicitudes", ("action",))
+        self.errors = registry.counter(f"{prefix}_request_errors_total", "Solicitudes respondidas con error", ("action",))
+
+    def handle(self, handler, request):
+        """Atiende `request` con `handler` y registra su latencia."""
+        action = request.get("action") if isinstance(request, dict) else None
+        action = action if action in self.actions else "otra"
+        start = time.perf_counter()
+        response = handler(request)
+        self.seconds.observe(time.perf_counter() - start, action=action)
+        if response.get("status") != "success":
+            self.errors.inc(action=action)
+        return response
+
+def stats_response(registry=REGISTRY):
+    """Respuesta a la acción `stats` de los servicios JSON."""
+    return {"status": "success", "metrics": registry.render()}
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Atiende GET /metrics en un hilo propio para que Prometheus lea las
+    métricas del proceso. Devuelve el servidor (server.shutdown() lo detiene).
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metricas", daemon=True).start()
+    return server
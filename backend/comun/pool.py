@@ -0,0 +1,231 @@
+import asyncio
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from .protocol import CODEC_JSON, FrameReader, encode_frame, read_frame_async, send_frame, send_frames
+from .tracing import inject, span
+
+# Conexiones persistentes como máximo por pool, y segundos que una puede
+# quedar ociosa antes de descartarla
+POOL_SIZE = 8
+POOL_MAX_IDLE = 60.0
+
+class RequestNotSent(ConnectionError):
+    """La solicitud no llegó a enviarse: repetirla por otra conexión es seguro."""
+
+class PooledConnection:
+    """Conexión persistente hacia un servicio interno junto con su lector."""
+
+    def __init__(self, sock, codec=CODEC_JSON):
+        self.sock = sock
+        self.codec = codec
+        self.reader = FrameReader(sock)
+        self.last_used = time.monotonic()
+
+    def call(self, payload):
+        self._send(send_frame, payload)
+        return self._receive()
+
+    def call_many(self, payloads):
+        """Envía todas las solicitudes de una vez y lee las respuestas en orden."""
+        self._send(send_frames, payloads)
+        return [self._receive() for _ in payloads]
+
+    def _send(self, send, payload):
+        # Un envío fallido puede haber dejado parte de la trama en el socket,
+        # pero el servicio no procesa una trama incompleta
+        try:
+            send(self.sock, payload, self.codec)
+        except OSError as e:
+            raise RequestNotSent(str(e)) from e
+
+    def _receive(self):
+        response = self.reader.read()
+        if response is None:
+            raise ConnectionError("El servicio cerró la conexión")
+        self.last_used = time.monotonic()
+        return response
+
+    def is_alive(self):
+        """Comprueba sin bloquear que el otro extremo no haya cerrado la conexión."""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        # Datos sin solicitar o fin de archivo: la conexión no es reutilizable
+        return not readable
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    """
+    Pool acotado y seguro entre hilos de conexiones persistentes hacia un servicio.
+
+    Como máximo `max_size` solicitudes se atienden a la vez; las demás esperan
+    hasta `timeout` segundos por una conexión libre. Las conexiones ociosas se
+    verifican antes de reutilizarse y se descartan si llevan más de `max_idle`
+    segundos sin uso. Con `port=None`, `host` es la ruta de un socket Unix.
+    """
+
+    def __init__(self, host, port, max_size=POOL_SIZE, timeout=10.0, max_idle=POOL_MAX_IDLE, codec=CODEC_JSON):
+        self.host = host
+        self.port = port
+        self.peer = host if port is None else f"{host}:{port}"
+        self.codec = codec
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def request(self, payload):
+        """
+        Envía una solicitud y devuelve la respuesta decodificada.
+        Si la solicitud no se pudo enviar por una conexión reutilizada se
+        reintenta una vez con una nueva. Una vez enviada nunca se repite (ni
+        siquiera si la respuesta no llega a tiempo): el servicio pudo haberla
+        procesado y las acciones como save_message no son idempotentes.
+        Dentro de una traza la solicitud se registra como un span y lleva el
+        contexto de la traza al servicio.
+        """
+        with span(payload.get("action", "request"), peer=self.peer):
+            payload = inject(payload)
+            return self._with_connection(lambda conn: conn.call(payload))
+
+    def request_many(self, payloads):
+        """Envía varias solicitudes encadenadas por la misma conexión y devuelve sus respuestas."""
+        if not payloads:
+            return []
+        with span("request_many", peer=self.peer, count=len(payloads)):
+            payloads = [inject(payload) for payload in payloads]
+            return self._with_connection(lambda conn: conn.call_many(payloads))
+
+    def close(self):
+        """Cierra todas las conexiones ociosas del pool."""
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def _with_connection(self, call):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No hay conexiones libres hacia {self.host}:{self.port}")
+        try:
+            conn = self._take_idle()
+            if conn is not None:
+                try:
+                    return self._call(conn, call)
+                except RequestNotSent:
+                    pass
+            return self._call(self._connect(), call)
+        finally:
+            self._slots.release()
+
+    def _call(self, conn, call):
+        try:
+            response = call(conn)
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conn)
+        return response
+
+    def _take_idle(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn = self._idle.pop()
+            if now - conn.last_used <= self.max_idle and conn.is_alive():
+                return conn
+            conn.close()
+
+    def _connect(self):
+        if self.port is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.host)
+            except OSError:
+                sock.close()
+                raise
+            return PooledConnection(sock, self.codec)
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PooledConnection(sock, self.codec)
+
+class AsyncConnectionPool:
+    """
+    Equivalente de ConnectionPool para código asyncio: las conexiones son
+    pares (StreamReader, StreamWriter) y la espera por una conexión libre no
+    bloquea el bucle de eventos.
+    """
+
+    def __init__(self, host, port, max_size=POOL_SIZE, timeout=10.0, codec=CODEC_JSON):
+        self.host = host
+        self.port = port
+        self.peer = f"{host}:{port}"
+        self.max_size = max_size
+        self.timeout = timeout
+        self.codec = codec
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(max_size)
+
+    async def request(self, payload):
+        """
+        Envía una solicitud y devuelve la respuesta decodificada. Como en
+        ConnectionPool, solo se reintenta si la solicitud no llegó a enviarse.
+        """
+        with span(payload.get("action", "request"), peer=self.peer):
+            payload = inject(payload)
+            async with self._slots:
+                conn = self._take_idle()
+                if conn is not None:
+                    try:
+                        return await self._call(conn, payload)
+                    except RequestNotSent:
+                        pass
+                conn = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout
+                )
+                return await self._call(conn, payload)
+
+    def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _call(self, conn, payload):
+        reader, writer = conn
+        try:
+            try:
+                writer.write(encode_frame(payload, self.codec))
+                await writer.drain()
+            except OSError as e:
+                raise RequestNotSent(str(e)) from e
+            response = await asyncio.wait_for(read_frame_async(reader), self.timeout)
+            if response is None:
+                raise ConnectionError("El servicio cerró la conexión")
+        except BaseException:
+            writer.close()
+            raise
+        self._idle.append(conn)
+        return response
+
+    def _take_idle(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            # El servicio cerró la conexión mientras estaba ociosa
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import socket
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BUFFER_SIZE = 4096
+# Por debajo de 2**24 el primer byte de una trama siempre es 0, lo que permite
+# distinguirla de un documento JSON sin delimitar (que empieza por '{').
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024 - 1
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+HEADER = struct.Struct('!IB')
+
+_decoder = json.JSONDecoder()
+
+def encode(obj, codec=CODEC_JSON):
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack no está instalado")
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def decode(body, codec=CODEC_JSON):
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack no está instalado")
+        return msgpack.unpackb(body, raw=False)
+    if codec != CODEC_JSON:
+        raise ValueError(f"Codificación desconocida: {codec}")
+    return json.loads(str(body, 'utf-8'))
+
+def encode_frame(obj, codec=CODEC_JSON):
+    """Devuelve la trama completa: longitud (4 bytes), codificación (1 byte) y cuerpo."""
+    body = encode(obj, codec)
+    if len(body) > MAX_MESSAGE_SIZE:
+        raise ValueError("Mensaje demasiado grande")
+    return HEADER.pack(len(body), codec) + body
+
+def send_frame(sock, obj, codec=CODEC_JSON):
+    sock.sendall(encode_frame(obj, codec))
+
+def send_frames(sock, objs, codec=CODEC_JSON):
+    """Envía varias tramas con una sola escritura (solicitudes encadenadas)."""
+    sock.sendall(b''.join(encode_frame(obj, codec) for obj in objs))
+
+def send_json(sock, obj):
+    """Envía un documento JSON terminado en salto de línea."""
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+async def read_frame_async(reader):
+    """Lee una trama de un asyncio.StreamReader; None si la conexión se cerró entre tramas."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Conexión cerrada a mitad de una trama")
+    length, codec = HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError("Mensaje demasiado grande")
+    try:
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Conexión cerrada a mitad de una trama")
+    return decode(body, codec)
+
+class FrameReader:
+    """
+    Lee tramas consecutivas de un socket.
+
+    El cuerpo se recibe con `recv_into` sobre un búfer que se reutiliza entre
+    tramas, de modo que leer una respuesta grande no implica concatenar
+    fragmentos.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.codec = CODEC_JSON
+
+    def __iter__(self):
+        while True:
+            document = self.read()
+            if document is None:
+                return
+            yield document
+
+    def read(self):
+        """Devuelve el siguiente documento, o None si el otro extremo cerró la conexión."""
+        if not self._read_exactly(memoryview(self.header), allow_eof=True):
+            return None
+        length, codec = HEADER.unpack(self.header)
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError("Mensaje demasiado grande")
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        view = memoryview(self.buffer)[:length]
+        self._read_exactly(view)
+        self.codec = codec
+        return decode(view, codec)
+
+    def _read_exactly(self, view, allow_eof=False):
+        received = 0
+        while received < len(view):
+            count = self.sock.recv_into(view[received:])
+            if count == 0:
+                if allow_eof and received == 0:
+                    return False
+                raise ConnectionError("Conexión cerrada a mitad de una trama")
+            received += count
+        return True
+
+class JSONReader:
+    """
+    Lee documentos JSON consecutivos sin tramas de longitud.
+
+    Es el formato de los clientes que abren una conexión por solicitud (la
+    interfaz y los scripts de prueba): un documento, opcionalmente terminado
+    en salto de línea.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def __iter__(self):
+        while True:
+            document = self.read()
+            if document is None:
+                return
+            yield document
+
+    def read(self):
+        """Devuelve el siguiente documento, o None si el otro extremo cerró la conexión."""
+        while True:
+            document = self._parse()
+            if document is not None:
+                return document
+            if len(self.buffer) > MAX_MESSAGE_SIZE:
+                raise ValueError("Mensaje demasiado grande")
+            data = self.sock.recv(BUFFER_SIZE)
+            if not data:
+                return None
+            self.buffer += data
+
+    def _parse(self):
+        while True:
+            newline = self.buffer.find(b'\n')
+            if newline == -1:
+                break
+            line = bytes(self.buffer[:newline])
+            del self.buffer[:newline + 1]
+            if line.strip():
+                return json.loads(line)
+
+        # Documento sin delimitador: solo se acepta cuando ya está completo
+        try:
+            text = self.buffer.decode('utf-8').lstrip()
+        except UnicodeDecodeError:
+            return None
+        if not text:
+            self.buffer.clear()
+            return None
+        try:
+            document, end = _decoder.raw_decode(text)
+        except ValueError:
+            return None
+        self.buffer = bytearray(text[end:].encode('utf-8'))
+        return document
+
+class MessageStream:
+    """
+    Extremo servidor de una conexión entre servicios.
+
+    Detecta por el primer byte si el cliente usa tramas con longitud o envía
+    JSON sin delimitar, y responde en el mismo formato (y con la misma
+    codificación) que la solicitud.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = None
+
+    def __iter__(self):
+        while True:
+            document = self.read()
+            if document is None:
+                return
+            yield document
+
+    def read(self):
+        if self.reader is None:
+            first = self.sock.recv(1, socket.MSG_PEEK)
+            if not first:
+                return None
+            if first[0] == 0:
+                self.reader = FrameReader(self.sock)
+            else:
+                self.reader = JSONReader(self.sock)
+        return self.reader.read()
+
+    def send(self, obj):
+        if isinstance(self.reader, FrameReader):
+            send_frame(self.sock, obj, self.reader.codec)
+        else:
+            send_json(self.sock, obj)
@@ -0,0 +1,127 @@
+import logging
+import queue
+import socket
+import threading
+
+from .metrics import REGISTRY
+from .pool import POOL_MAX_IDLE, POOL_SIZE
+from .protocol import send_frame, send_json
+
+# Conexiones atendidas a la vez y conexiones aceptadas que pueden esperar un hilo
+MAX_WORKERS = 64
+MAX_PENDING = 256
+# Una conexión que no envía nada en este tiempo se cierra y libera su hilo.
+# Es menor que POOL_MAX_IDLE: el servidor cierra primero las conexiones
+# ociosas de los pools, y el cliente las descarta con is_alive() antes de
+# enviar nada por ellas.
+IDLE_TIMEOUT = POOL_MAX_IDLE / 2
+# Cuánto se espera el primer byte de un cliente rechazado para elegir el formato
+REJECT_PEEK_TIMEOUT = 0.05
+
+log = logging.getLogger(__name__)
+
+SATURATED = {"status": "error", "message": "Servidor saturado, intente más tarde"}
+
+CONNECTIONS = REGISTRY.gauge("server_connections", "Conexiones atendidas o esperando un hilo", ("server",))
+REJECTED = REGISTRY.counter("server_rejected_total", "Conexiones rechazadas por saturación", ("server",))
+
+def workers_for_peers(peers, pool_size=POOL_SIZE, minimum=MAX_WORKERS):
+    """
+    Hilos necesarios para `peers` servicios que se conectan con un pool: cada
+    uno mantiene hasta `pool_size` conexiones persistentes y cada conexión
+    ocupa un hilo mientras está abierta, aunque esté ociosa. Con menos
+    hilos, las conexiones nuevas esperan en la cola hasta agotar el tiempo
+    de espera del cliente.
+    """
+    return max(minimum, peers * pool_size)
+
+def reject_json(conn):
+    """
+    Rechazo para los servicios JSON: responde en tramas si el cliente habla
+    el protocolo de tramas (primer byte 0) y en JSON plano si no.
+    """
+    try:
+        conn.settimeout(REJECT_PEEK_TIMEOUT)
+        first = conn.recv(1, socket.MSG_PEEK)
+    except OSError:
+        first = b''
+    conn.settimeout(None)
+    if first == b'\x00':
+        send_frame(conn, SATURATED)
+    else:
+        send_json(conn, SATURATED)
+
+class ThreadPoolServer:
+    """
+    Núcleo común de los servidores con hilos.
+
+    Un único hilo acepta conexiones y las entrega a `max_workers` hilos
+    fijos, creados a demanda. Como mucho `max_pending` conexiones aceptadas
+    esperan un hilo libre; pasado ese límite la conexión se rechaza con
+    `reject(conn)` y se cierra, en lugar de crear hilos sin control. Con
+    `idle_timeout`, las lecturas del handler fallan con socket.timeout si el
+    cliente no envía nada en ese tiempo.
+
+    Los hilos son daemon, como los que se creaban por conexión: una conexión
+    de mensajería puede durar indefinidamente y no debe impedir que el
+    proceso termine.
+    """
+
+    def __init__(self, handler, max_workers=MAX_WORKERS, max_pending=MAX_PENDING,
+                 idle_timeout=IDLE_TIMEOUT, reject=reject_json, name="servidor"):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.reject = reject
+        self.rejected = 0
+        self.active = 0
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._workers = 0
+        self._lock = threading.Lock()
+        CONNECTIONS.set_function(lambda: self.active, server=name)
+        REJECTED.set_function(lambda: self.rejected, server=name)
+
+    def serve(self, server_socket):
+        """Acepta conexiones indefinidamente."""
+        while True:
+            conn, addr = server_socket.accept()
+            self.submit(conn, addr)
+
+    def submit(self, conn, *args):
+        """Encola la conexión para un hilo del pool; False si se rechazó."""
+        with self._lock:
+            accepted = self.active < self.max_workers + self.max_pending
+            if accepted:
+                self.active += 1
+                spawn = self._workers < min(self.max_workers, self.active)
+                if spawn:
+                    self._workers += 1
+            else:
+                self.rejected += 1
+        if not accepted:
+            try:
+                if self.reject is not None:
+                    self.reject(conn)
+            except OSError:
+                pass
+            finally:
+                conn.close()
+            return False
+        conn.settimeout(self.idle_timeout)
+        self._queue.put((conn, args))
+        if spawn:
+            threading.Thread(target=self._work, name=f"{self.name}-{self._workers}", daemon=True).start()
+        return True
+
+    def _work(self):
+        while True:
+            conn, args = self._queue.get()
+            try:
+                self.handler(conn, *args)
+            except Exception:
+                log.exception("Error al atender la conexión")
+            finally:
+                with self._lock:
+                    self.active -= 1
@@ -0,0 +1,48 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import time
+
+# Vigencia de un token de sesión, en segundos
+SESSION_TTL = 3600
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(key, payload):
+    if isinstance(key, str):
+        key = key.encode()
+    return hmac.new(key, payload.encode(), hashlib.sha256).digest()
+
+def issue_token(key, username, ttl=SESSION_TTL):
+    """
+    Token de sesión <usuario>.<expira>.<firma>, con el usuario y la firma
+    HMAC-SHA256 en base64 para URL: no contiene '|' ni saltos de línea, así
+    que viaja tal cual en una línea AUTH|<token>.
+    """
+    payload = f"{_b64encode(username.encode())}.{int(time.time() + ttl)}"
+    return f"{payload}.{_b64encode(_sign(key, payload))}"
+
+def token_username(token):
+    """Usuario que declara el token, sin verificarlo; None si no tiene formato de token."""
+    try:
+        user_part, _, _ = token.split('.')
+        return _b64decode(user_part).decode()
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+def verify_token(key, token):
+    """Usuario del token si la firma es válida y no expiró; None si no."""
+    try:
+        user_part, expires, signature = token.split('.')
+        if not hmac.compare_digest(_b64decode(signature), _sign(key, f"{user_part}.{expires}")):
+            return None
+        if int(expires) < time.time():
+            return None
+        return _b64decode(user_part).decode()
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
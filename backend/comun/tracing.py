@@ -0,0 +1,205 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import REGISTRY
+
+# Campo de las solicitudes JSON que lleva el contexto de la traza entre servicios
+TRACE_FIELD = "trace"
+# Spans que esperan al hilo escritor; con la cola llena se descartan
+TRACE_QUEUE_SIZE = 10000
+# Spans que el hilo escritor agrega al archivo con una sola escritura
+TRACE_WRITE_BATCH = 512
+# Fracción de los comandos de cliente que se trazan
+TRACE_SAMPLE_RATE = 1.0
+
+DROPPED = REGISTRY.counter("trace_spans_dropped_total", "Spans descartados con la cola llena")
+
+# (id de la traza, id del span activo, servicio) de la solicitud en curso.
+# Cada hilo y cada tarea de asyncio tiene su propio valor.
+_current = contextvars.ContextVar("trace", default=None)
+_lock = threading.Lock()
+_state = {"configured": False, "writer": None, "sample_rate": TRACE_SAMPLE_RATE}
+
+class SpanWriter:
+    """
+    Agrega spans a `path`, uno por línea en JSON, desde un hilo propio. Cada
+    lote se escribe con un solo write en modo O_APPEND, así que varios
+    procesos pueden compartir el archivo sin mezclar líneas. Con la cola
+    llena el span se descarta (y se cuenta) en lugar de frenar la solicitud.
+    """
+
+    def __init__(self, path, max_queue=TRACE_QUEUE_SIZE):
+        self.path = path
+        self._queue = queue.Queue(max_queue)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        threading.Thread(target=self._run, name="trazas", daemon=True).start()
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def flush(self):
+        """Espera a que los spans encolados estén en el archivo."""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < TRACE_WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                data = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+                data = data.encode()
+                while data:
+                    data = data[os.write(self._fd, data):]
+            except OSError:
+                DROPPED.inc(len(records))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if len(records) < len(batch):
+                os.close(self._fd)
+                return
+
+def configure_tracing(path=None, sample_rate=None):
+    """
+    Activa las trazas del proceso: los spans se agregan a `path` (por
+    omisión TRACE_FILE; sin ruta quedan apagadas) y se traza la fracción
+    `sample_rate` de los comandos (TRACE_SAMPLE_RATE, por omisión 1.0).
+    Los servicios no necesitan llamarla: el primer span de cada proceso la
+    llama con los valores del entorno, también en los hijos de fork.
+    """
+    with _lock:
+        _configure(path, sample_rate)
+
+def _configure(path, sample_rate):
+    if path is None:
+        path = os.environ.get("TRACE_FILE")
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", TRACE_SAMPLE_RATE))
+    if _state["writer"] is not None:
+        _state["writer"].close()
+    _state.update(
+        configured=True,
+        writer=SpanWriter(path) if path else None,
+        sample_rate=min(max(float(sample_rate), 0.0), 1.0),
+    )
+
+def stop_tracing():
+    """Escribe los spans pendientes y apaga las trazas del proceso."""
+    with _lock:
+        if _state["writer"] is not None:
+            _state["writer"].close()
+        _state.update(configured=True, writer=None)
+
+def flush_traces():
+    writer = _state["writer"]
+    if writer is not None:
+        writer.flush()
+
+def _after_fork():
+    # El hilo escritor no se hereda: el hijo abre el suyo con su primer span
+    global _lock
+    _lock = threading.Lock()
+    _state.update(configured=False, writer=None)
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(flush_traces)
+
+def _writer():
+    if not _state["configured"]:
+        with _lock:
+            if not _state["configured"]:
+                _configure(None, None)
+    return _state["writer"]
+
+@contextmanager
+def _span(writer, trace_id, parent_id, service, name, tags):
+    span_id = secrets.token_hex(4)
+    token = _current.set((trace_id, span_id, service))
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield tags
+    except BaseException as e:
+        tags["error"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - begin
+        _current.reset(token)
+        writer.write({
+            "trace_id": trace_id, "span_id": span_id, "parent_id": parent_id,
+            "service": service, "name": name, "pid": os.getpid(),
+            "start": round(start, 6), "duration_ms": round(duration * 1000, 3), **tags,
+        })
+
+@contextmanager
+def start_trace(service, name, **tags):
+    """
+    Span raíz de una traza nueva: uno por comando de cliente. Devuelve los
+    `tags` del span (se pueden agregar campos) o None si no se traza.
+    """
+    writer = _writer()
+    if writer is None or random.random() >= _state["sample_rate"]:
+        # Tampoco se continúa una traza anterior de la misma tarea
+        token = _current.set(None)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+    with _span(writer, secrets.token_hex(8), None, service, name, tags) as span_tags:
+        yield span_tags
+
+@contextmanager
+def span(name, **tags):
+    """Span hijo del activo, en el mismo servicio; sin traza activa no registra nada."""
+    current = _current.get()
+    writer = _writer() if current is not None else None
+    if writer is None:
+        yield None
+        return
+    trace_id, parent_id, service = current
+    with _span(writer, trace_id, parent_id, service, name, tags) as span_tags:
+        yield span_tags
+
+@contextmanager
+def continue_trace(request, service, name=None, **tags):
+    """
+    Span de `service` al atender `request`, dentro de la traza que trae en
+    TRACE_FIELD. Las solicitudes sin traza no se registran. El nombre por
+    omisión es la acción de la solicitud.
+    """
+    carrier = request.get(TRACE_FIELD) if isinstance(request, dict) else None
+    writer = _writer() if isinstance(carrier, dict) and carrier.get("id") else None
+    if writer is None:
+        yield None
+        return
+    name = name or str(request.get("action"))
+    with _span(writer, str(carrier["id"]), carrier.get("parent"), service, name, tags) as span_tags:
+        yield span_tags
+
+def inject(payload):
+    """`payload` con el contexto de la traza activa en TRACE_FIELD; sin traza lo devuelve tal cual."""
+    current = _current.get()
+    if current is None:
+        return payload
+    return {**payload, TRACE_FIELD: {"id": current[0], "parent": current[1]}}
@@ -3,47 +3,125 @@ import multiprocessing
 import time
 import subprocess
 
-def start_microservices():
+def start_microservices(async_messaging=False, messaging_shards=1, storage_workers=1, legacy_auth=False,
+                        stats_port=None, trace_file=None, compact_interval=None, archive_days=None,
+                        storage_backend='sqlite', save_batch_delay=None):
     import os
+    import secrets
+    import tempfile
     from servicioMensajeria.main import MessagingService
+    from servicioMensajeria.async_service import AsyncMessagingService
+    from servicioMensajeria.sharding import MessagingRouter, ShardedMessagingService
     from servicioAutenticacion.main import iniciar_servidor as iniciar_autenticacion
-    from servicioAlmacenamiento.main import start_server as iniciar_almacenamiento
+    from servicioAlmacenamiento.main import start_server as iniciar_almacenamiento, start_prefork
     from servicioAlmacenamiento.database import init_db, DB_NAME
+    from servicioAlmacenamiento.compaction import ARCHIVE_AFTER_DAYS, COMPACT_INTERVAL
+    from comun.server import workers_for_peers
 
-    # Limpiar la base de datos antes de iniciar los servicios
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)
-    init_db()
-    print("Base de datos inicializada.")
+    # Limpiar la base de datos antes de iniciar los servicios. Con
+    # storage_backend=memory no se usa: los datos viven en el proceso de
+    # almacenamiento y se pierden al terminar.
+    if storage_backend == 'sqlite':
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+        init_db()
+        print("Base de datos inicializada.")
 
-    # Iniciar el servicio de almacenamiento
-    almacenamiento_process = multiprocessing.Process(target=iniciar_almacenamiento, daemon=True)
-    almacenamiento_process.start()
+    # Clave con la que autenticación firma los tokens de sesión y mensajería
+    # los verifica. Fijarla en SESSION_KEY mantiene válidos los tokens entre reinicios.
+    session_key = os.environ.get('SESSION_KEY') or secrets.token_hex(32)
+
+    # Con trace_file, cada proceso agrega ahí los spans de sus solicitudes
+    # (python trace_report.py <archivo> muestra las más lentas)
+    if trace_file:
+        os.environ['TRACE_FILE'] = os.path.abspath(trace_file)
+
+    # Cada proceso de mensajería mantiene un pool hacia autenticación y otro
+    # hacia almacenamiento, y autenticación uno hacia almacenamiento: los
+    # hilos de cada servicio alcanzan para todas esas conexiones persistentes.
+    storage_threads = workers_for_peers(messaging_shards + 1)
+    auth_threads = workers_for_peers(messaging_shards)
+
+    # Con stats_port, cada servicio publica sus métricas para Prometheus:
+    # almacenamiento en stats_port, autenticación en +1, mensajería (o el
+    # enrutador) en +2 y el shard i en +3+i.
+    def stats(offset):
+        return stats_port + offset if stats_port else None
+
+    # Motor de almacenamiento ('sqlite' o 'memory'). Cada compact_interval
+    # segundos (0 la apaga) almacenamiento archiva los mensajes entregados
+    # con más de archive_days días. save_batch_delay es la latencia máxima
+    # (segundos) de los lotes de save_message en SQLite.
+    storage_options = {
+        'backend': storage_backend,
+        'save_batch_delay': save_batch_delay,
+        'compact_interval': COMPACT_INTERVAL if compact_interval is None else compact_interval,
+        'archive_after_days': ARCHIVE_AFTER_DAYS if archive_days is None else archive_days,
+    }
+
+    # Iniciar el servicio de almacenamiento. En modo prefork los procesos se
+    # lanzan desde aquí: un proceso daemon no puede tener hijos.
+    if storage_workers > 1:
+        start_prefork(storage_workers, max_threads=storage_threads, stats_port=stats(0), **storage_options)
+    else:
+        almacenamiento_process = multiprocessing.Process(
+            target=iniciar_almacenamiento,
+            kwargs={'max_threads': storage_threads, 'stats_port': stats(0), **storage_options},
+            daemon=True
+        )
+        almacenamiento_process.start()
     print("Servicio de almacenamiento iniciado.")
 
     time.sleep(1)
 
     # Iniciar el servicio de autenticación
-    autenticacion_process = multiprocessing.Process(target=iniciar_autenticacion, args=('127.0.0.1', 7000), daemon=True)
+    # No es daemon: calcula los hashes de contraseñas en su propio pool de procesos
+    autenticacion_process = multiprocessing.Process(
+        target=iniciar_autenticacion, args=('127.0.0.1', 7000),
+        kwargs={'max_hilos': auth_threads, 'clave_sesion': session_key, 'puerto_stats': stats(1)}
+    )
     autenticacion_process.start()
     print("Servicio de autenticación iniciado.")
 
     time.sleep(1)
 
-    # Iniciar el servicio de mensajería
-    messaging_service = MessagingService(
-        host='127.0.0.1', port=5001,
-        auth_host='127.0.0.1', auth_port=7000,
-        storage_host='127.0.0.1', storage_port=8000
-    )
-    messaging_process = multiprocessing.Process(target=messaging_service.start, daemon=True)
-    messaging_process.start()
-    print("Servicio de mensajería iniciado.")
+    if messaging_shards > 1:
+        # Un proceso por shard más el enrutador que atiende el puerto público
+        if async_messaging:
+            print("El modo con shards usa el servicio con hilos; se ignora 'async'.")
+        socket_dir = tempfile.mkdtemp(prefix='mensajeria-')
+        for shard in range(messaging_shards):
+            shard_service = ShardedMessagingService(
+                shard, messaging_shards, socket_dir,
+                auth_host='127.0.0.1', auth_port=7000,
+                storage_host='127.0.0.1', storage_port=8000,
+                session_key=session_key, legacy_auth=legacy_auth, stats_port=stats(3 + shard)
+            )
+            multiprocessing.Process(target=shard_service.start, daemon=True).start()
+        time.sleep(1)
+        router = MessagingRouter('127.0.0.1', 5001, messaging_shards, socket_dir,
+                                 session_key=session_key, stats_port=stats(2))
+        multiprocessing.Process(target=router.start, daemon=True).start()
+        print(f"Servicio de mensajería iniciado con {messaging_shards} shards.")
+    else:
+        # Iniciar el servicio de mensajería (con hilos o con asyncio)
+        service_class = AsyncMessagingService if async_messaging else MessagingService
+        messaging_service = service_class(
+            host='127.0.0.1', port=5001,
+            auth_host='127.0.0.1', auth_port=7000,
+            storage_host='127.0.0.1', storage_port=8000,
+            session_key=session_key, legacy_auth=legacy_auth, stats_port=stats(2)
+        )
+        messaging_process = multiprocessing.Process(target=messaging_service.start, daemon=True)
+        messaging_process.start()
+        print("Servicio de mensajería iniciado.")
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
+        autenticacion_process.join(timeout=2)
+        autenticacion_process.terminate()
         print("Servicios detenidos.")
 
 def run_tests():
@@ -53,9 +131,28 @@ def run_tests():
     subprocess.run(['python', 'test_autenticacion.py'])
     time.sleep(1)
     subprocess.run(['python', 'test_integration.py'])
+    time.sleep(1)
+    subprocess.run(['python', 'test_comun.py'])
 
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'test':
         run_tests()
     else:
-        start_microservices()
+        # Opciones: 'async', 'legacy_auth' (acepta AUTH|<username>), 'shards=<N>',
+        # 'storage_workers=<N>', 'stats_port=<N>', 'trace_file=<ruta>', 'compact_interval=<segundos>',
+        # 'archive_days=<N>', 'storage_backend=<sqlite|memory>' y 'save_batch_delay=<segundos>'
+        # (p. ej. python main.py shards=4)
+        def option(name, default, parse=int):
+            return next((parse(arg.split('=', 1)[1]) for arg in sys.argv[1:] if arg.startswith(f'{name}=')), default)
+        start_microservices(
+            async_messaging='async' in sys.argv[1:],
+            messaging_shards=option('shards', 1),
+            storage_workers=option('storage_workers', 1),
+            legacy_auth='legacy_auth' in sys.argv[1:],
+            stats_port=option('stats_port', None),
+            trace_file=option('trace_file', None, str),
+            compact_interval=option('compact_interval', None),
+            archive_days=option('archive_days', None),
+            storage_backend=option('storage_backend', 'sqlite', str),
+            save_batch_delay=option('save_batch_delay', None, float),
+        )
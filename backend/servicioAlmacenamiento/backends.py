@@ -0,0 +1,271 @@
+import bisect
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+from . import database
+
+class StorageBackend(ABC):
+    """
+    Lo que el servicio de almacenamiento necesita de su motor. process_request
+    traduce cada acción a uno de estos métodos, así que un motor nuevo solo
+    tiene que implementarlos con la misma semántica que database.py.
+
+    `shared` indica si varios procesos pueden usar el motor a la vez (en el
+    modo prefork los trabajadores leen por su cuenta); si no, el proceso
+    escritor atiende todas las acciones. Un motor que no implementa alguno
+    de los métodos abstractos falla al crearse.
+    """
+
+    name = None
+    shared = False
+
+    def init(self):
+        """Prepara el almacenamiento antes de atender solicitudes."""
+
+    def after_fork(self, writer=True):
+        """Prepara el motor en un proceso hijo del modo prefork."""
+
+    def start_maintenance(self, compact_interval, archive_after_days):
+        """Arranca las tareas de fondo del proceso que escribe."""
+
+    def caches(self):
+        """Cachés con `stats()` que se exportan como métricas, por nombre."""
+        return {}
+
+    @abstractmethod
+    def save_user(self, username, password_hash):
+        """Registra al usuario; ValueError si ya existe."""
+
+    @abstractmethod
+    def register_user(self, username, password_hash):
+        """Registra al usuario si el nombre está libre; devuelve si lo registró."""
+
+    @abstractmethod
+    def register_users(self, users):
+        """Registra los pares (usuario, hash) libres; devuelve los nombres registrados."""
+
+    @abstractmethod
+    def update_password(self, username, old_hash, new_hash):
+        """Cambia el hash solo si sigue siendo `old_hash`; devuelve si lo cambió."""
+
+    @abstractmethod
+    def get_user(self, username):
+        """{"password_hash": ...} del usuario, o None si no existe."""
+
+    @abstractmethod
+    def get_all_users(self):
+        """Nombres de todos los usuarios."""
+
+    @abstractmethod
+    def save_message(self, sender, receiver, message):
+        """Guarda el mensaje como pendiente; vuelve cuando ya está guardado."""
+
+    @abstractmethod
+    def get_messages(self, receiver):
+        """Textos de los pendientes de `receiver`, que quedan entregados."""
+
+    @abstractmethod
+    def get_pending_messages(self, receiver, after_id=0, limit=None):
+        """Hasta `limit` pendientes con id mayor que `after_id`, sin marcarlos."""
+
+    @abstractmethod
+    def ack_messages(self, receiver, up_to_id):
+        """Marca entregados los pendientes con id hasta `up_to_id`; devuelve cuántos."""
+
+    @abstractmethod
+    def get_conversation_history(self, user1, user2, before_id=None, limit=None):
+        """Los `limit` mensajes de la conversación anteriores a `before_id`, en orden."""
+
+    @abstractmethod
+    def compact(self, max_age_days=None):
+        """Pasada de compactación inmediata; devuelve lo archivado y las páginas liberadas."""
+
+class SQLiteBackend(StorageBackend):
+    """
+    El motor persistente de database.py (SQLite en modo WAL). Con
+    `save_batch_delay` fija la latencia máxima de los lotes de save_message
+    en el proceso que lo inicia y en sus hijos del modo prefork.
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, save_batch_delay=None):
+        self.save_batch_delay = save_batch_delay
+
+    def _configure_batching(self):
+        if self.save_batch_delay is not None:
+            database.set_save_batch_delay(self.save_batch_delay)
+
+    def init(self):
+        database.init_db()
+        self._configure_batching()
+
+    def after_fork(self, writer=True):
+        database.after_fork(writer)
+        self._configure_batching()
+
+    def start_maintenance(self, compact_interval, archive_after_days):
+        if compact_interval:
+            database.compactor.interval = compact_interval
+            database.compactor.max_age_days = archive_after_days
+            database.compactor.start()
+
+    def caches(self):
+        return {"users": database.user_cache, "messages": database.message_cache}
+
+    def save_user(self, username, password_hash):
+        database.save_user(username, password_hash)
+
+    def register_user(self, username, password_hash):
+        return database.register_user(username, password_hash)
+
+    def register_users(self, users):
+        return database.register_users(users)
+
+    def update_password(self, username, old_hash, new_hash):
+        return database.update_password(username, old_hash, new_hash)
+
+    def get_user(self, username):
+        return database.get_user(username)
+
+    def get_all_users(self):
+        return database.get_all_users()
+
+    def save_message(self, sender, receiver, message):
+        database.save_message(sender, receiver, message)
+
+    def get_messages(self, receiver):
+        return database.get_messages(receiver)
+
+    def get_pending_messages(self, receiver, after_id=0, limit=None):
+        return database.get_pending_messages(receiver, after_id, limit)
+
+    def ack_messages(self, receiver, up_to_id):
+        return database.ack_messages(receiver, up_to_id)
+
+    def get_conversation_history(self, user1, user2, before_id=None, limit=None):
+        return database.get_conversation_history(user1, user2, before_id, limit)
+
+    def compact(self, max_age_days=None):
+        return database.compact_messages(max_age_days)
+
+class MemoryBackend(StorageBackend):
+    """
+    Motor en memoria, sin durabilidad: para medir la capa de red por
+    separado o para despliegues efímeros. Los usuarios están en un dict; cada
+    conversación guarda sus mensajes en orden de id (el historial se pagina
+    con bisect) y cada destinatario sus pendientes en una deque, de la que
+    los ack sacan por la izquierda. Un solo candado protege todo: cada
+    operación toca unas pocas entradas.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._ids = itertools.count(1)
+        # (menor, mayor) -> ([ids], [mensajes]), como idx_messages_conversation
+        self._conversations = {}
+        self._pending = {}
+
+    def save_user(self, username, password_hash):
+        if not self.register_user(username, password_hash):
+            raise ValueError("El usuario ya existe.")
+
+    def register_user(self, username, password_hash):
+        with self._lock:
+            if username in self._users:
+                return False
+            self._users[username] = password_hash
+            return True
+
+    def register_users(self, users):
+        registered = []
+        with self._lock:
+            for username, password_hash in users:
+                if username not in self._users:
+                    self._users[username] = password_hash
+                    registered.append(username)
+        return registered
+
+    def update_password(self, username, old_hash, new_hash):
+        with self._lock:
+            if self._users.get(username) != old_hash:
+                return False
+            self._users[username] = new_hash
+            return True
+
+    def get_user(self, username):
+        password_hash = self._users.get(username)
+        return None if password_hash is None else {"password_hash": password_hash}
+
+    def get_all_users(self):
+        with self._lock:
+            return list(self._users)
+
+    def save_message(self, sender, receiver, message):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        with self._lock:
+            record = {"id": next(self._ids), "sender": sender, "message": message, "timestamp": timestamp}
+            ids, messages = self._conversations.setdefault(tuple(sorted((sender, receiver))), ([], []))
+            ids.append(record["id"])
+            messages.append(record)
+            self._pending.setdefault(receiver, deque()).append(record)
+
+    def get_messages(self, receiver):
+        with self._lock:
+            pending = self._pending.pop(receiver, ())
+            return [record["message"] for record in pending]
+
+    def get_pending_messages(self, receiver, after_id=0, limit=None):
+        limit = limit or database.PENDING_PAGE_SIZE
+        with self._lock:
+            page = []
+            for record in self._pending.get(receiver, ()):
+                if record["id"] > (after_id or 0):
+                    page.append(dict(record))
+                    if len(page) == limit:
+                        break
+            return page
+
+    def ack_messages(self, receiver, up_to_id):
+        with self._lock:
+            pending = self._pending.get(receiver)
+            acked = 0
+            while pending and pending[0]["id"] <= up_to_id:
+                pending.popleft()
+                acked += 1
+            if pending is not None and not pending:
+                del self._pending[receiver]
+            return acked
+
+    def get_conversation_history(self, user1, user2, before_id=None, limit=None):
+        with self._lock:
+            ids, messages = self._conversations.get(tuple(sorted((user1, user2))), ((), ()))
+            end = bisect.bisect_left(ids, before_id) if before_id else len(ids)
+            start = 0 if limit is None else max(end - limit, 0)
+            return [dict(record) for record in messages[start:end]]
+
+    def compact(self, max_age_days=None):
+        # Sin archivo ni páginas que devolver: todo el historial vive en memoria
+        return {"archived": {}, "released_pages": 0}
+
+BACKENDS = {backend.name: backend for backend in (SQLiteBackend, MemoryBackend)}
+
+def create_backend(backend, **options):
+    """
+    Motor por nombre ("sqlite" o "memory") creado con `options`; una
+    instancia se devuelve tal cual.
+    """
+    if isinstance(backend, StorageBackend):
+        return backend
+    try:
+        backend_class = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Motor de almacenamiento desconocido: {backend}") from None
+    return backend_class(**options)
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+class WriteBatcher:
+    """
+    Agrupa inserciones concurrentes en una sola transacción (group commit).
+
+    Un hilo de fondo toma las filas encoladas y las escribe con `executemany`.
+    Tras la primera fila espera hasta `max_delay` segundos a que lleguen más,
+    sin pasar de `max_rows` por transacción. Quien llama a `submit` queda
+    bloqueado hasta que su fila está confirmada en disco.
+
+    `on_commit`, si se indica, recibe las filas del lote dentro de la misma
+    transacción (por ejemplo, para invalidar cachés sin dejar una ventana en
+    la que la caché contradiga a la base).
+    """
+
+    def __init__(self, engine, statement, max_delay=0.002, max_rows=256, on_commit=None):
+        self.engine = engine
+        self.statement = statement
+        self.on_commit = on_commit
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.commits = 0
+        self.rows = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def after_fork(self):
+        """Descarta la cola y el hilo heredados; el proceso hijo arranca los suyos."""
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, params):
+        """Encola una fila y espera a que se confirme; relanza el error si falla."""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((params, future))
+        return future.result()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            rows = [params for params, _ in batch]
+            with self.engine.write() as conn:
+                conn.executemany(self.statement, rows)
+                if self.on_commit is not None:
+                    self.on_commit(rows)
+        except Exception as e:
+            # Una fila inválida no debe hacer fallar a las demás del lote
+            if len(batch) > 1:
+                for item in batch:
+                    self._commit([item])
+            else:
+                batch[0][1].set_exception(e)
+            return
+        self.commits += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            future.set_result(None)
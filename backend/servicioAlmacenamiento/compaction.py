@@ -0,0 +1,209 @@
+import argparse
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from comun.metrics import REGISTRY
+from .engine import SQLiteEngine
+
+# Días desde su envío a partir de los cuales un mensaje entregado sale de messages
+ARCHIVE_AFTER_DAYS = 30
+# Segundos entre pasadas de la compactación
+COMPACT_INTERVAL = 3600
+# Filas de messages que se revisan por transacción: las escrituras esperan a
+# lo sumo un lote
+COMPACT_BATCH_SIZE = 1000
+# Páginas libres que se devuelven al sistema por transacción
+VACUUM_PAGES = 1000
+# Filas por índice que lee ANALYZE: estadísticas aproximadas pero baratas
+ANALYSIS_LIMIT = 1000
+
+ARCHIVE_PREFIX = "messages_archive_"
+AUTO_VACUUM_INCREMENTAL = 2
+
+ARCHIVED = REGISTRY.counter("storage_archived_messages_total", "Mensajes movidos a las tablas de archivo")
+COMPACTION_SECONDS = REGISTRY.histogram(
+    "storage_compaction_seconds", "Duración de cada pasada de compactación", buckets=(0.01, 0.1, 1, 10, 60, 300)
+)
+
+log = logging.getLogger(__name__)
+
+SCAN_QUERY = """
+    SELECT id, sender, receiver, message, is_delivered, timestamp
+    FROM messages
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+CATALOG_UPSERT = """
+    INSERT INTO message_archives (name, min_id, max_id, rows) VALUES (?, ?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET
+        min_id = min(min_id, excluded.min_id),
+        max_id = max(max_id, excluded.max_id),
+        rows = rows + excluded.rows
+"""
+
+def archive_table(timestamp):
+    """Tabla de archivo del mes de `timestamp` ("AAAA-MM-DD HH:MM:SS"): messages_archive_AAAA_MM."""
+    return f"{ARCHIVE_PREFIX}{timestamp[:4]}_{timestamp[5:7]}"
+
+def create_archive_table(conn, name):
+    # Mismo índice de conversación que messages; todos sus mensajes están entregados
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME
+        )
+    """)
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{name}_conversation
+        ON {name} (min(sender, receiver), max(sender, receiver), id)
+    """)
+
+def archive_messages(engine, max_age_days, batch_size=COMPACT_BATCH_SIZE, now=None):
+    """
+    Mueve a su tabla de archivo mensual los mensajes entregados con más de
+    `max_age_days` días y devuelve cuántos movió a cada tabla. Los
+    pendientes se quedan en messages aunque sean viejos.
+
+    Recorre messages por id, un lote por transacción, y se detiene en el
+    primer mensaje reciente: los ids crecen con el tiempo, así que el resto
+    de la tabla también lo es.
+    """
+    now = time.time() if now is None else now
+    cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - max_age_days * 86400))
+    moved = defaultdict(int)
+    after_id = 0
+    while True:
+        partitions = defaultdict(list)
+        with engine.write() as conn:
+            rows = conn.execute(SCAN_QUERY, (after_id, batch_size)).fetchall()
+            old = [row for row in rows if row[5] < cutoff]
+            for row in old:
+                if row[4]:
+                    partitions[archive_table(row[5])].append(row)
+            for name, batch in partitions.items():
+                create_archive_table(conn, name)
+                conn.executemany(
+                    f"INSERT INTO {name} (id, sender, receiver, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    [(row[0], row[1], row[2], row[3], row[5]) for row in batch]
+                )
+                conn.execute(CATALOG_UPSERT, (name, batch[0][0], batch[-1][0], len(batch)))
+                conn.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in batch])
+        for name, batch in partitions.items():
+            moved[name] += len(batch)
+            ARCHIVED.inc(len(batch))
+        if len(old) < batch_size:
+            return dict(moved)
+        after_id = rows[-1][0]
+
+def incremental_vacuum_enabled(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+
+def enable_incremental_vacuum(conn):
+    """
+    Activa auto_vacuum=INCREMENTAL en una base creada sin él. Solo se aplica
+    reescribiéndola con VACUUM, que en una base grande bloquea las
+    escrituras mientras dura: no lo hace el servicio, sino el comando de
+    mantenimiento de este módulo, con el servicio detenido. Las bases nuevas
+    ya nacen con el modo incremental (ver engine.PRAGMAS).
+    """
+    if incremental_vacuum_enabled(conn):
+        return
+    log.info("Activando auto_vacuum incremental (VACUUM de la base)")
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+def release_free_pages(engine, pages=VACUUM_PAGES):
+    """Devuelve al sistema las páginas libres, de a `pages` por transacción; devuelve cuántas."""
+    released = 0
+    while True:
+        with engine.write() as conn:
+            if not incremental_vacuum_enabled(conn):
+                return released
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return released
+            conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        released += free - remaining
+        if remaining >= free:
+            return released
+
+def analyze(engine, limit=ANALYSIS_LIMIT):
+    """Actualiza las estadísticas del planificador leyendo a lo sumo `limit` filas por índice."""
+    with engine.write() as conn:
+        conn.execute(f"PRAGMA analysis_limit={limit}")
+        conn.execute("ANALYZE")
+
+class MessageCompactor:
+    """
+    Mantiene chica la tabla messages desde un hilo de fondo del proceso que
+    escribe. Cada `interval` segundos archiva los mensajes entregados con
+    más de `max_age_days` días, devuelve al sistema las páginas que quedaron
+    libres y, si movió mensajes, actualiza las estadísticas del planificador.
+    """
+
+    def __init__(self, engine, max_age_days=ARCHIVE_AFTER_DAYS, interval=COMPACT_INTERVAL,
+                 batch_size=COMPACT_BATCH_SIZE):
+        self.engine = engine
+        self.max_age_days = max_age_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self, max_age_days=None, now=None):
+        """Una pasada completa; devuelve los mensajes archivados por tabla y las páginas liberadas."""
+        if max_age_days is None:
+            max_age_days = self.max_age_days
+        with self._lock, COMPACTION_SECONDS.time():
+            archived = archive_messages(self.engine, max_age_days, self.batch_size, now)
+            released = release_free_pages(self.engine)
+            if archived:
+                analyze(self.engine)
+        return {"archived": archived, "released_pages": released}
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="compactacion", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                result = self.run()
+            except Exception:
+                log.exception("Error en la compactación de mensajes")
+                continue
+            if result["archived"] or result["released_pages"]:
+                log.info("Compactación: %s mensajes archivados, %s páginas liberadas",
+                         sum(result["archived"].values()), result["released_pages"])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convierte una base existente a auto_vacuum incremental (VACUUM completo). "
+                    "Ejecutar con el servicio de almacenamiento detenido: "
+                    "python -m servicioAlmacenamiento.compaction storage_service.db"
+    )
+    parser.add_argument("database", help="archivo de la base SQLite")
+    config = parser.parse_args(argv)
+    engine = SQLiteEngine(config.database)
+    with engine.write() as conn:
+        enable_incremental_vacuum(conn)
+    engine.reset()
+    print(f"{config.database}: auto_vacuum incremental activado.")
+
+if __name__ == "__main__":
+    main()
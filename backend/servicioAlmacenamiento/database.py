@@ -1,109 +1,304 @@
+import logging
+import os
 import sqlite3
-import threading
+
+from comun.cache import MISSING, LRUCache
+from .batcher import WriteBatcher
+from .compaction import MessageCompactor, incremental_vacuum_enabled
+from .engine import SQLiteEngine
+from .migrations import apply_migrations
 
 DB_NAME = "storage_service.db"
 
-user_cache = {}
-message_cache = {}
-lock = threading.Lock()
+log = logging.getLogger(__name__)
+
+# Latencia máxima (segundos) que un mensaje espera a que se llene su lote,
+# y tamaño máximo del lote confirmado en una transacción. La latencia se
+# puede fijar con SAVE_BATCH_DELAY o, al iniciar el servicio, con
+# start_server(save_batch_delay=...).
+SAVE_MESSAGE_MAX_DELAY = float(os.environ.get("SAVE_BATCH_DELAY", 0.002))
+SAVE_MESSAGE_MAX_BATCH = 256
+
+# Una entrada de usuario ocupa unos 250 bytes (nombre, hash y estructuras),
+# así que 16384 entradas caben en ~4 MB: suficiente para el conjunto activo.
+USER_CACHE_SIZE = 16384
+USER_CACHE_TTL = 300
+# Los usuarios desconocidos se recuerdan poco tiempo: otro proceso puede registrarlos
+UNKNOWN_USER_CACHE_TTL = 5
+# Destinatarios sin mensajes pendientes (el caso común al iniciar sesión)
+MESSAGE_CACHE_SIZE = 16384
+
+# Usa idx_messages_pending; se pagina por id para entregar en bloques
+PENDING_MESSAGES_QUERY = """
+    SELECT id, sender, message, timestamp
+    FROM messages
+    WHERE receiver = ? AND is_delivered = 0 AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+PENDING_PAGE_SIZE = 500
+
+# Usa idx_messages_conversation: el par se normaliza igual que en el índice.
+# Paginación por cursor: la página son los `limit` mensajes anteriores a `before_id`.
+CONVERSATION_HISTORY_QUERY = """
+    SELECT id, sender, message, timestamp
+    FROM messages
+    WHERE min(sender, receiver) = ? AND max(sender, receiver) = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+# La misma consulta sobre una tabla de archivo, y las tablas de archivo que
+# pueden tener mensajes anteriores a un id, de la más reciente a la más vieja
+ARCHIVE_HISTORY_QUERY = """
+    SELECT id, sender, message, timestamp
+    FROM {table}
+    WHERE min(sender, receiver) = ? AND max(sender, receiver) = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+ARCHIVES_QUERY = "SELECT name, max_id FROM message_archives WHERE min_id < ? ORDER BY max_id DESC"
+
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+user_cache = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL, negative_ttl=UNKNOWN_USER_CACHE_TTL)
+message_cache = LRUCache(MESSAGE_CACHE_SIZE)
+engine = SQLiteEngine(DB_NAME)
+# Los trabajadores del modo prefork no ven las escrituras del escritor en su
+# caché: un usuario recordado como inexistente seguiría sin existir para ellos.
+cache_unknown_users = True
+
+def _invalidate_pending(rows):
+    for _, receiver, _ in rows:
+        message_cache.invalidate(receiver)
+
+message_batcher = WriteBatcher(
+    engine,
+    "INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)",
+    max_delay=SAVE_MESSAGE_MAX_DELAY,
+    max_rows=SAVE_MESSAGE_MAX_BATCH,
+    on_commit=_invalidate_pending,
+)
+# La arranca el proceso que escribe (ver SQLiteBackend.start_maintenance)
+compactor = MessageCompactor(engine)
 
 def init_db():
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                receiver TEXT NOT NULL,
-                message TEXT NOT NULL,
-                is_delivered BOOLEAN DEFAULT 0,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
+    # El archivo pudo haberse borrado o reemplazado: descartar las conexiones viejas
+    engine.reset()
+    user_cache.clear()
+    message_cache.clear()
+    if not os.path.exists(DB_NAME):
+        # Restos del journal WAL de una base anterior no deben aplicarse a la nueva
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(DB_NAME + suffix):
+                os.remove(DB_NAME + suffix)
+    with engine.write() as conn:
+        apply_migrations(conn)
+        if not incremental_vacuum_enabled(conn):
+            # La compactación archiva igual, pero las páginas libres quedan en el archivo
+            log.warning("La base no usa auto_vacuum incremental; para convertirla, con el servicio "
+                        "detenido: python -m servicioAlmacenamiento.compaction %s", DB_NAME)
+
+def use_database(path):
+    """
+    Apunta el módulo a otra base (por ejemplo, una temporal en las pruebas)
+    sin tocar la anterior; init_db la prepara.
+    """
+    global DB_NAME
+    engine.reset()
+    engine.path = DB_NAME = path
+    user_cache.clear()
+    message_cache.clear()
+
+def set_save_batch_delay(seconds):
+    """Latencia máxima de los lotes de save_message; rige desde el próximo lote."""
+    message_batcher.max_delay = seconds
+
+def after_fork(writer=True):
+    """
+    Prepara el estado del módulo en un proceso hijo (modo prefork). Solo el
+    escritor recuerda usuarios inexistentes: es el único que ve los registros.
+    """
+    global cache_unknown_users
+    cache_unknown_users = writer
+    engine.after_fork()
+    message_batcher.after_fork()
+    user_cache.clear()
+    message_cache.clear()
 
 def save_user(username, password_hash):
-    with lock:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(
-                    "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                    (username, password_hash)
-                )
-                user_cache[username] = {
-                    "password_hash": password_hash,
-                }
-            except sqlite3.IntegrityError:
-                raise ValueError("El usuario ya existe.")
+    try:
+        with engine.write() as conn:
+            conn.execute(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (username, password_hash)
+            )
+    except sqlite3.IntegrityError:
+        raise ValueError("El usuario ya existe.")
+    user_cache.set(username, {
+        "password_hash": password_hash,
+    })
+
+REGISTER_USER_QUERY = """
+    INSERT INTO users (username, password_hash) VALUES (?, ?)
+    ON CONFLICT (username) DO NOTHING
+"""
+
+def register_user(username, password_hash):
+    """
+    Registra al usuario si el nombre está libre, con una sola sentencia: dos
+    registros concurrentes del mismo nombre no pueden pasar ambos una
+    comprobación previa. Devuelve si lo registró.
+    """
+    with engine.write() as conn:
+        cursor = conn.execute(REGISTER_USER_QUERY, (username, password_hash))
+    if cursor.rowcount:
+        user_cache.set(username, {"password_hash": password_hash})
+    return cursor.rowcount > 0
+
+def register_users(users):
+    """
+    Registra una lista de pares (usuario, hash) en una sola transacción y
+    devuelve los nombres registrados; los que ya existían se omiten.
+    """
+    registered = []
+    with engine.write() as conn:
+        for username, password_hash in users:
+            if conn.execute(REGISTER_USER_QUERY, (username, password_hash)).rowcount:
+                registered.append((username, password_hash))
+    for username, password_hash in registered:
+        user_cache.set(username, {"password_hash": password_hash})
+    return [username for username, _ in registered]
+
+def update_password(username, old_hash, new_hash):
+    """
+    Reemplaza el hash de la contraseña solo si sigue siendo `old_hash`, para
+    que dos actualizaciones concurrentes no se pisen. Devuelve si lo cambió.
+    """
+    with engine.write() as conn:
+        cursor = conn.execute(
+            "UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?",
+            (new_hash, username, old_hash)
+        )
+    if cursor.rowcount:
+        user_cache.set(username, {"password_hash": new_hash})
+    return cursor.rowcount > 0
 
 def get_user(username):
-    with lock:
-        if username in user_cache:
-            return user_cache[username]
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT username, password_hash, FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
-            if user:
-                user_cache[username] = {"password_hash": user[1]}
-                return user_cache[username]
-            return None
+    user = user_cache.get(username)
+    if user is not MISSING:
+        return user
+    with engine.read() as conn:
+        row = conn.execute(
+            "SELECT username, password_hash FROM users WHERE username = ?", (username,)
+        ).fetchone()
+    user = {"password_hash": row[1]} if row else None
+    if user is not None or cache_unknown_users:
+        user_cache.set(username, user)
+    return user
 
 def save_message(sender, receiver, message):
-    with lock:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)",
-                (sender, receiver, message)
-            )
-            if receiver not in message_cache:
-                message_cache[receiver] = []
-            message_cache[receiver].append(message)
+    message_batcher.submit((sender, receiver, message))
 
 def get_messages(receiver):
-    with lock:
-        if receiver in message_cache:
-            return message_cache[receiver]
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, message FROM messages WHERE receiver = ? AND is_delivered = 0",
-                (receiver,)
-            )
-            messages = cursor.fetchall()
-            message_ids = [msg[0] for msg in messages]
-            cursor.executemany(
-                "UPDATE messages SET is_delivered = 1 WHERE id = ?", [(mid,) for mid in message_ids]
-            )
-            conn.commit()
-            return [msg[1] for msg in messages]
+    # message_cache solo recuerda destinatarios sin pendientes; save_message
+    # invalida la entrada dentro de la transacción que inserta el mensaje.
+    if message_cache.get(receiver) is not MISSING:
+        return []
+    # Lectura y marcado en la misma transacción para no entregar dos veces
+    with engine.write() as conn:
+        messages = conn.execute(PENDING_MESSAGES_QUERY, (receiver, 0, -1)).fetchall()
+        conn.executemany(
+            "UPDATE messages SET is_delivered = 1 WHERE id = ?", [(msg[0],) for msg in messages]
+        )
+        message_cache.set(receiver, ())
+    return [msg[2] for msg in messages]
+
+def get_pending_messages(receiver, after_id=0, limit=PENDING_PAGE_SIZE):
+    """
+    Devuelve hasta `limit` mensajes pendientes con id mayor que `after_id`,
+    sin marcarlos como entregados: eso lo hace `ack_messages` cuando el
+    cliente ya los recibió.
+    """
+    if not after_id and message_cache.get(receiver) is not MISSING:
+        return []
+    params = (receiver, after_id or 0, limit or PENDING_PAGE_SIZE)
+    with engine.read() as conn:
+        messages = conn.execute(PENDING_MESSAGES_QUERY, params).fetchall()
+    if not messages and not after_id:
+        # Se confirma dentro de una transacción de escritura, serializada con
+        # las inserciones, para no cachear un vacío que ya no es cierto.
+        with engine.write() as conn:
+            messages = conn.execute(PENDING_MESSAGES_QUERY, params).fetchall()
+            if not messages:
+                message_cache.set(receiver, ())
+    return [
+        {'id': msg[0], 'sender': msg[1], 'message': msg[2], 'timestamp': msg[3]}
+        for msg in messages
+    ]
+
+def ack_messages(receiver, up_to_id):
+    """
+    Marca como entregados los pendientes de `receiver` con id hasta
+    `up_to_id`. Repetir el mismo ack no tiene efecto, así que un cliente que
+    se reconecta a mitad de la entrega no pierde ni duplica mensajes
+    confirmados. Devuelve cuántos mensajes se marcaron.
+    """
+    with engine.write() as conn:
+        cursor = conn.execute(
+            "UPDATE messages SET is_delivered = 1 WHERE receiver = ? AND is_delivered = 0 AND id <= ?",
+            (receiver, up_to_id)
+        )
+    return cursor.rowcount
+
+def compact_messages(max_age_days=None, now=None):
+    """Pasada de compactación inmediata; ver MessageCompactor.run."""
+    return compactor.run(max_age_days, now)
+
+def cache_stats():
+    return {"users": user_cache.stats(), "messages": message_cache.stats()}
 
 def get_all_users():
-    with lock:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT username FROM users")
-            users = [row[0] for row in cursor.fetchall()]
-            return users
-
-def get_conversation_history(user1, user2):
-    with lock:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT sender, message, timestamp
-                FROM messages
-                WHERE (sender = ? AND receiver = ?) OR (sender = ? AND receiver = ?)
-                ORDER BY timestamp ASC
-            """, (user1, user2, user2, user1))
-            messages = cursor.fetchall()
-            return [{'sender': msg[0], 'message': msg[1], 'timestamp': msg[2]} for msg in messages]
+    with engine.read() as conn:
+        return [row[0] for row in conn.execute("SELECT username FROM users")]
+
+def get_conversation_history(user1, user2, before_id=None, limit=None):
+    """
+    Devuelve en orden cronológico los `limit` mensajes más recientes de la
+    conversación con id menor que `before_id` (todos si no se indica límite).
+    """
+    with engine.read() as conn:
+        return read_conversation_history(conn, user1, user2, before_id, limit)
+
+def read_conversation_history(conn, user1, user2, before_id=None, limit=None):
+    """
+    get_conversation_history sobre la conexión de lectura `conn`.
+
+    Los mensajes archivados son entregados y viejos, pero sus ids se
+    intercalan con los de pendientes aún más viejos que siguen en messages,
+    así que la página se arma combinando por id. Las tablas de archivo se
+    recorren de la más reciente a la más vieja y solo mientras puedan
+    aportar mensajes a la página.
+    """
+    user_a, user_b = sorted((user1, user2))
+    before_id = before_id or MAX_MESSAGE_ID
+    params = (user_a, user_b, before_id, -1 if limit is None else limit)
+    # Una sola transacción: la compactación no puede mover un mensaje
+    # entre las dos consultas
+    conn.execute("BEGIN")
+    try:
+        messages = conn.execute(CONVERSATION_HISTORY_QUERY, params).fetchall()
+        for table, max_id in conn.execute(ARCHIVES_QUERY, (before_id,)).fetchall():
+            if limit is not None and 0 < limit <= len(messages) and max_id < messages[limit - 1][0]:
+                break
+            messages.extend(conn.execute(ARCHIVE_HISTORY_QUERY.format(table=table), params))
+            messages.sort(key=lambda msg: msg[0], reverse=True)
+            if limit is not None:
+                del messages[limit:]
+    finally:
+        conn.rollback()
+    messages.reverse()
+    return [
+        {'id': msg[0], 'sender': msg[1], 'message': msg[2], 'timestamp': msg[3]}
+        for msg in messages
+    ]
@@ -0,0 +1,121 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from comun.metrics import REGISTRY
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# La conexión de escritura confirma con fsync; el costo se reparte entre las
+# filas de cada lote de WriteBatcher.
+WRITER_PRAGMAS = (
+    "PRAGMA synchronous=FULL",
+)
+
+STATEMENT_CACHE_SIZE = 256
+
+# Tiempo dentro de cada transacción (sin la espera por la conexión)
+SQLITE_SECONDS = REGISTRY.histogram("storage_sqlite_seconds", "Tiempo en transacciones de SQLite", ("mode",))
+
+class SQLiteEngine:
+    """
+    Conexiones persistentes a la base de datos de almacenamiento.
+
+    Hay una única conexión de escritura, protegida por un candado, y un pool de
+    conexiones de solo lectura. Con el journal en modo WAL las lecturas no
+    esperan a las escrituras en curso. sqlite3 guarda las sentencias ya
+    preparadas por conexión, así que las consultas se reutilizan sin volver a
+    compilarse mientras la conexión siga abierta.
+    """
+
+    def __init__(self, path, readers=4):
+        self.path = path
+        self.readers = readers
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._idle_readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(readers)
+        self._generation = 0
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        if not read_only:
+            # Antes que WAL: en un archivo nuevo rige desde la primera tabla,
+            # así la compactación devuelve páginas sin reescribir la base. Una
+            # base existente conserva su modo (ver compaction.enable_incremental_vacuum).
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only=1")
+        else:
+            for pragma in WRITER_PRAGMAS:
+                conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def write(self):
+        """Entrega la conexión de escritura dentro de una transacción."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            with SQLITE_SECONDS.time(mode="write"), self._writer:
+                yield self._writer
+
+    @contextmanager
+    def read(self):
+        """Entrega una conexión de solo lectura del pool."""
+        with self._reader_slots:
+            try:
+                generation, conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                generation, conn = self._generation, self._connect(read_only=True)
+            try:
+                with SQLITE_SECONDS.time(mode="read"):
+                    yield conn
+            finally:
+                if generation == self._generation:
+                    self._idle_readers.put((generation, conn))
+                else:
+                    conn.close()
+
+    def reset(self):
+        """
+        Cierra todas las conexiones abiertas. Se usa cuando el archivo de la
+        base de datos se reemplaza (por ejemplo, al limpiarla antes de las pruebas).
+        """
+        with self._write_lock:
+            self._generation += 1
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            while True:
+                try:
+                    _, conn = self._idle_readers.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+
+    def after_fork(self):
+        """
+        Descarta, sin cerrarlas, las conexiones heredadas del proceso padre:
+        SQLite no admite usar una conexión a ambos lados de un fork. Cada
+        proceso abre las suyas a medida que las necesita.
+        """
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._idle_readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(self.readers)
+        self._generation += 1
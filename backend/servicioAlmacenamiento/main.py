@@ -1,63 +1,242 @@
+import logging
+import multiprocessing
+import os
 import socket
-import threading
-import json
-from .database import get_all_users, init_db, save_user, get_user, save_message, get_messages, get_conversation_history
+import time
+from functools import partial
+from comun.log import configure_logging, log_config, log_request
+from comun.metrics import RequestMetrics, serve_metrics, stats_response, track_caches
+from comun.pool import ConnectionPool
+from comun.protocol import MessageStream
+from comun.server import MAX_PENDING, MAX_WORKERS, ThreadPoolServer
+from comun.tracing import continue_trace
+from .backends import SQLiteBackend, create_backend
+from .compaction import ARCHIVE_AFTER_DAYS, COMPACT_INTERVAL
 
 HOST = "127.0.0.1"
 PORT = 8000
+LISTEN_BACKLOG = 1024
+WRITER_SOCKET = "storage_writer.sock"
+WRITER_POOL_SIZE = 32
+DEFAULT_BACKEND = SQLiteBackend()
 
-def handle_client(conn, addr):
-    print(f"Conexión establecida desde {addr}")
+log = logging.getLogger(__name__)
+
+# En modo prefork estas acciones las atiende el proceso escritor: escriben en
+# la base o dependen de cachés que solo las escrituras mantienen al día.
+WRITER_ACTIONS = {
+    "guardar_usuario", "registrar_usuario_atomic", "registrar_usuarios_atomic", "actualizar_password",
+    "save_message", "get_messages", "get_pending_messages", "ack_messages", "compact",
+}
+request_metrics = RequestMetrics("storage", WRITER_ACTIONS | {
+    "obtener_usuario", "obtener_usuarios", "get_conversation_history", "stats", "log_config",
+})
+
+def process_request(request, backend=DEFAULT_BACKEND):
+    """Atiende una solicitud con `backend` (un StorageBackend) y devuelve la respuesta."""
     try:
-        data = conn.recv(1024)
-        if not data:
-            return
-        request = json.loads(data.decode("utf-8"))
         action = request.get("action")
 
         if action == "guardar_usuario":
-            save_user(request["username"], request["password_hash"])
+            backend.save_user(request["username"], request["password_hash"])
             response = {"status": "success", "message": "Usuario registrado exitosamente"}
+        elif action == "registrar_usuario_atomic":
+            if backend.register_user(request["username"], request["password_hash"]):
+                response = {"status": "success", "message": "Usuario registrado exitosamente"}
+            else:
+                response = {"status": "error", "message": "Usuario ya existe"}
+        elif action == "registrar_usuarios_atomic":
+            users = [(user["username"], user["password_hash"]) for user in request["users"]]
+            registered = backend.register_users(users)
+            response = {"status": "success", "registered": registered}
+        elif action == "actualizar_password":
+            if backend.update_password(request["username"], request["old_hash"], request["password_hash"]):
+                response = {"status": "success", "message": "Contraseña actualizada"}
+            else:
+                response = {"status": "error", "message": "El hash de la contraseña cambió"}
         elif action == "obtener_usuario":
-            user = get_user(request["username"])
+            user = backend.get_user(request["username"])
             if user:
                 response = {"status": "success", "user": user}
             else:
                 response = {"status": "error", "message": "Usuario no encontrado"}
         elif action == "obtener_usuarios":
-            users = get_all_users()
+            users = backend.get_all_users()
             response = {"status": "success", "users": users}
         elif action == "save_message":
-            save_message(request["sender"], request["receiver"], request["message"])
+            backend.save_message(request["sender"], request["receiver"], request["message"])
             response = {"status": "success", "message": "Mensaje guardado"}
         elif action == "get_conversation_history":
-                user1 = request.get("user1")
-                user2 = request.get("user2")
-                messages = get_conversation_history(user1, user2)
-                response = {"status": "success", "messages": messages}
+            user1 = request.get("user1")
+            user2 = request.get("user2")
+            messages = backend.get_conversation_history(
+                user1, user2, request.get("before_id"), request.get("limit")
+            )
+            response = {"status": "success", "messages": messages}
         elif action == "get_messages":
-            messages = get_messages(request["receiver"])
+            messages = backend.get_messages(request["receiver"])
             response = {"status": "success", "messages": messages}
+        elif action == "get_pending_messages":
+            messages = backend.get_pending_messages(
+                request["receiver"], request.get("after_id"), request.get("limit")
+            )
+            response = {"status": "success", "messages": messages}
+        elif action == "ack_messages":
+            acked = backend.ack_messages(request["receiver"], request["up_to_id"])
+            response = {"status": "success", "acked": acked}
+        elif action == "compact":
+            response = {"status": "success", **backend.compact(request.get("max_age_days"))}
+        elif action == "stats":
+            # En modo prefork, las métricas del proceso que atendió la solicitud
+            response = stats_response()
+        elif action == "log_config":
+            response = log_config(request)
         else:
             response = {"status": "error", "message": "Acción no válida"}
     except Exception as e:
         response = {"status": "error", "message": str(e)}
+    return response
+
+def handle_client(conn, addr, handler=process_request):
+    """Atiende todas las solicitudes de una conexión hasta que el cliente la cierre."""
+    log_request(log, "Conexión establecida desde %s", addr)
+    stream = MessageStream(conn)
+    try:
+        for request in stream:
+            with continue_trace(request, "almacenamiento"):
+                response = request_metrics.handle(handler, request)
+            stream.send(response)
+    except ValueError as e:
+        stream.send({"status": "error", "message": str(e)})
+    except OSError:
+        pass
     finally:
-        conn.sendall(json.dumps(response).encode("utf-8"))
         conn.close()
 
-def start_server():
-    init_db()
+def serve(server, handler=process_request, max_threads=MAX_WORKERS, max_pending=MAX_PENDING,
+          backend=DEFAULT_BACKEND):
+    track_caches("storage", backend.caches())
+    pool = ThreadPoolServer(
+        lambda conn, addr: handle_client(conn, addr, handler),
+        max_workers=max_threads, max_pending=max_pending, name="almacenamiento",
+    )
+    pool.serve(server)
+
+def listen_tcp(backlog, reuse_port=False, port=PORT):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(5)
-    print(f"Servidor de almacenamiento escuchando en {HOST}:{PORT}")
-
-    while True:
-        conn, addr = server.accept()
-        client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-        client_thread.start()
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((HOST, port))
+    server.listen(backlog)
+    return server
+
+def backend_options(save_batch_delay):
+    # Solo las opciones indicadas: un motor que no las admite falla al crearse
+    return {} if save_batch_delay is None else {"save_batch_delay": save_batch_delay}
+
+def start_server(workers=1, backlog=LISTEN_BACKLOG, max_threads=MAX_WORKERS, max_pending=MAX_PENDING,
+                 stats_port=None, compact_interval=COMPACT_INTERVAL, archive_after_days=ARCHIVE_AFTER_DAYS,
+                 backend=DEFAULT_BACKEND, save_batch_delay=None):
+    """
+    Inicia el servicio. Cada proceso atiende a lo sumo `max_threads`
+    conexiones a la vez y deja esperar `max_pending`; las demás se rechazan.
+    Con `workers` > 1 usa el modo prefork: varios procesos comparten el
+    puerto con SO_REUSEPORT y el núcleo reparte las conexiones entre ellos.
+    Con `stats_port` las métricas se publican por HTTP en ese puerto. Cada
+    `compact_interval` segundos los mensajes entregados con más de
+    `archive_after_days` días pasan a las tablas de archivo. `backend` es
+    un StorageBackend o su nombre ("sqlite" o "memory"); con un nombre,
+    `save_batch_delay` fija la latencia máxima (segundos) de los lotes de
+    save_message.
+    """
+    configure_logging("almacenamiento")
+    backend = create_backend(backend, **backend_options(save_batch_delay))
+    backend.init()
+    if workers > 1:
+        processes = start_prefork(workers, backlog, max_threads=max_threads, max_pending=max_pending,
+                                  stats_port=stats_port, compact_interval=compact_interval,
+                                  archive_after_days=archive_after_days, backend=backend)
+        for process in processes:
+            process.join()
+        return
+    server = listen_tcp(backlog)
+    log.info("Servidor de almacenamiento escuchando en %s:%s", HOST, PORT)
+    if stats_port:
+        serve_metrics(stats_port)
+    backend.start_maintenance(compact_interval, archive_after_days)
+    serve(server, partial(process_request, backend=backend), max_threads, max_pending, backend)
+
+def start_prefork(workers, backlog=LISTEN_BACKLOG, writer_socket=WRITER_SOCKET, port=PORT,
+                  max_threads=MAX_WORKERS, max_pending=MAX_PENDING, stats_port=None,
+                  compact_interval=COMPACT_INTERVAL, archive_after_days=ARCHIVE_AFTER_DAYS,
+                  backend=DEFAULT_BACKEND, save_batch_delay=None):
+    """
+    Lanza un proceso escritor y `workers` procesos que atienden a los
+    clientes, y devuelve los procesos. Cada trabajador lee con sus propias
+    conexiones SQLite (WAL permite lecturas concurrentes entre procesos) y
+    reenvía las acciones de WRITER_ACTIONS al escritor por un socket Unix,
+    así que todas las escrituras siguen pasando por una sola conexión y un
+    solo WriteBatcher. La base ya debe estar inicializada. Con un motor que
+    no se comparte entre procesos (`backend.shared` falso, como el de
+    memoria) el escritor atiende todas las acciones y los trabajadores solo
+    reparten las conexiones.
+
+    Las métricas de `stats_port` son las del escritor, que hace todas las
+    escrituras; la acción `stats` devuelve las del trabajador que la atiende.
+    La compactación también corre en el escritor. `backend` es un
+    StorageBackend o su nombre, y `save_batch_delay` se aplica como en
+    start_server.
+    """
+    backend = create_backend(backend, **backend_options(save_batch_delay))
+    if os.path.exists(writer_socket):
+        os.remove(writer_socket)
+    # El escritor recibe a lo sumo WRITER_POOL_SIZE conexiones de cada trabajador
+    writer_threads = workers * WRITER_POOL_SIZE
+    processes = [multiprocessing.Process(
+        target=run_writer,
+        args=(writer_socket, writer_threads, stats_port, compact_interval, archive_after_days, backend),
+        daemon=True
+    )]
+    processes[0].start()
+    while not os.path.exists(writer_socket):
+        time.sleep(0.01)
+    for _ in range(workers):
+        process = multiprocessing.Process(
+            target=run_worker, args=(writer_socket, backlog, port, max_threads, max_pending, backend), daemon=True
+        )
+        process.start()
+        processes.append(process)
+    log.info("Servidor de almacenamiento escuchando en %s:%s (%s procesos)", HOST, port, workers)
+    return processes
+
+def run_writer(writer_socket, max_threads, stats_port=None, compact_interval=COMPACT_INTERVAL,
+               archive_after_days=ARCHIVE_AFTER_DAYS, backend=DEFAULT_BACKEND):
+    backend.after_fork()
+    configure_logging("almacenamiento-escritor")
+    if stats_port:
+        serve_metrics(stats_port)
+    backend.start_maintenance(compact_interval, archive_after_days)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(writer_socket)
+    server.listen(LISTEN_BACKLOG)
+    serve(server, partial(process_request, backend=backend), max_threads, backend=backend)
+
+def run_worker(writer_socket, backlog, port=PORT, max_threads=MAX_WORKERS, max_pending=MAX_PENDING,
+               backend=DEFAULT_BACKEND):
+    backend.after_fork(writer=False)
+    configure_logging("almacenamiento")
+    writer = ConnectionPool(writer_socket, None, max_size=WRITER_POOL_SIZE)
+
+    def handler(request):
+        if request.get("action") in WRITER_ACTIONS or not backend.shared:
+            try:
+                return writer.request(request)
+            except Exception as e:
+                return {"status": "error", "message": str(e)}
+        return process_request(request, backend)
+
+    serve(listen_tcp(backlog, reuse_port=True, port=port), handler, max_threads, max_pending, backend)
 
 if __name__ == "__main__":
     start_server()
@@ -0,0 +1,77 @@
+# Cada entrada lleva el esquema de la versión N a la N + 1. La versión
+# aplicada se guarda en PRAGMA user_version; nunca se editan entradas ya
+# publicadas, solo se agregan nuevas al final.
+MIGRATIONS = [
+    # 1: esquema inicial
+    (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            message TEXT NOT NULL,
+            is_delivered BOOLEAN DEFAULT 0,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ),
+    # 2: mensajes pendientes por destinatario e historial por conversación.
+    # La conversación se indexa con el par normalizado (menor, mayor) para que
+    # ambos sentidos de la charla queden contiguos en el índice.
+    (
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_pending
+        ON messages (receiver, id) WHERE is_delivered = 0
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (min(sender, receiver), max(sender, receiver), timestamp)
+        """,
+    ),
+    # 3: el historial se pagina por id (cursor estable y único), así que el
+    # índice de conversación pasa a ordenar por id en lugar de timestamp.
+    (
+        "DROP INDEX IF EXISTS idx_messages_conversation",
+        """
+        CREATE INDEX idx_messages_conversation
+        ON messages (min(sender, receiver), max(sender, receiver), id)
+        """,
+    ),
+    # 4: catálogo de las tablas de archivo (una por mes) a las que la
+    # compactación mueve los mensajes entregados, con su rango de ids para
+    # que el historial consulte solo las que pueden tener la página pedida.
+    (
+        """
+        CREATE TABLE message_archives (
+            name TEXT PRIMARY KEY,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            rows INTEGER NOT NULL
+        )
+        """,
+    ),
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn):
+    """Aplica, cada una en su propia transacción, las migraciones pendientes."""
+    version = schema_version(conn)
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,141 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from comun.cache import MISSING, LRUCache
+from comun.metrics import REGISTRY
+from comun.tracing import span
+
+# Parámetros de scrypt: con N=2^14 y r=8 cada hash usa 16 MB y unos 50 ms.
+# Se guardan junto al hash, así que se pueden subir sin invalidar los
+# existentes: se recalculan en el siguiente inicio de sesión.
+ESQUEMA = "scrypt"
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+TAMANO_SAL = 16
+TAMANO_HASH = 32
+
+# Procesos que calculan hashes; con 0 se calculan en el hilo de la solicitud
+PROCESOS_HASH = os.cpu_count() or 1
+
+# Credenciales verificadas hace poco: un nuevo inicio de sesión con la misma
+# contraseña no repite scrypt ni la consulta al almacenamiento.
+CACHE_CREDENCIALES_TAMANO = 16384
+CACHE_CREDENCIALES_TTL = 60
+
+# Incluye la espera por un proceso libre del pool
+SEGUNDOS_HASH = REGISTRY.histogram("auth_hash_seconds", "Tiempo de cálculo y verificación de hashes", ("operation",))
+
+def _scrypt(password, sal, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=sal, n=n, r=r, p=p, maxmem=256 * n * r, dklen=TAMANO_HASH
+    )
+
+def calcular_hash(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """Hash con sal, en el formato scrypt$<n>$<r>$<p>$<sal>$<hash> (hexadecimal)."""
+    sal = os.urandom(TAMANO_SAL)
+    return f"{ESQUEMA}${n}${r}${p}${sal.hex()}${_scrypt(password, sal, n, r, p).hex()}"
+
+def verificar_hash(password, password_hash):
+    """Compara en tiempo constante; acepta también el SHA-256 sin sal de versiones anteriores."""
+    if password_hash.startswith(f"{ESQUEMA}$"):
+        _, n, r, p, sal, esperado = password_hash.split("$")
+        calculado = _scrypt(password, bytes.fromhex(sal), int(n), int(r), int(p)).hex()
+        return hmac.compare_digest(calculado, esperado)
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+
+def requiere_rehash(password_hash):
+    """True si el hash no usa el esquema y los parámetros actuales."""
+    return not password_hash.startswith(f"{ESQUEMA}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+def _preparar_proceso():
+    # El Ctrl+C llega a todo el grupo; el pool lo cierra el proceso del
+    # servicio, y si a este lo terminan sin cerrarlo, el hijo sale solo.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_salir_con_el_padre, args=(multiprocessing.parent_process(),), daemon=True).start()
+
+def _salir_con_el_padre(padre):
+    padre.join()
+    os._exit(0)
+
+class HasherContrasenas:
+    """
+    Calcula y verifica hashes en un pool de procesos, para que el trabajo de
+    CPU de scrypt no compita por el GIL con los hilos que atienden
+    conexiones. El pool se crea con el primer uso, ya dentro del proceso del
+    servicio; ese proceso no puede ser daemon porque tiene hijos.
+    """
+
+    def __init__(self, procesos=PROCESOS_HASH):
+        self.procesos = procesos
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def calcular(self, password):
+        with SEGUNDOS_HASH.time(operation="calcular"), span("hash.calcular"):
+            return self._ejecutar(calcular_hash, password)
+
+    def calcular_varios(self, passwords):
+        """Hashes de una lista de contraseñas, repartidos entre los procesos."""
+        with SEGUNDOS_HASH.time(operation="calcular_varios"), span("hash.calcular_varios", count=len(passwords)):
+            if not self.procesos:
+                return [calcular_hash(password) for password in passwords]
+            return list(self._obtener_pool().map(calcular_hash, passwords))
+
+    def verificar(self, password, password_hash):
+        with SEGUNDOS_HASH.time(operation="verificar"), span("hash.verificar"):
+            return self._ejecutar(verificar_hash, password, password_hash)
+
+    def _ejecutar(self, funcion, *args):
+        if not self.procesos:
+            return funcion(*args)
+        return self._obtener_pool().submit(funcion, *args).result()
+
+    def _obtener_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    self.procesos,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_preparar_proceso,
+                )
+            return self._pool
+
+    def cerrar(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+class CacheCredenciales:
+    """
+    Recuerda por `ttl` segundos las credenciales ya verificadas. No guarda la
+    contraseña sino un HMAC de ella con una clave aleatoria que solo existe
+    en la memoria de este proceso.
+    """
+
+    def __init__(self, max_size=CACHE_CREDENCIALES_TAMANO, ttl=CACHE_CREDENCIALES_TTL):
+        self._clave = secrets.token_bytes(32)
+        self._cache = LRUCache(max_size, ttl=ttl)
+
+    def _huella(self, username, password):
+        return hmac.new(self._clave, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def verificada(self, username, password):
+        huella = self._cache.get(username)
+        return huella is not MISSING and hmac.compare_digest(huella, self._huella(username, password))
+
+    def recordar(self, username, password):
+        self._cache.set(username, self._huella(username, password))
+
+    def olvidar(self, username):
+        self._cache.invalidate(username)
+
+    def stats(self):
+        return self._cache.stats()
@@ -1,20 +1,39 @@
-import json
+import logging
 import socket
-import threading
-import hashlib
+
+from comun.log import configure_logging, log_config
+from comun.metrics import RequestMetrics, serve_metrics, stats_response, track_caches
+from comun.pool import ConnectionPool
+from comun.protocol import MessageStream, send_frame
+from comun.server import MAX_PENDING, MAX_WORKERS, ThreadPoolServer
+from comun.tokens import issue_token
+from comun.tracing import continue_trace
+from .credenciales import PROCESOS_HASH, CacheCredenciales, HasherContrasenas, requiere_rehash
 
 ALMACENAMIENTO_HOST = '127.0.0.1'
 ALMACENAMIENTO_PORT = 8000
 MENSAJERIA_PORT = 5001
 MENSAJERIA_HOST = '127.0.0.1'
 
+log = logging.getLogger(__name__)
+almacenamiento_pool = ConnectionPool(ALMACENAMIENTO_HOST, ALMACENAMIENTO_PORT)
+hasher = HasherContrasenas()
+credenciales_verificadas = CacheCredenciales()
+# Clave compartida con el servicio de mensajería para firmar los tokens de
+# sesión; sin clave, iniciar_sesion no emite token.
+clave_sesion = None
+
+metricas_solicitudes = RequestMetrics("auth", {
+    "registrar_usuario", "registrar_usuarios", "iniciar_sesion", "verificar_usuario", "obtener_usuarios", "stats",
+    "log_config",
+})
+def configurar_clave_sesion(clave):
+    global clave_sesion
+    clave_sesion = clave
+
 def enviar_solicitud_al_almacenamiento(solicitud):
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-            cliente.connect((ALMACENAMIENTO_HOST, ALMACENAMIENTO_PORT))
-            cliente.sendall(json.dumps(solicitud).encode('utf-8'))
-            respuesta = cliente.recv(1024).decode('utf-8')
-            return json.loads(respuesta)
+        return almacenamiento_pool.request(solicitud)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -27,32 +46,52 @@ def notificar_nuevo_usuario(username):
                 "action": "nuevo_usuario",
                 "username": username
             }
-            cliente.sendall(json.dumps(solicitud).encode('utf-8'))
+            send_frame(cliente, solicitud)
     except Exception as e:
-        print(f"Error al notificar al servicio de mensajería: {e}")
+        log.warning("Error al notificar al servicio de mensajería: %s", e)
 
 def registrar_usuario(username, password):
-    """Registra un usuario nuevo en el sistema."""
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-
+    """
+    Registra un usuario nuevo en el sistema. El almacenamiento inserta solo si
+    el nombre está libre, así que basta una solicitud y dos registros
+    concurrentes del mismo nombre no pueden tener éxito ambos.
+    """
     respuesta = enviar_solicitud_al_almacenamiento({
-        "action": "obtener_usuario",
-        "username": username
+        "action": "registrar_usuario_atomic",
+        "username": username,
+        "password_hash": hasher.calcular(password)
     })
-
     if respuesta["status"] == "success":
-        return {"status": "error", "message": "Usuario ya existe"}
+        notificar_nuevo_usuario(username)
+        # Ya se conoce la contraseña: el registro deja la sesión iniciada y
+        # un inicio de sesión inmediato no repite scrypt.
+        credenciales_verificadas.recordar(username, password)
+        respuesta = sesion_iniciada(username, "Usuario registrado exitosamente")
+    return respuesta
 
+def registrar_usuarios(usuarios):
+    """
+    Registra en una sola transacción una lista de usuarios ({"username",
+    "password"}), para cargas masivas. Devuelve los registrados; los que ya
+    existían se omiten.
+    """
+    hashes = hasher.calcular_varios([usuario["password"] for usuario in usuarios])
     respuesta = enviar_solicitud_al_almacenamiento({
-        "action": "guardar_usuario",
-        "username": username,
-        "password_hash": password_hash
+        "action": "registrar_usuarios_atomic",
+        "users": [
+            {"username": usuario["username"], "password_hash": password_hash}
+            for usuario, password_hash in zip(usuarios, hashes)
+        ]
     })
+    if respuesta["status"] == "success":
+        for username in respuesta["registered"]:
+            notificar_nuevo_usuario(username)
     return respuesta
 
 def iniciar_sesion(username, password):
     """Inicia sesión de un usuario existente."""
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    if credenciales_verificadas.verificada(username, password):
+        return sesion_iniciada(username)
 
     respuesta = enviar_solicitud_al_almacenamiento({
         "action": "obtener_usuario",
@@ -62,12 +101,36 @@ def iniciar_sesion(username, password):
     if respuesta["status"] == "error":
         return {"status": "error", "message": "Usuario no encontrado"}
 
-    usuario = respuesta["user"]
-    if usuario["password_hash"] == password_hash:
-        return {"status": "success", "message": "Inicio de sesión exitoso"}
-    else:
+    password_hash = respuesta["user"]["password_hash"]
+    if not hasher.verificar(password, password_hash):
         return {"status": "error", "message": "Contraseña incorrecta"}
 
+    if requiere_rehash(password_hash):
+        actualizar_hash(username, password, password_hash)
+    credenciales_verificadas.recordar(username, password)
+    return sesion_iniciada(username)
+
+def sesion_iniciada(username, mensaje="Inicio de sesión exitoso"):
+    """
+    Respuesta a un inicio de sesión correcto, con un token firmado que el
+    servicio de mensajería verifica sin consultar a este servicio.
+    """
+    respuesta = {"status": "success", "message": mensaje}
+    if clave_sesion is not None:
+        respuesta["token"] = issue_token(clave_sesion, username)
+    return respuesta
+
+def actualizar_hash(username, password, password_hash):
+    """Reemplaza un hash viejo (SHA-256 o parámetros anteriores) por uno actual."""
+    respuesta = enviar_solicitud_al_almacenamiento({
+        "action": "actualizar_password",
+        "username": username,
+        "old_hash": password_hash,
+        "password_hash": hasher.calcular(password)
+    })
+    if respuesta["status"] != "success":
+        log.warning("No se pudo actualizar el hash de %s: %s", username, respuesta.get("message"))
+
 def verificar_usuario(username):
     """Verifica si un usuario existe (llamada interna)."""
     respuesta = enviar_solicitud_al_almacenamiento({
@@ -83,39 +146,72 @@ def obtener_usuarios():
     })
     return respuesta
 
-def manejar_cliente(conexion):
+def procesar_solicitud(solicitud):
     try:
-        datos = conexion.recv(1024).decode('utf-8')
-        solicitud = json.loads(datos)
         accion = solicitud.get("action")
 
         if accion == "registrar_usuario":
             respuesta = registrar_usuario(solicitud["username"], solicitud["password"])
+        elif accion == "registrar_usuarios":
+            respuesta = registrar_usuarios(solicitud["users"])
         elif accion == "iniciar_sesion":
             respuesta = iniciar_sesion(solicitud["username"], solicitud["password"])
         elif accion == "verificar_usuario":
             respuesta = verificar_usuario(solicitud["username"])
         elif accion == "obtener_usuarios":
             respuesta = obtener_usuarios()
+        elif accion == "stats":
+            respuesta = stats_response()
+        elif accion == "log_config":
+            respuesta = log_config(solicitud)
         else:
             respuesta = {"status": "error", "message": "Acción no válida"}
-
-        conexion.sendall(json.dumps(respuesta).encode('utf-8'))
     except Exception as e:
-        conexion.sendall(json.dumps({"status": "error", "message": str(e)}).encode('utf-8'))
+        respuesta = {"status": "error", "message": str(e)}
+    return respuesta
+
+def manejar_cliente(conexion, direccion=None):
+    """Atiende todas las solicitudes de una conexión hasta que el cliente la cierre."""
+    stream = MessageStream(conexion)
+    try:
+        for solicitud in stream:
+            with continue_trace(solicitud, "autenticacion"):
+                respuesta = metricas_solicitudes.handle(procesar_solicitud, solicitud)
+            stream.send(respuesta)
+    except ValueError as e:
+        stream.send({"status": "error", "message": str(e)})
+    except OSError:
+        pass
     finally:
         conexion.close()
 
-def iniciar_servidor(host='127.0.0.1', puerto=7000):
+def iniciar_servidor(host='127.0.0.1', puerto=7000, max_hilos=MAX_WORKERS, max_pendientes=MAX_PENDING,
+                     procesos_hash=PROCESOS_HASH, clave_sesion=None, puerto_stats=None):
+    """
+    Inicia el servicio. Atiende a lo sumo `max_hilos` conexiones a la vez y
+    deja esperar `max_pendientes`; las demás reciben un error de saturación.
+    Los hashes de contraseñas se calculan en `procesos_hash` procesos y los
+    tokens de sesión se firman con `clave_sesion`. Con `puerto_stats` las
+    métricas se publican por HTTP en ese puerto.
+    """
+    configure_logging("autenticacion")
+    hasher.procesos = procesos_hash
+    track_caches("auth", {"credenciales": credenciales_verificadas})
+    configurar_clave_sesion(clave_sesion)
     servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     servidor.bind((host, puerto))
-    servidor.listen(5)
-    print(f"Servicio de autenticación iniciado en {host}:{puerto}")
+    servidor.listen(max_pendientes)
+    log.info("Servicio de autenticación iniciado en %s:%s", host, puerto)
+    if puerto_stats:
+        serve_metrics(puerto_stats, host)
 
-    while True:
-        conexion, _ = servidor.accept()
-        threading.Thread(target=manejar_cliente, args=(conexion,)).start()
+    pool = ThreadPoolServer(manejar_cliente, max_workers=max_hilos, max_pending=max_pendientes,
+                            name="autenticacion")
+    try:
+        pool.serve(servidor)
+    finally:
+        hasher.cerrar()
 
 if __name__ == "__main__":
     iniciar_servidor()
@@ -0,0 +1,395 @@
+import asyncio
+import logging
+from functools import partial
+
+from comun.log import configure_logging, log_config
+from comun.metrics import serve_metrics, stats_response
+from comun.pool import AsyncConnectionPool
+from comun.protocol import encode_frame, read_frame_async
+from comun.tokens import verify_token
+from comun.tracing import start_trace
+from .broadcast import AsyncNewUserBroadcaster
+from .connection import MAX_LINE_LENGTH, OUTBOUND_QUEUE_SIZE, OVERFLOW_SPILL, AsyncClientConnection
+from .main import (
+    AUTH_FAILED, AUTH_PROMPT, COMMAND_SECONDS, MESSAGES, PENDING_PAGE_SIZE, command_label,
+    format_history_page, format_pending_messages, parse_history_args, parse_send_batch, track_service
+)
+
+# Cola de conexiones pendientes de aceptar
+LISTEN_BACKLOG = 1024
+
+log = logging.getLogger(__name__)
+
+class AsyncMessagingService:
+    """
+    Implementación con asyncio del servicio de mensajería.
+
+    Habla el mismo protocolo que MessagingService (AUTH, SEND, GET_USERS,
+    GET_HISTORY y las notificaciones en port + 1), pero atiende todas las
+    conexiones desde un único bucle de eventos. Una conexión ociosa solo
+    ocupa un par de buffers, así que un proceso puede mantener decenas de
+    miles de clientes (sujeto al límite de descriptores del sistema).
+
+    StreamReader ya separa los comandos por línea con el límite
+    MAX_LINE_LENGTH, así que admite comandos encadenados en una lectura.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5001,
+                 auth_host="127.0.0.1", auth_port=7000,
+                 storage_host="127.0.0.1", storage_port=8000,
+                 outbound_queue_size=OUTBOUND_QUEUE_SIZE, overflow_policy=OVERFLOW_SPILL,
+                 session_key=None, legacy_auth=None, stats_port=None):
+        self.host = host
+        self.port = port
+        self.auth_host = auth_host
+        self.auth_port = auth_port
+        self.storage_host = storage_host
+        self.storage_port = storage_port
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow_policy = overflow_policy
+        # Igual que en MessagingService: tokens firmados y AUTH|<username> opcional
+        self.session_key = session_key
+        self.legacy_auth = session_key is None if legacy_auth is None else legacy_auth
+        self.stats_port = stats_port
+        self.connected_clients = {}
+        self.known_users = set()
+
+    def start(self):
+        """
+        Inicia el servidor de mensajería y bloquea hasta que se detenga.
+        """
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        configure_logging("mensajeria")
+        # Los pools se crean dentro del bucle que los va a usar
+        self.auth_pool = AsyncConnectionPool(self.auth_host, self.auth_port)
+        self.storage_pool = AsyncConnectionPool(self.storage_host, self.storage_port)
+        self.broadcaster = AsyncNewUserBroadcaster(lambda: self.connected_clients.values())
+        track_service(self)
+        if self.stats_port:
+            serve_metrics(self.stats_port, self.host)
+
+        server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            backlog=LISTEN_BACKLOG, limit=MAX_LINE_LENGTH
+        )
+        notifications = await asyncio.start_server(
+            self.handle_notification, self.host, self.port + 1
+        )
+        log.info("Servicio de mensajería (asyncio) corriendo en %s:%s", self.host, self.port)
+        log.info("Servicio de mensajería escuchando notificaciones en %s:%s", self.host, self.port + 1)
+
+        await self.load_user_directory()
+        async with server, notifications:
+            await asyncio.gather(server.serve_forever(), notifications.serve_forever())
+
+    async def handle_notification(self, reader, writer):
+        try:
+            while True:
+                notification = await read_frame_async(reader)
+                if notification is None:
+                    break
+                if notification.get('action') == 'nuevo_usuario':
+                    username = notification.get('username')
+                    if username:
+                        log.info("Nuevo usuario registrado: %s", username)
+                        self.known_users.add(username)
+                        self.broadcast_new_user(username)
+                elif notification.get('action') in ('stats', 'log_config'):
+                    response = stats_response() if notification['action'] == 'stats' else log_config(notification)
+                    writer.write(encode_frame(response))
+                    await writer.drain()
+        except Exception as e:
+            log.warning("Error al manejar la notificación: %s", e)
+        finally:
+            writer.close()
+
+    def broadcast_new_user(self, username):
+        """Avisa del nuevo usuario a los clientes conectados (en lotes)."""
+        self.broadcaster.publish(username)
+
+    async def send(self, writer, text):
+        """Escritura directa, solo para antes de que el cliente tenga su cola."""
+        writer.write(text.encode())
+        await writer.drain()
+
+    def send_to(self, username, text, message=None, on_sent=None):
+        """Encola una línea para un cliente conectado; False si no está conectado o no se pudo encolar."""
+        client = self.connected_clients.get(username)
+        if client is None:
+            return False
+        return client.send(text, message, on_sent)
+
+    def queue_stats(self):
+        """Profundidad de las colas de salida y líneas descartadas o desviadas a almacenamiento."""
+        clients = list(self.connected_clients.values())
+        depths = [client.depth() for client in clients]
+        return {
+            "clients": len(clients),
+            "total_depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": sum(client.dropped for client in clients),
+            "spilled": sum(client.spilled for client in clients),
+        }
+
+    async def handle_client(self, reader, writer):
+        """
+        Maneja la comunicación con un cliente.
+        """
+        username = None
+        client = None
+        try:
+            username = await self.authenticate_client(reader, writer)
+            if not username:
+                await self.send(writer, AUTH_FAILED)
+                return
+
+            client = AsyncClientConnection(
+                username, writer,
+                max_queue=self.outbound_queue_size,
+                overflow_policy=self.overflow_policy,
+                on_spill=self.store_message,
+            )
+            self.connected_clients[username] = client
+
+            await self.send_pending_messages(username)
+
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # El comando superó MAX_LINE_LENGTH sin fin de línea
+                    client.send("Error: Comando demasiado largo\n")
+                    break
+                if not line:
+                    break
+                command, *args = line.decode().strip().split('|')
+                label = command_label(command)
+
+                with COMMAND_SECONDS.time(command=label), start_trace("mensajeria", label, user=username):
+                    if command == "SEND":
+                        await self.handle_send_message(username, args)
+                    elif command == "SEND_BATCH":
+                        await self.handle_send_batch(username, args)
+                    elif command == "GET_USERS":
+                        await self.handle_get_users(username)
+                    elif command == "GET_HISTORY":
+                        await self.handle_get_history(username, args)
+                    else:
+                        client.send("Comando no reconocido\n")
+        except Exception as e:
+            log.warning("Error con el usuario %s: %s", username, e)
+        finally:
+            if client is not None:
+                if self.connected_clients.get(username) is client:
+                    del self.connected_clients[username]
+                client.close()
+            else:
+                writer.close()
+
+    async def authenticate_client(self, reader, writer):
+        """
+        Autentica al cliente al momento de conectarse.
+        """
+        try:
+            await self.send(writer, AUTH_PROMPT)
+            line = await reader.readline()
+            if not line:
+                return None
+            command, *args = line.decode().strip().split('|')
+            if command != "AUTH" or len(args) != 1:
+                return None
+            with COMMAND_SECONDS.time(command="AUTH"), start_trace("mensajeria", "AUTH"):
+                return await self.resolve_credential(args[0])
+        except Exception as e:
+            log.warning("Error al autenticar al cliente: %s", e)
+            return None
+
+    async def resolve_credential(self, credential):
+        """Usuario al que corresponde el token (o el nombre, en modo heredado); None si no es válido."""
+        if self.session_key is not None:
+            username = verify_token(self.session_key, credential)
+            if username is not None:
+                return username
+        if self.legacy_auth and await self.validate_user(credential):
+            return credential
+        return None
+
+    async def handle_send_message(self, sender, args):
+        """
+        Maneja el comando SEND para enviar un mensaje.
+        Formato: SEND|<recipient>|<content>
+        """
+        if len(args) != 2:
+            self.send_to(sender, "Error: Formato incorrecto para SEND\n")
+            return
+
+        recipient, content = args
+
+        if await self.deliver_message(sender, recipient, content):
+            self.send_to(sender, "Mensaje procesado\n")
+        else:
+            self.send_to(sender, "Error: Usuario destinatario no válido\n")
+
+    async def handle_send_batch(self, sender, args):
+        """
+        Maneja el comando SEND_BATCH.
+        Formato: SEND_BATCH|<recipient1>|<content1>|<recipient2>|<content2>...
+        """
+        try:
+            messages = parse_send_batch(args)
+        except ValueError:
+            self.send_to(sender, "Error: Formato incorrecto para SEND_BATCH\n")
+            return
+
+        accepted = 0
+        for recipient, content in messages:
+            accepted += await self.deliver_message(sender, recipient, content)
+        self.send_to(sender, f"Mensajes procesados|{accepted}|{len(messages) - accepted}\n")
+
+    async def deliver_message(self, sender, recipient, content):
+        """Entrega o guarda un mensaje; False si el destinatario no es válido."""
+        if not await self.validate_user(recipient):
+            MESSAGES.inc(result="rejected")
+            return False
+        if self.send_to(recipient, f"{sender} dice: {content}\n", (sender, recipient, content)):
+            MESSAGES.inc(result="delivered")
+        elif recipient not in self.connected_clients:
+            MESSAGES.inc(result="stored")
+            await self.store_message(sender, recipient, content)
+        return True
+
+    async def handle_get_users(self, username):
+        """Envía la lista de usuarios al cliente."""
+        users = await self.get_all_users()
+        self.send_to(username, f"USER_LIST|{'|'.join(users)}\n")
+
+    async def handle_get_history(self, username, args):
+        """
+        Maneja la solicitud de obtener el historial de conversación.
+        Formato: GET_HISTORY|<usuario>[|<before_id>[|<limit>]]
+        """
+        try:
+            other_user, before_id, limit = parse_history_args(args)
+        except ValueError:
+            self.send_to(username, "Error: Formato incorrecto para GET_HISTORY\n")
+            return
+
+        messages = await self.get_conversation_history(username, other_user, before_id, limit + 1)
+        self.send_to(username, ''.join(format_history_page(other_user, messages, limit)))
+
+    async def send_pending_messages(self, username):
+        """
+        Envía los mensajes pendientes al usuario al momento de conectarse, en
+        bloques que se confirman una vez escritos (ver MessagingService).
+        """
+        after_id = 0
+        while True:
+            messages = await self.get_pending_messages(username, after_id)
+            if not messages:
+                break
+            after_id = messages[-1]['id']
+            ack = partial(self.ack_messages, username, after_id)
+            if not self.send_to(username, format_pending_messages(messages), on_sent=ack):
+                break
+            if len(messages) < PENDING_PAGE_SIZE:
+                break
+
+    async def load_user_directory(self):
+        """Carga el directorio local con los usuarios ya registrados."""
+        self.known_users.update(await self.get_all_users())
+
+    async def validate_user(self, username):
+        """
+        Valida al usuario con el directorio local y, si no aparece, con el
+        Servicio de Autenticación.
+        """
+        if username in self.known_users:
+            return True
+        try:
+            response = await self.auth_pool.request({
+                "action": "verificar_usuario",
+                "username": username
+            })
+        except Exception as e:
+            log.warning("Error al validar el usuario: %s", e)
+            return False
+        if response["status"] == "success":
+            self.known_users.add(username)
+            return True
+        return False
+
+    async def get_all_users(self):
+        """Obtiene la lista de todos los usuarios registrados."""
+        try:
+            response = await self.auth_pool.request({"action": "obtener_usuarios"})
+            return response["users"] if response["status"] == "success" else []
+        except Exception as e:
+            log.warning("Error al obtener la lista de usuarios: %s", e)
+            return []
+
+    async def get_conversation_history(self, user1, user2, before_id=None, limit=None):
+        """Solicita una página del historial de conversación al servicio de almacenamiento."""
+        try:
+            response = await self.storage_pool.request({
+                "action": "get_conversation_history",
+                "user1": user1,
+                "user2": user2,
+                "before_id": before_id,
+                "limit": limit
+            })
+            return response["messages"] if response["status"] == "success" else []
+        except Exception as e:
+            log.warning("Error al obtener el historial de conversación: %s", e)
+            return []
+
+    async def store_message(self, sender, recipient, content):
+        """
+        Envía un mensaje al Servicio de Almacenamiento para guardarlo.
+        """
+        try:
+            response = await self.storage_pool.request({
+                "action": "save_message",
+                "sender": sender,
+                "receiver": recipient,
+                "message": content
+            })
+            return response["status"] == "success"
+        except Exception as e:
+            log.warning("Error al guardar el mensaje: %s", e)
+            return False
+
+    async def get_pending_messages(self, recipient, after_id=0):
+        """
+        Solicita al Servicio de Almacenamiento un bloque de mensajes pendientes.
+        """
+        try:
+            response = await self.storage_pool.request({
+                "action": "get_pending_messages",
+                "receiver": recipient,
+                "after_id": after_id,
+                "limit": PENDING_PAGE_SIZE
+            })
+            return response["messages"] if response["status"] == "success" else []
+        except Exception as e:
+            log.warning("Error al recuperar los mensajes: %s", e)
+            return []
+
+    async def ack_messages(self, recipient, up_to_id):
+        """
+        Marca como entregados los pendientes de `recipient` hasta `up_to_id`.
+        """
+        try:
+            response = await self.storage_pool.request({
+                "action": "ack_messages",
+                "receiver": recipient,
+                "up_to_id": up_to_id
+            })
+            return response["status"] == "success"
+        except Exception as e:
+            log.warning("Error al confirmar la entrega de mensajes: %s", e)
+            return False
+
+if __name__ == "__main__":
+    AsyncMessagingService().start()
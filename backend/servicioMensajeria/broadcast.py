@@ -0,0 +1,83 @@
+import asyncio
+import queue
+import threading
+import time
+
+# Ventana durante la que se juntan registros antes de avisar a los clientes
+BROADCAST_WINDOW = 0.05
+# Usuarios como máximo por línea NEW_USER
+MAX_USERS_PER_LINE = 500
+
+def format_new_users(usernames):
+    """Arma las líneas NEW_USER|<u1>|<u2>... para un lote de usuarios nuevos."""
+    return ''.join(
+        f"NEW_USER|{'|'.join(usernames[i:i + MAX_USERS_PER_LINE])}\n"
+        for i in range(0, len(usernames), MAX_USERS_PER_LINE)
+    )
+
+def _unique(usernames):
+    return list(dict.fromkeys(usernames))
+
+class NewUserBroadcaster:
+    """
+    Difunde los registros nuevos a los clientes conectados.
+
+    Las notificaciones solo encolan el nombre; un hilo propio junta los que
+    lleguen dentro de `window` segundos y envía un único NEW_USER con todo el
+    lote a cada cliente. Una ola de N registros cuesta así unas pocas
+    escrituras por cliente en lugar de N.
+    """
+
+    def __init__(self, get_clients, window=BROADCAST_WINDOW):
+        self.get_clients = get_clients
+        self.window = window
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def publish(self, username):
+        self._queue.put(username)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._send(_unique(batch))
+
+    def _send(self, usernames):
+        text = format_new_users(usernames)
+        self.batches += 1
+        for client in list(self.get_clients()):
+            client.send(text)
+
+class AsyncNewUserBroadcaster:
+    """Equivalente de NewUserBroadcaster para el bucle de eventos de asyncio."""
+
+    def __init__(self, get_clients, window=BROADCAST_WINDOW):
+        self.get_clients = get_clients
+        self.window = window
+        self.batches = 0
+        self._pending = []
+        self._timer = None
+
+    def publish(self, username):
+        self._pending.append(username)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        self._timer = None
+        usernames, self._pending = _unique(self._pending), []
+        text = format_new_users(usernames)
+        self.batches += 1
+        for client in list(self.get_clients()):
+            client.send(text)
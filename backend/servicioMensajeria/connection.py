@@ -0,0 +1,272 @@
+import asyncio
+import queue
+import socket
+import threading
+from collections import deque
+
+# Qué hacer cuando la cola de salida de un cliente está llena
+OVERFLOW_DROP = "drop"              # descartar la línea nueva
+OVERFLOW_DISCONNECT = "disconnect"  # cerrar la conexión del cliente lento
+OVERFLOW_SPILL = "spill"            # guardar los mensajes de chat como pendientes
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_SPILL)
+
+OUTBOUND_QUEUE_SIZE = 1000
+# Líneas que el escritor junta como máximo en una sola escritura
+MAX_WRITE_BATCH = 256
+# Longitud máxima de un comando recibido de un cliente
+MAX_LINE_LENGTH = 64 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+_CLOSE = object()
+
+def _segments(items):
+    """
+    Parte un lote de la cola en escrituras que terminan en cada elemento con
+    `on_sent`: así el aviso se da antes de escribir lo que venga detrás.
+    """
+    segment = []
+    for item in items:
+        segment.append(item)
+        if item[2] is not None:
+            yield segment
+            segment = []
+    if segment:
+        yield segment
+
+class LineTooLong(ValueError):
+    pass
+
+class LineReader:
+    """
+    Lector incremental de comandos terminados en '\\n'.
+
+    Una lectura del socket puede traer varios comandos encadenados o solo
+    parte de uno; el resto queda en el buffer para la siguiente llamada.
+    `readline` devuelve None cuando el cliente cierra la conexión y lanza
+    LineTooLong si un comando supera `max_line` bytes sin terminar.
+    `initial` son bytes ya leídos del socket por otro (p. ej. el enrutador).
+    """
+
+    def __init__(self, sock, max_line=MAX_LINE_LENGTH, initial=b''):
+        self.sock = sock
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.lines = deque()
+        if initial:
+            self._feed(initial)
+
+    def readline(self):
+        while not self.lines:
+            data = self.sock.recv(READ_CHUNK_SIZE)
+            if not data:
+                return None
+            self._feed(data)
+        return self.lines.popleft()
+
+    def unread(self):
+        """Devuelve, sin consumirlos, los bytes recibidos que aún no se leyeron."""
+        return b''.join(line.encode() + b'\n' for line in self.lines) + bytes(self.buffer)
+
+    def _feed(self, data):
+        self.buffer += data
+        *complete, rest = self.buffer.split(b'\n')
+        if len(rest) > self.max_line or any(len(line) > self.max_line for line in complete):
+            raise LineTooLong(f"Comando de más de {self.max_line} bytes")
+        self.buffer = bytearray(rest)
+        # Se ignoran las líneas vacías, como un '\r\n' suelto
+        for line in complete:
+            line = line.decode().strip()
+            if line:
+                self.lines.append(line)
+
+class ClientConnection:
+    """
+    Conexión de un cliente autenticado con su propia cola de salida.
+
+    Todas las escrituras al socket las hace un único hilo escritor, así que un
+    destinatario lento no bloquea a quien le envía y las líneas de distintos
+    remitentes nunca se intercalan. Cada elemento de la cola es el texto a
+    enviar; si es un mensaje de chat, la tupla (remitente, destinatario,
+    contenido) que permite guardarlo como pendiente cuando no se puede
+    entregar, y opcionalmente `on_sent`, que el escritor llama cuando el texto
+    ya se escribió en el socket y antes de escribir lo que sigue en la cola.
+    """
+
+    def __init__(self, username, sock, max_queue=OUTBOUND_QUEUE_SIZE,
+                 overflow_policy=OVERFLOW_SPILL, on_spill=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de desborde desconocida: {overflow_policy}")
+        self.username = username
+        self.sock = sock
+        self.overflow_policy = overflow_policy
+        self.on_spill = on_spill
+        self.dropped = 0
+        self.spilled = 0
+        self.closed = False
+        self.queue = queue.Queue(max_queue)
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, text, message=None, on_sent=None):
+        """
+        Encola una línea para el cliente. Devuelve False si no se encoló
+        (cola llena o conexión cerrada); en ese caso ya se aplicó la política.
+        """
+        if not self.closed:
+            try:
+                self.queue.put_nowait((text.encode(), message, on_sent))
+                return True
+            except queue.Full:
+                if self.overflow_policy == OVERFLOW_DISCONNECT:
+                    self.close()
+        self._undeliverable(message)
+        return False
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        """Deja de aceptar líneas; el escritor envía lo ya encolado y cierra el socket."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put_nowait((_CLOSE, None, None))
+        except queue.Full:
+            # El escritor está atascado: cerrar el socket lo destraba
+            self._shutdown()
+
+    def _undeliverable(self, message):
+        if message is not None and self.overflow_policy == OVERFLOW_SPILL and self.on_spill:
+            self.spilled += 1
+            self.on_spill(*message)
+        else:
+            self.dropped += 1
+
+    def _write_loop(self):
+        failed = False
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = any(item[0] is _CLOSE for item in batch)
+            for segment in _segments(item for item in batch if item[0] is not _CLOSE):
+                if not failed:
+                    try:
+                        self.sock.sendall(b''.join(data for data, _, _ in segment))
+                    except OSError:
+                        failed = True
+                        self.closed = True
+                    else:
+                        on_sent = segment[-1][2]
+                        if on_sent is not None:
+                            on_sent()
+                        continue
+                for _, message, _ in segment:
+                    self._undeliverable(message)
+            if closing or failed:
+                break
+        # Lo que quede en la cola ya no se puede entregar
+        while True:
+            try:
+                data, message, _ = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if data is not _CLOSE:
+                self._undeliverable(message)
+        self._shutdown()
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class AsyncClientConnection:
+    """
+    Equivalente de ClientConnection para el servidor asyncio: la cola es una
+    asyncio.Queue y el escritor, una tarea que espera `drain()` sin bloquear a
+    los remitentes. Aquí `on_sent` es una corrutina.
+    """
+
+    def __init__(self, username, writer, max_queue=OUTBOUND_QUEUE_SIZE,
+                 overflow_policy=OVERFLOW_SPILL, on_spill=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de desborde desconocida: {overflow_policy}")
+        self.username = username
+        self.writer = writer
+        self.overflow_policy = overflow_policy
+        self.on_spill = on_spill
+        self.dropped = 0
+        self.spilled = 0
+        self.closed = False
+        self.queue = asyncio.Queue(max_queue)
+        self.task = asyncio.ensure_future(self._write_loop())
+
+    def send(self, text, message=None, on_sent=None):
+        if not self.closed:
+            try:
+                self.queue.put_nowait((text.encode(), message, on_sent))
+                return True
+            except asyncio.QueueFull:
+                if self.overflow_policy == OVERFLOW_DISCONNECT:
+                    self.close()
+        self._undeliverable(message)
+        return False
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put_nowait((_CLOSE, None, None))
+        except asyncio.QueueFull:
+            self.task.cancel()
+            self.writer.close()
+
+    def _undeliverable(self, message):
+        if message is not None and self.overflow_policy == OVERFLOW_SPILL and self.on_spill:
+            self.spilled += 1
+            asyncio.ensure_future(self.on_spill(*message))
+        else:
+            self.dropped += 1
+
+    async def _write_loop(self):
+        failed = False
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while len(batch) < MAX_WRITE_BATCH and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                closing = any(item[0] is _CLOSE for item in batch)
+                for segment in _segments(item for item in batch if item[0] is not _CLOSE):
+                    if not failed:
+                        try:
+                            self.writer.write(b''.join(data for data, _, _ in segment))
+                            await self.writer.drain()
+                        except (OSError, ConnectionError):
+                            failed = True
+                            self.closed = True
+                        else:
+                            on_sent = segment[-1][2]
+                            if on_sent is not None:
+                                await on_sent()
+                            continue
+                    for _, message, _ in segment:
+                        self._undeliverable(message)
+                if closing or failed:
+                    break
+        finally:
+            while not self.queue.empty():
+                data, message, _ = self.queue.get_nowait()
+                if data is not _CLOSE:
+                    self._undeliverable(message)
+            self.writer.close()
@@ -1,13 +1,113 @@
+import logging
 import socket
 import threading
-import json
+from functools import partial
+
+from comun.log import configure_logging, log_config, log_request
+from comun.metrics import REGISTRY, serve_metrics, stats_response
+from comun.pool import ConnectionPool
+from comun.protocol import MessageStream
+from comun.server import ThreadPoolServer
+from comun.tokens import verify_token
+from comun.tracing import start_trace
+from .broadcast import NewUserBroadcaster
+from .connection import OUTBOUND_QUEUE_SIZE, OVERFLOW_SPILL, ClientConnection, LineReader, LineTooLong
+
+log = logging.getLogger(__name__)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+AUTH_PROMPT = "Por favor, autentíquese. Formato: AUTH|<token>\n"
+AUTH_FAILED = "Error: Autenticación fallida\n"
+SATURATED = "Error: Servidor saturado, intente más tarde\n"
+# Clientes atendidos a la vez (cada uno ocupa un hilo mientras está conectado)
+# y conexiones que pueden esperar a que se libere uno
+MAX_CLIENTS = 1024
+MAX_PENDING_CLIENTS = 128
+NOTIFICATION_WORKERS = 4
+# Mensajes pendientes que se piden al almacenamiento y se escriben por bloque
+PENDING_PAGE_SIZE = 500
+
+COMMANDS = frozenset({"AUTH", "SEND", "SEND_BATCH", "GET_USERS", "GET_HISTORY"})
+COMMAND_SECONDS = REGISTRY.histogram("messaging_command_seconds", "Latencia de los comandos de los clientes", ("command",))
+MESSAGES = REGISTRY.counter("messaging_messages_total", "Mensajes según se entregaron, guardaron o rechazaron", ("result",))
+CONNECTED_CLIENTS = REGISTRY.gauge("messaging_connected_clients", "Clientes autenticados conectados")
+QUEUE_DEPTH = REGISTRY.gauge("messaging_outbound_queue_depth", "Líneas en las colas de salida", ("stat",))
+QUEUE_OVERFLOW = REGISTRY.gauge(
+    "messaging_outbound_overflow_lines", "Líneas descartadas o guardadas por desborde, de los clientes conectados", ("policy",)
+)
+
+def command_label(command):
+    """Etiqueta de la métrica de un comando; los desconocidos se agrupan en "otro"."""
+    return command if command in COMMANDS else "otro"
+
+def track_service(service):
+    """Exporta los clientes conectados y el estado de sus colas de salida."""
+    CONNECTED_CLIENTS.set_function(lambda: len(service.connected_clients))
+    QUEUE_DEPTH.set_function(lambda: service.queue_stats()["total_depth"], stat="total")
+    QUEUE_DEPTH.set_function(lambda: service.queue_stats()["max_depth"], stat="max")
+    QUEUE_OVERFLOW.set_function(lambda: service.queue_stats()["dropped"], policy="drop")
+    QUEUE_OVERFLOW.set_function(lambda: service.queue_stats()["spilled"], policy="spill")
+
+def parse_history_args(args):
+    """Devuelve (usuario, before_id, limit) de un GET_HISTORY; ValueError si el formato es incorrecto."""
+    if not 1 <= len(args) <= 3:
+        raise ValueError("Formato incorrecto para GET_HISTORY")
+    other_user = args[0]
+    before_id = int(args[1]) if len(args) > 1 and args[1] else None
+    limit = int(args[2]) if len(args) > 2 and args[2] else HISTORY_PAGE_SIZE
+    if limit <= 0:
+        raise ValueError("Formato incorrecto para GET_HISTORY")
+    return other_user, before_id, min(limit, HISTORY_MAX_PAGE_SIZE)
+
+def format_history_page(other_user, messages, limit):
+    """
+    Arma la respuesta a GET_HISTORY a partir de hasta `limit + 1` mensajes:
+    líneas HISTORY|<id>|<remitente>|<mensaje> en orden cronológico, seguidas de
+    HISTORY_END|<usuario>|<id más antiguo>|<1 si hay más>.
+    """
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:]
+    oldest_id = messages[0]['id'] if messages else ''
+    lines = [f"HISTORY|{msg['id']}|{msg['sender']}|{msg['message']}\n" for msg in messages]
+    lines.append(f"HISTORY_END|{other_user}|{oldest_id}|{int(has_more)}\n")
+    return lines
+
+def format_pending_messages(messages):
+    return ''.join(f"{message['sender']} dice: {message['message']}\n" for message in messages)
+
+def reject_client(conn):
+    conn.sendall(SATURATED.encode())
+
+def parse_send_batch(args):
+    """Devuelve los pares (destinatario, contenido) de un SEND_BATCH; ValueError si el formato es incorrecto."""
+    if not args or len(args) % 2:
+        raise ValueError("Formato incorrecto para SEND_BATCH")
+    return list(zip(args[::2], args[1::2]))
 
 class MessagingService:
     def __init__(self, host="127.0.0.1", port=5001,
                  auth_host="127.0.0.1", auth_port=7000,
-                 storage_host="127.0.0.1", storage_port=8000):
+                 storage_host="127.0.0.1", storage_port=8000,
+                 outbound_queue_size=OUTBOUND_QUEUE_SIZE, overflow_policy=OVERFLOW_SPILL,
+                 max_clients=MAX_CLIENTS, max_pending_clients=MAX_PENDING_CLIENTS,
+                 session_key=None, legacy_auth=None, stats_port=None):
         """
         Inicializa el servicio de mensajería con integración al Servicio de Autenticación y Almacenamiento.
+
+        Cada cliente conectado tiene una cola de salida de `outbound_queue_size`
+        líneas; `overflow_policy` ("drop", "disconnect" o "spill") decide qué
+        hacer cuando se llena. Se atienden hasta `max_clients` clientes a la
+        vez; con `max_pending_clients` más esperando, los nuevos se rechazan.
+
+        Con `session_key`, AUTH|<token> se verifica localmente con la firma de
+        los tokens que emite el servicio de autenticación. El formato viejo
+        AUTH|<username>, que no prueba la identidad del cliente, solo se
+        acepta con `legacy_auth` (por omisión, solo si no hay clave).
+
+        Las métricas se consultan con la acción `stats` en el puerto de
+        notificaciones y, con `stats_port`, por HTTP en ese puerto.
         """
         self.host = host
         self.port = port
@@ -15,8 +115,21 @@ class MessagingService:
         self.auth_port = auth_port
         self.storage_host = storage_host
         self.storage_port = storage_port
+        self.auth_pool = ConnectionPool(auth_host, auth_port)
+        self.storage_pool = ConnectionPool(storage_host, storage_port)
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow_policy = overflow_policy
+        self.max_clients = max_clients
+        self.max_pending_clients = max_pending_clients
+        self.session_key = session_key
+        self.legacy_auth = session_key is None if legacy_auth is None else legacy_auth
+        self.stats_port = stats_port
         self.connected_clients = {}
-        self.user_list = []
+        # Directorio local de usuarios registrados: evita consultar al servicio
+        # de autenticación por cada mensaje. Se carga al iniciar y se mantiene
+        # con las notificaciones de nuevo_usuario.
+        self.known_users = set()
+        self.known_users_lock = threading.Lock()
 
     def start(self):
         """
@@ -25,15 +138,37 @@ class MessagingService:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"Servicio de mensajería corriendo en {self.host}:{self.port}")
+        self.server_socket.listen(self.max_pending_clients)
+        log.info("Servicio de mensajería corriendo en %s:%s", self.host, self.port)
 
+        self.start_background()
         threading.Thread(target=self.listen_for_notifications, daemon=True).start()
+        self.load_user_directory()
 
         while True:
             client_socket, client_address = self.server_socket.accept()
-            print(f"Conexión establecida con {client_address}")
-            threading.Thread(target=self.handle_client, args=(client_socket,)).start()
+            log_request(log, "Conexión establecida con %s", client_address)
+            self.client_pool.submit(client_socket)
+
+    def start_background(self):
+        """
+        Crea los componentes con hilos propios. Se hace al iniciar y no en
+        __init__ porque el servicio suele construirse antes de lanzar su
+        proceso, y los hilos no sobreviven al fork.
+        """
+        configure_logging("mensajeria")
+        self.broadcaster = NewUserBroadcaster(lambda: self.connected_clients.values())
+        # Los clientes de chat pasan largos ratos sin escribir: sin tiempo de inactividad
+        self.client_pool = ThreadPoolServer(
+            self.handle_client, max_workers=self.max_clients, max_pending=self.max_pending_clients,
+            idle_timeout=None, reject=reject_client, name="mensajeria",
+        )
+        self.notification_pool = ThreadPoolServer(
+            self.handle_notification, max_workers=NOTIFICATION_WORKERS, reject=None, name="notificaciones",
+        )
+        track_service(self)
+        if self.stats_port:
+            serve_metrics(self.stats_port, self.host)
 
     def listen_for_notifications(self):
         """Escucha notificaciones del servicio de autenticación."""
@@ -41,219 +176,304 @@ class MessagingService:
         notification_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         notification_socket.bind((self.host, self.port + 1))  # Puerto 5002
         notification_socket.listen(5)
-        print(f"Servicio de mensajería escuchando notificaciones en {self.host}:{self.port + 1}")
+        log.info("Servicio de mensajería escuchando notificaciones en %s:%s", self.host, self.port + 1)
 
-        while True:
-            conn, _ = notification_socket.accept()
-            threading.Thread(target=self.handle_notification, args=(conn,)).start()
+        self.notification_pool.serve(notification_socket)
 
-    def handle_notification(self, conn):
+    def handle_notification(self, conn, addr=None):
         try:
-            data = conn.recv(1024).decode('utf-8')
-            if not data:
-                return
-            notification = json.loads(data)
-            action = notification.get('action')
-            if action == 'nuevo_usuario':
-                username = notification.get('username')
-                if username:
-                    print(f"Nuevo usuario registrado: {username}")
-                    # Notificar a los clientes conectados
-                    self.broadcast_new_user(username)
+            stream = MessageStream(conn)
+            for notification in stream:
+                action = notification.get('action')
+                if action == 'nuevo_usuario':
+                    username = notification.get('username')
+                    if username:
+                        log.info("Nuevo usuario registrado: %s", username)
+                        self.add_known_user(username)
+                        # Notificar a los clientes conectados
+                        self.broadcast_new_user(username)
+                elif action == 'stats':
+                    stream.send(stats_response())
+                elif action == 'log_config':
+                    stream.send(log_config(notification))
         except Exception as e:
-            print(f"Error al manejar la notificación: {e}")
+            log.warning("Error al manejar la notificación: %s", e)
         finally:
             conn.close()
 
     def broadcast_new_user(self, username):
-        """Envía la lista actualizada de usuarios a los clientes conectados."""
-        for client_username, client_socket in self.connected_clients.items():
-            try:
-                client_socket.sendall(f"NEW_USER|{username}\n".encode())
-            except Exception as e:
-                print(f"Error al enviar nueva lista de usuarios a {client_username}: {e}")
+        """Avisa del nuevo usuario a los clientes conectados (en lotes, fuera de este hilo)."""
+        self.broadcaster.publish(username)
 
     def handle_get_users(self, username):
         """Envía la lista de usuarios al cliente."""
         users = self.get_all_users()
-        client_socket = self.connected_clients.get(username)
-        if client_socket:
-            client_socket.sendall(f"USER_LIST|{'|'.join(users)}\n".encode())
+        self.send_to(username, f"USER_LIST|{'|'.join(users)}\n")
+
+    def send_to(self, username, text, message=None, on_sent=None):
+        """Encola una línea para un cliente conectado; False si no está conectado o no se pudo encolar."""
+        client = self.connected_clients.get(username)
+        if client is None:
+            return False
+        return client.send(text, message, on_sent)
+
+    def queue_stats(self):
+        """Profundidad de las colas de salida y líneas descartadas o desviadas a almacenamiento."""
+        clients = list(self.connected_clients.values())
+        depths = [client.depth() for client in clients]
+        return {
+            "clients": len(clients),
+            "total_depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "dropped": sum(client.dropped for client in clients),
+            "spilled": sum(client.spilled for client in clients),
+        }
 
     def get_all_users(self):
         """Obtiene la lista de todos los usuarios registrados."""
         # Obtener usuarios del servicio de autenticación
         try:
-            with socket.create_connection((self.auth_host, self.auth_port)) as auth_socket:
-                auth_socket.sendall(json.dumps({
-                    "action": "obtener_usuarios"
-                }).encode())
-                response = json.loads(auth_socket.recv(4096).decode())
-                if response["status"] == "success":
-                    return response["users"]
-                else:
-                    return []
+            response = self.auth_pool.request({
+                "action": "obtener_usuarios"
+            })
+            if response["status"] == "success":
+                return response["users"]
+            else:
+                return []
         except Exception as e:
-            print(f"Error al obtener la lista de usuarios: {e}")
+            log.warning("Error al obtener la lista de usuarios: %s", e)
             return []
 
-    def handle_client(self, client_socket):
+    def handle_client(self, client_socket, reader=None):
         """
-        Maneja la comunicación con un cliente.
+        Maneja la comunicación con un cliente. Si se recibe `reader`, el
+        cliente ya fue saludado (por el enrutador de shards) y su AUTH está en
+        el buffer del lector.
         """
         username = None
+        client = None
+        greeted = reader is not None
+        if reader is None:
+            reader = LineReader(client_socket)
         try:
-            username = self.authenticate_client(client_socket)
+            username = self.authenticate_client(client_socket, reader, greeted)
             if not username:
-                client_socket.send("Error: Autenticación fallida\n".encode())
+                client_socket.send(AUTH_FAILED.encode())
                 client_socket.close()
                 return
 
-            self.connected_clients[username] = client_socket
+            client = ClientConnection(
+                username, client_socket,
+                max_queue=self.outbound_queue_size,
+                overflow_policy=self.overflow_policy,
+                on_spill=self.store_message,
+            )
+            self.connected_clients[username] = client
 
             self.send_pending_messages(username)
 
             while True:
-                data = client_socket.recv(1024).decode()
-                if not data:
+                line = reader.readline()
+                if line is None:
                     break
-                command, *args = data.strip().split('|')
-
-                if command == "SEND":
-                    self.handle_send_message(username, args)
-                elif command == "GET_USERS":
-                    self.handle_get_users(username)
-                elif command == "GET_HISTORY":
-                    self.handle_get_history(username, args)
-                else:
-                    client_socket.send("Comando no reconocido\n".encode())
+                command, *args = line.split('|')
+                label = command_label(command)
+
+                # Cada comando es una traza: los pools llevan su contexto a
+                # autenticación y almacenamiento
+                with COMMAND_SECONDS.time(command=label), start_trace("mensajeria", label, user=username):
+                    if command == "SEND":
+                        self.handle_send_message(username, args)
+                    elif command == "SEND_BATCH":
+                        self.handle_send_batch(username, args)
+                    elif command == "GET_USERS":
+                        self.handle_get_users(username)
+                    elif command == "GET_HISTORY":
+                        self.handle_get_history(username, args)
+                    else:
+                        client.send("Comando no reconocido\n")
+        except LineTooLong:
+            client.send("Error: Comando demasiado largo\n")
         except Exception as e:
-            print(f"Error con el usuario {username}: {e}")
+            log.warning("Error con el usuario %s: %s", username, e)
         finally:
-            if username:
-                del self.connected_clients[username]
-            client_socket.close()
+            if client is not None:
+                if self.connected_clients.get(username) is client:
+                    del self.connected_clients[username]
+                # El escritor envía lo que quede en la cola y cierra el socket
+                client.close()
+            else:
+                client_socket.close()
 
     def handle_get_history(self, username, args):
-        """Maneja la solicitud de obtener el historial de conversación."""
-        if len(args) != 1:
-            client_socket = self.connected_clients.get(username)
-            if client_socket:
-                client_socket.send("Error: Formato incorrecto para GET_HISTORY\n".encode())
+        """
+        Maneja la solicitud de obtener el historial de conversación.
+        Formato: GET_HISTORY|<usuario>[|<before_id>[|<limit>]]
+        """
+        try:
+            other_user, before_id, limit = parse_history_args(args)
+        except ValueError:
+            self.send_to(username, "Error: Formato incorrecto para GET_HISTORY\n")
             return
 
-        other_user = args[0]
+        # Se pide un mensaje de más para saber si quedan páginas anteriores;
+        # la página completa se encola como una sola escritura.
+        messages = self.get_conversation_history(username, other_user, before_id, limit + 1)
+        self.send_to(username, ''.join(format_history_page(other_user, messages, limit)))
 
-        messages = self.get_conversation_history(username, other_user)
-        client_socket = self.connected_clients.get(username)
-        if client_socket:
-            for msg in messages:
-                formatted_message = f"HISTORY|{msg['sender']}|{msg['message']}\n"
-                client_socket.send(formatted_message.encode())
-
-    def get_conversation_history(self, user1, user2):
-        """Solicita el historial de conversación al servicio de almacenamiento."""
+    def get_conversation_history(self, user1, user2, before_id=None, limit=None):
+        """Solicita una página del historial de conversación al servicio de almacenamiento."""
         try:
-            with socket.create_connection((self.storage_host, self.storage_port)) as storage_socket:
-                storage_socket.sendall(json.dumps({
-                    "action": "get_conversation_history",
-                    "user1": user1,
-                    "user2": user2
-                }).encode())
-                response = json.loads(storage_socket.recv(4096).decode())
-                if response["status"] == "success":
-                    return response["messages"]
-                else:
-                    return []
+            response = self.storage_pool.request({
+                "action": "get_conversation_history",
+                "user1": user1,
+                "user2": user2,
+                "before_id": before_id,
+                "limit": limit
+            })
+            if response["status"] == "success":
+                return response["messages"]
+            else:
+                return []
         except Exception as e:
-            print(f"Error al obtener el historial de conversación: {e}")
+            log.warning("Error al obtener el historial de conversación: %s", e)
             return []
 
-    def authenticate_client(self, client_socket):
+    def authenticate_client(self, client_socket, reader, greeted=False):
         """
-        Autentica al cliente al momento de conectarse.
+        Autentica al cliente al momento de conectarse. Lo que el cliente haya
+        enviado detrás del AUTH queda en `reader` para el bucle principal.
         """
         try:
-            client_socket.send("Por favor, autentíquese. Formato: AUTH|<username>\n".encode())
-            data = client_socket.recv(1024).decode()
-            if not data:
+            if not greeted:
+                client_socket.send(AUTH_PROMPT.encode())
+            line = reader.readline()
+            if not line:
                 return None
-            command, *args = data.strip().split('|')
+            command, *args = line.split('|')
             if command != "AUTH" or len(args) != 1:
                 return None
-            username = args[0]
-
-            if self.validate_user(username):
-                return username
-            else:
-                return None
+            with COMMAND_SECONDS.time(command="AUTH"), start_trace("mensajeria", "AUTH"):
+                return self.resolve_credential(args[0])
         except Exception as e:
-            print(f"Error al autenticar al cliente: {e}")
+            log.warning("Error al autenticar al cliente: %s", e)
             return None
 
+    def resolve_credential(self, credential):
+        """Usuario al que corresponde el token (o el nombre, en modo heredado); None si no es válido."""
+        if self.session_key is not None:
+            username = verify_token(self.session_key, credential)
+            if username is not None:
+                return username
+        if self.legacy_auth and self.validate_user(credential):
+            return credential
+        return None
+
     def handle_send_message(self, sender, args):
         """
         Maneja el comando SEND para enviar un mensaje.
         Formato: SEND|<recipient>|<content>
         """
         if len(args) != 2:
-            sender_socket = self.connected_clients.get(sender)
-            if sender_socket:
-                sender_socket.send("Error: Formato incorrecto para SEND\n".encode())
+            self.send_to(sender, "Error: Formato incorrecto para SEND\n")
             return
 
         recipient, content = args
 
-        if not self.validate_user(recipient):
-            sender_socket = self.connected_clients.get(sender)
-            if sender_socket:
-                sender_socket.send("Error: Usuario destinatario no válido\n".encode())
+        if self.deliver_message(sender, recipient, content):
+            self.send_to(sender, "Mensaje procesado\n")
+        else:
+            self.send_to(sender, "Error: Usuario destinatario no válido\n")
+
+    def handle_send_batch(self, sender, args):
+        """
+        Maneja el comando SEND_BATCH para enviar varios mensajes con una sola
+        confirmación.
+        Formato: SEND_BATCH|<recipient1>|<content1>|<recipient2>|<content2>...
+        Respuesta: Mensajes procesados|<entregados o guardados>|<rechazados>
+        """
+        try:
+            messages = parse_send_batch(args)
+        except ValueError:
+            self.send_to(sender, "Error: Formato incorrecto para SEND_BATCH\n")
             return
 
-        if recipient in self.connected_clients:
-            recipient_socket = self.connected_clients[recipient]
-            try:
-                message = f"{sender} dice: {content}\n"
-                recipient_socket.send(message.encode())
-                print(f"Mensaje enviado a {recipient}")
-            except Exception as e:
-                print(f"Error al enviar mensaje a {recipient}: {e}")
-                self.store_message(sender, recipient, content)
-        else:
-            self.store_message(sender, recipient, content)
+        accepted = sum(self.deliver_message(sender, recipient, content)
+                       for recipient, content in messages)
+        self.send_to(sender, f"Mensajes procesados|{accepted}|{len(messages) - accepted}\n")
 
-        sender_socket = self.connected_clients.get(sender)
-        if sender_socket:
-            sender_socket.send("Mensaje procesado\n".encode())
+    def deliver_message(self, sender, recipient, content):
+        """Entrega o guarda un mensaje; False si el destinatario no es válido."""
+        if not self.validate_user(recipient):
+            MESSAGES.inc(result="rejected")
+            return False
+
+        # La entrega solo encola en la conexión del destinatario: si está lento o
+        # se desconecta, su cola aplica la política de desborde (por defecto,
+        # guardar el mensaje como pendiente).
+        if self.send_to(recipient, f"{sender} dice: {content}\n", (sender, recipient, content)):
+            MESSAGES.inc(result="delivered")
+            log_request(log, "Mensaje enviado a %s", recipient, sender=sender)
+        elif recipient not in self.connected_clients:
+            MESSAGES.inc(result="stored")
+            self.store_message(sender, recipient, content)
+        return True
 
     def send_pending_messages(self, username):
         """
         Envía los mensajes pendientes al usuario al momento de conectarse.
+
+        Se piden al almacenamiento en bloques de PENDING_PAGE_SIZE y cada
+        bloque se encola como una sola escritura. El bloque se confirma (ack
+        hasta su último id) recién cuando el escritor lo escribió en el
+        socket: si la conexión cae antes, esos mensajes siguen pendientes.
         """
-        messages = self.get_messages(username)
-        if messages:
-            client_socket = self.connected_clients.get(username)
-            if client_socket:
-                for message in messages:
-                    response = f"{message['sender']} dice: {message['message']}\n"
-                    client_socket.send(response.encode())
-        else:
-            pass
+        after_id = 0
+        while True:
+            messages = self.get_pending_messages(username, after_id)
+            if not messages:
+                break
+            after_id = messages[-1]['id']
+            ack = partial(self.ack_messages, username, after_id)
+            if not self.send_to(username, format_pending_messages(messages), on_sent=ack):
+                break
+            if len(messages) < PENDING_PAGE_SIZE:
+                break
+
+    def load_user_directory(self):
+        """Carga el directorio local con los usuarios ya registrados."""
+        users = self.get_all_users()
+        with self.known_users_lock:
+            self.known_users.update(users)
+
+    def add_known_user(self, username):
+        with self.known_users_lock:
+            self.known_users.add(username)
 
     def validate_user(self, username):
+        """
+        Valida al usuario con el directorio local y, si no aparece (por ejemplo,
+        si se perdió una notificación), con el Servicio de Autenticación.
+        """
+        if username in self.known_users:
+            return True
+        if self.validate_user_remote(username):
+            self.add_known_user(username)
+            return True
+        return False
+
+    def validate_user_remote(self, username):
         """
         Valida al usuario con el Servicio de Autenticación.
         """
         try:
-            with socket.create_connection((self.auth_host, self.auth_port)) as auth_socket:
-                auth_socket.sendall(json.dumps({
-                    "action": "verificar_usuario",
-                    "username": username
-                }).encode())
-                response = json.loads(auth_socket.recv(1024).decode())
-                return response["status"] == "success"
+            response = self.auth_pool.request({
+                "action": "verificar_usuario",
+                "username": username
+            })
+            return response["status"] == "success"
         except Exception as e:
-            print(f"Error al validar el usuario: {e}")
+            log.warning("Error al validar el usuario: %s", e)
             return False
 
     def store_message(self, sender, recipient, content):
@@ -261,38 +481,51 @@ class MessagingService:
         Envía un mensaje al Servicio de Almacenamiento para guardarlo.
         """
         try:
-            with socket.create_connection((self.storage_host, self.storage_port)) as storage_socket:
-                storage_socket.sendall(json.dumps({
-                    "action": "save_message",
-                    "sender": sender,
-                    "receiver": recipient,
-                    "message": content
-                }).encode())
-                response = json.loads(storage_socket.recv(1024).decode())
-                return response["status"] == "success"
+            response = self.storage_pool.request({
+                "action": "save_message",
+                "sender": sender,
+                "receiver": recipient,
+                "message": content
+            })
+            return response["status"] == "success"
         except Exception as e:
-            print(f"Error al guardar el mensaje: {e}")
+            log.warning("Error al guardar el mensaje: %s", e)
             return False
 
-    def get_messages(self, recipient):
+    def get_pending_messages(self, recipient, after_id=0):
         """
-        Solicita los mensajes pendientes al Servicio de Almacenamiento.
+        Solicita al Servicio de Almacenamiento un bloque de mensajes pendientes.
         """
         try:
-            with socket.create_connection((self.storage_host, self.storage_port)) as storage_socket:
-                storage_socket.sendall(json.dumps({
-                    "action": "get_messages",
-                    "receiver": recipient
-                }).encode())
-                response = json.loads(storage_socket.recv(4096).decode())
-                if response["status"] == "success":
-                    return response["messages"]
-                else:
-                    return []
+            response = self.storage_pool.request({
+                "action": "get_pending_messages",
+                "receiver": recipient,
+                "after_id": after_id,
+                "limit": PENDING_PAGE_SIZE
+            })
+            if response["status"] == "success":
+                return response["messages"]
+            else:
+                return []
         except Exception as e:
-            print(f"Error al recuperar los mensajes: {e}")
+            log.warning("Error al recuperar los mensajes: %s", e)
             return []
 
+    def ack_messages(self, recipient, up_to_id):
+        """
+        Marca como entregados los pendientes de `recipient` hasta `up_to_id`.
+        """
+        try:
+            response = self.storage_pool.request({
+                "action": "ack_messages",
+                "receiver": recipient,
+                "up_to_id": up_to_id
+            })
+            return response["status"] == "success"
+        except Exception as e:
+            log.warning("Error al confirmar la entrega de mensajes: %s", e)
+            return False
+
 
 if __name__ == "__main__":
     service = MessagingService(port=5001,
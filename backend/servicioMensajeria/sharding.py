@@ -0,0 +1,272 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+
+from comun.log import configure_logging, log_config
+from comun.metrics import serve_metrics, stats_response
+from comun.pool import ConnectionPool
+from comun.protocol import MessageStream
+from comun.server import ThreadPoolServer, workers_for_peers
+from comun.tokens import verify_token
+from comun.tracing import continue_trace
+from .connection import LineReader, READ_CHUNK_SIZE, MAX_LINE_LENGTH
+from .main import (
+    AUTH_FAILED, AUTH_PROMPT, MAX_PENDING_CLIENTS, NOTIFICATION_WORKERS,
+    MessagingService, reject_client
+)
+
+log = logging.getLogger(__name__)
+
+# Puntos por shard en el anillo: más puntos reparten mejor a los usuarios
+VIRTUAL_NODES = 64
+LISTEN_BACKLOG = 1024
+# El AUTH más lo que el cliente haya encadenado detrás cabe en un paquete
+HANDOFF_MAX_SIZE = MAX_LINE_LENGTH + READ_CHUNK_SIZE
+# El router solo espera el AUTH: hilos pocos y ocupados por poco tiempo
+ROUTER_WORKERS = 32
+AUTH_TIMEOUT = 30.0
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+def handoff_path(socket_dir, shard):
+    return os.path.join(socket_dir, f"mensajeria-{shard}.handoff")
+
+def bus_path(socket_dir, shard):
+    return os.path.join(socket_dir, f"mensajeria-{shard}.bus")
+
+def _bind_unix(path, kind=socket.SOCK_STREAM):
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, kind)
+    sock.bind(path)
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+class HashRing:
+    """
+    Hashing consistente de usuarios a shards. Al cambiar la cantidad de
+    shards solo se mueve la parte de los usuarios que le toca al shard nuevo
+    (o al que se quita), no todos.
+    """
+
+    def __init__(self, shards, virtual_nodes=VIRTUAL_NODES):
+        self.shards = shards
+        points = sorted(
+            (_hash(f"{shard}#{i}"), shard) for shard in range(shards) for i in range(virtual_nodes)
+        )
+        self._keys = [key for key, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, username):
+        index = bisect.bisect(self._keys, _hash(username)) % len(self._keys)
+        return self._owners[index]
+
+class MessagingRouter:
+    """
+    Punto de entrada público del servicio de mensajería con shards.
+
+    Saluda al cliente, lee su AUTH y pasa el descriptor del socket (con lo
+    ya leído) al proceso del shard dueño del usuario mediante SCM_RIGHTS.
+    Desde ahí el router no vuelve a tocar esa conexión. También recibe las
+    notificaciones del servicio de autenticación y las reenvía a todos los
+    shards por su bus.
+    """
+
+    def __init__(self, host="127.0.0.1", port=5001, shards=2, socket_dir=".",
+                 max_pending_clients=MAX_PENDING_CLIENTS, session_key=None, stats_port=None):
+        self.host = host
+        self.port = port
+        self.shards = shards
+        self.socket_dir = socket_dir
+        self.max_pending_clients = max_pending_clients
+        self.session_key = session_key
+        self.stats_port = stats_port
+        self.ring = HashRing(shards)
+        self.handoff = {}
+        self.handoff_locks = {shard: threading.Lock() for shard in range(shards)}
+        self.bus = {shard: ConnectionPool(bus_path(socket_dir, shard), None) for shard in range(shards)}
+
+    def start(self):
+        configure_logging("mensajeria-enrutador")
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(LISTEN_BACKLOG)
+        log.info("Enrutador de mensajería (%s shards) corriendo en %s:%s", self.shards, self.host, self.port)
+
+        threading.Thread(target=self.listen_for_notifications, daemon=True).start()
+        if self.stats_port:
+            serve_metrics(self.stats_port, self.host)
+
+        pool = ThreadPoolServer(
+            self.handle_client, max_workers=ROUTER_WORKERS, max_pending=self.max_pending_clients,
+            idle_timeout=AUTH_TIMEOUT, reject=reject_client, name="enrutador",
+        )
+        pool.serve(server_socket)
+
+    def handle_client(self, client_socket, client_address=None):
+        try:
+            client_socket.sendall(AUTH_PROMPT.encode())
+            reader = LineReader(client_socket)
+            line = reader.readline() or ""
+            command, *args = line.split('|')
+            if command != "AUTH" or len(args) != 1:
+                client_socket.sendall(AUTH_FAILED.encode())
+                return
+            # El shard vuelve a verificar la credencial; aquí solo se elige el shard
+            username = verify_token(self.session_key, args[0]) if self.session_key is not None else None
+            shard = self.ring.shard_for(username or args[0])
+            self.hand_off(shard, client_socket, f"{line}\n".encode() + reader.unread())
+        except Exception as e:
+            log.warning("Error al enrutar al cliente: %s", e)
+        finally:
+            # El shard tiene su propia copia del descriptor
+            client_socket.close()
+
+    def hand_off(self, shard, client_socket, payload):
+        """Envía el socket del cliente al shard; reintenta una vez si el canal se cayó."""
+        with self.handoff_locks[shard]:
+            for attempt in range(2):
+                conn = self.handoff.get(shard)
+                try:
+                    if conn is None:
+                        conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                        conn.connect(handoff_path(self.socket_dir, shard))
+                        self.handoff[shard] = conn
+                    socket.send_fds(conn, [payload], [client_socket.fileno()])
+                    return
+                except OSError:
+                    self.handoff.pop(shard, None)
+                    if conn is not None:
+                        conn.close()
+                    if attempt:
+                        raise
+
+    def listen_for_notifications(self):
+        notification_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        notification_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        notification_socket.bind((self.host, self.port + 1))
+        notification_socket.listen(5)
+        pool = ThreadPoolServer(
+            self.handle_notification, max_workers=NOTIFICATION_WORKERS, reject=None, name="notificaciones",
+        )
+        pool.serve(notification_socket)
+
+    def handle_notification(self, conn, addr=None):
+        try:
+            stream = MessageStream(conn)
+            for notification in stream:
+                if notification.get('action') == 'stats':
+                    # Las del enrutador; cada shard responde `stats` en su bus
+                    stream.send(stats_response())
+                    continue
+                for shard, pool in self.bus.items():
+                    try:
+                        pool.request(notification)
+                    except Exception as e:
+                        log.warning("Error al reenviar la notificación al shard %s: %s", shard, e)
+                if notification.get('action') == 'log_config':
+                    # Los shards ya la aplicaron; el enrutador también
+                    stream.send(log_config(notification))
+        except Exception as e:
+            log.warning("Error al manejar la notificación: %s", e)
+        finally:
+            conn.close()
+
+class ShardedMessagingService(MessagingService):
+    """
+    Un shard del servicio de mensajería. Atiende solo a los usuarios que el
+    anillo le asigna; recibe sus conexiones ya aceptadas desde el router y
+    entrega a los usuarios de otros shards a través del bus del shard dueño,
+    que los entrega si están conectados o los guarda como pendientes.
+    """
+
+    def __init__(self, shard, shards, socket_dir=".", **kwargs):
+        super().__init__(**kwargs)
+        self.shard = shard
+        self.ring = HashRing(shards)
+        self.socket_dir = socket_dir
+        self.bus = {
+            other: ConnectionPool(bus_path(socket_dir, other), None)
+            for other in range(shards) if other != shard
+        }
+
+    def start(self):
+        self.start_background()
+        bus_socket = _bind_unix(bus_path(self.socket_dir, self.shard))
+        handoff_socket = _bind_unix(handoff_path(self.socket_dir, self.shard), socket.SOCK_SEQPACKET)
+        threading.Thread(target=self.serve_bus, args=(bus_socket,), daemon=True).start()
+        self.load_user_directory()
+        log.info("Shard %s de mensajería listo", self.shard)
+
+        while True:
+            conn, _ = handoff_socket.accept()
+            threading.Thread(target=self.receive_handoffs, args=(conn,), daemon=True).start()
+
+    def receive_handoffs(self, conn):
+        """Recibe del router los sockets de clientes ya saludados."""
+        with conn:
+            while True:
+                payload, fds, _, _ = socket.recv_fds(conn, HANDOFF_MAX_SIZE, 1)
+                if not fds:
+                    break
+                client_socket = socket.socket(fileno=fds[0])
+                reader = LineReader(client_socket, initial=payload)
+                self.client_pool.submit(client_socket, reader)
+
+    def serve_bus(self, bus_socket):
+        # Al bus se conectan el router y los demás shards, cada uno con su pool
+        workers = workers_for_peers(self.ring.shards, minimum=0)
+        ThreadPoolServer(self.handle_bus, max_workers=workers, reject=None, name="bus").serve(bus_socket)
+
+    def handle_bus(self, conn, addr=None):
+        stream = MessageStream(conn)
+        try:
+            for request in stream:
+                with continue_trace(request, "mensajeria", f"bus.{request.get('action')}", shard=self.shard):
+                    response = self.process_bus_request(request)
+                stream.send(response)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def process_bus_request(self, request):
+        action = request.get("action")
+        if action == "deliver":
+            delivered = self.deliver_message(request["sender"], request["recipient"], request["content"])
+            return {"status": "success" if delivered else "error"}
+        if action == "nuevo_usuario":
+            username = request.get("username")
+            if username:
+                self.add_known_user(username)
+                self.broadcast_new_user(username)
+            return {"status": "success"}
+        if action == "stats":
+            return stats_response()
+        if action == "log_config":
+            return log_config(request)
+        return {"status": "error", "message": "Acción no válida"}
+
+    def deliver_message(self, sender, recipient, content):
+        owner = self.ring.shard_for(recipient)
+        if owner == self.shard:
+            return super().deliver_message(sender, recipient, content)
+        if not self.validate_user(recipient):
+            return False
+        try:
+            response = self.bus[owner].request({
+                "action": "deliver",
+                "sender": sender,
+                "recipient": recipient,
+                "content": content
+            })
+            return response["status"] == "success"
+        except Exception as e:
+            # Si el shard dueño no responde, el mensaje queda pendiente
+            log.warning("Error al entregar a %s en el shard %s: %s", recipient, owner, e)
+            return self.store_message(sender, recipient, content)
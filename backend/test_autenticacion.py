@@ -1,18 +1,24 @@
 import unittest
-import os
+import hashlib
 import threading
 import time
 
-from servicioAutenticacion.main import registrar_usuario, iniciar_sesion, verificar_usuario
+from servicioAutenticacion.credenciales import (
+    CacheCredenciales, calcular_hash, requiere_rehash, verificar_hash
+)
+from servicioAutenticacion.main import (
+    configurar_clave_sesion, credenciales_verificadas, enviar_solicitud_al_almacenamiento, iniciar_sesion,
+    procesar_solicitud,
+    registrar_usuario, registrar_usuarios, verificar_usuario
+)
+from comun.tokens import verify_token
 from servicioAlmacenamiento.main import start_server as iniciar_almacenamiento
-from servicioAlmacenamiento.database import DB_NAME, init_db
-
-if os.path.exists(DB_NAME):
-    os.remove(DB_NAME)
-init_db()
 
 class TestServicioAutenticacion(unittest.TestCase):
-    almacenamiento_thread = threading.Thread(target=iniciar_almacenamiento, daemon=True)
+    # Motor en memoria: las pruebas no tocan la base del servicio
+    almacenamiento_thread = threading.Thread(
+        target=iniciar_almacenamiento, kwargs={"backend": "memory"}, daemon=True
+    )
     almacenamiento_thread.start()
 
     time.sleep(1)
@@ -26,11 +32,39 @@ class TestServicioAutenticacion(unittest.TestCase):
         respuesta = registrar_usuario("testuser", "password123")
         self.assertEqual(respuesta["status"], "error")
 
+    def test_registro_masivo(self):
+        registrar_usuario("masivo_a", "clave_a")
+        respuesta = registrar_usuarios([
+            {"username": "masivo_a", "password": "otra"},
+            {"username": "masivo_b", "password": "clave_b"},
+        ])
+        self.assertEqual(respuesta["registered"], ["masivo_b"])
+        self.assertEqual(iniciar_sesion("masivo_a", "clave_a")["status"], "success")
+        self.assertEqual(iniciar_sesion("masivo_b", "clave_b")["status"], "success")
+
     def test_iniciar_sesion_exitoso(self):
         registrar_usuario("testuser", "password123")
         respuesta = iniciar_sesion("testuser", "password123")
         self.assertEqual(respuesta["status"], "success")
 
+    def test_iniciar_sesion_emite_token(self):
+        registrar_usuario("testuser", "password123")
+        self.assertNotIn("token", iniciar_sesion("testuser", "password123"))
+        configurar_clave_sesion("clave")
+        self.addCleanup(configurar_clave_sesion, None)
+        # También desde la caché de credenciales verificadas
+        for _ in range(2):
+            respuesta = iniciar_sesion("testuser", "password123")
+            self.assertEqual(verify_token("clave", respuesta["token"]), "testuser")
+
+    def test_registro_deja_la_sesion_iniciada(self):
+        configurar_clave_sesion("clave")
+        self.addCleanup(configurar_clave_sesion, None)
+        respuesta = registrar_usuario("recien", "password123")
+        self.assertEqual(verify_token("clave", respuesta["token"]), "recien")
+        self.assertTrue(credenciales_verificadas.verificada("recien", "password123"))
+        self.assertEqual(iniciar_sesion("recien", "otra")["status"], "error")
+
     def test_iniciar_sesion_fallo(self):
         registrar_usuario("testuser", "password123")
         respuesta = iniciar_sesion("testuser", "wrongpassword")
@@ -41,5 +75,52 @@ class TestServicioAutenticacion(unittest.TestCase):
         respuesta = verificar_usuario("testuser")
         self.assertEqual(respuesta["status"], "success")
 
+    def test_stats(self):
+        registrar_usuario("testuser", "password123")
+        iniciar_sesion("testuser", "password123")
+        metricas = procesar_solicitud({"action": "stats"})["metrics"]
+        self.assertIn('auth_hash_seconds_count{operation="calcular"}', metricas)
+        # Las del almacenamiento, que corre en el mismo proceso en estas pruebas
+        respuesta = enviar_solicitud_al_almacenamiento({"action": "stats"})
+        self.assertIn('storage_request_seconds_count{action="obtener_usuario"}', respuesta["metrics"])
+
+    def test_hash_heredado_se_actualiza(self):
+        enviar_solicitud_al_almacenamiento({
+            "action": "guardar_usuario",
+            "username": "heredado",
+            "password_hash": hashlib.sha256(b"clave").hexdigest()
+        })
+        self.assertEqual(iniciar_sesion("heredado", "clave")["status"], "success")
+        usuario = enviar_solicitud_al_almacenamiento({"action": "obtener_usuario", "username": "heredado"})
+        self.assertFalse(requiere_rehash(usuario["user"]["password_hash"]))
+        credenciales_verificadas.olvidar("heredado")
+        self.assertEqual(iniciar_sesion("heredado", "clave")["status"], "success")
+        self.assertEqual(iniciar_sesion("heredado", "otra")["status"], "error")
+
+class TestCredenciales(unittest.TestCase):
+    def test_hash_con_sal(self):
+        primero, segundo = calcular_hash("secreto", n=2 ** 8), calcular_hash("secreto", n=2 ** 8)
+        self.assertNotEqual(primero, segundo)
+        self.assertTrue(verificar_hash("secreto", primero))
+        self.assertFalse(verificar_hash("otro", segundo))
+        # Parámetros distintos de los actuales: se recalcula al iniciar sesión
+        self.assertTrue(requiere_rehash(primero))
+        self.assertFalse(requiere_rehash(calcular_hash("secreto")))
+
+    def test_hash_sha256_heredado(self):
+        heredado = hashlib.sha256(b"secreto").hexdigest()
+        self.assertTrue(verificar_hash("secreto", heredado))
+        self.assertFalse(verificar_hash("otro", heredado))
+        self.assertTrue(requiere_rehash(heredado))
+
+    def test_cache_credenciales(self):
+        cache = CacheCredenciales(max_size=10, ttl=0.1)
+        cache.recordar("ana", "secreto")
+        self.assertTrue(cache.verificada("ana", "secreto"))
+        self.assertFalse(cache.verificada("ana", "otro"))
+        self.assertFalse(cache.verificada("beto", "secreto"))
+        time.sleep(0.15)
+        self.assertFalse(cache.verificada("ana", "secreto"))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,385 @@
+import unittest
+import os
+import socket
+import tempfile
+import threading
+import time
+import json
+import logging
+import queue
+import urllib.request
+
+from comun.metrics import REGISTRY, MetricsRegistry, RequestMetrics, serve_metrics, track_caches
+from comun.cache import LRUCache
+from comun.log import DROPPED, JSONFormatter, NonBlockingQueueHandler, log_config, log_request
+from comun.pool import POOL_MAX_IDLE, ConnectionPool
+from comun.protocol import JSONReader, MessageStream, FrameReader, send_frame
+from comun.tokens import issue_token, token_username, verify_token
+from comun.server import IDLE_TIMEOUT, MAX_WORKERS, SATURATED, ThreadPoolServer, workers_for_peers
+from comun.tracing import configure_tracing, continue_trace, flush_traces, span, start_trace, stop_tracing
+import trace_report
+
+class EchoServer:
+    """Servidor de prueba que responde cada solicitud con su contenido y el número de conexión."""
+
+    def __init__(self, path=None, delay=0):
+        self.delay = delay
+        self.received = []
+        if path is None:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(('127.0.0.1', 0))
+            self.port = self.server.getsockname()[1]
+        else:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.port = None
+        self.server.listen(5)
+        self.connections = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            threading.Thread(target=self.handle, args=(conn, len(self.connections)), daemon=True).start()
+
+    def close(self):
+        # shutdown despierta al hilo bloqueado en accept; close solo no lo hace
+        for sock in [self.server, *self.connections]:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def handle(self, conn, number):
+        try:
+            stream = MessageStream(conn)
+            for request in stream:
+                self.received.append(request)
+                time.sleep(self.delay)
+                stream.send({"status": "success", "echo": request, "connection": number})
+        except OSError:
+            pass
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer()
+        self.addCleanup(self.server.close)
+        self.pool = ConnectionPool('127.0.0.1', self.server.port, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reutiliza_conexion(self):
+        for i in range(5):
+            response = self.pool.request({"action": "eco", "n": i})
+            self.assertEqual(response["echo"]["n"], i)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_reconecta_si_el_servidor_cierra(self):
+        self.pool.request({"action": "eco"})
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        response = self.pool.request({"action": "eco"})
+        self.assertEqual(response["connection"], 2)
+
+    def test_solicitudes_concurrentes(self):
+        results = []
+        def worker():
+            for _ in range(20):
+                results.append(self.pool.request({"action": "eco"})["status"])
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ["success"] * 80)
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def test_no_repite_una_solicitud_enviada(self):
+        server = EchoServer()
+        self.addCleanup(server.close)
+        pool = ConnectionPool('127.0.0.1', server.port, timeout=0.1)
+        self.addCleanup(pool.close)
+        pool.request({"n": 0})
+        server.delay = 0.3
+        # La respuesta no llega a tiempo por la conexión reutilizada: no se reenvía
+        with self.assertRaises(OSError):
+            pool.request({"action": "save_message"})
+        time.sleep(0.4)
+        self.assertEqual([r for r in server.received if r.get("action") == "save_message"],
+                         [{"action": "save_message"}])
+
+    def test_respuesta_grande(self):
+        payload = {"action": "eco", "data": "x" * (2 * 1024 * 1024)}
+        response = self.pool.request(payload)
+        self.assertEqual(len(response["echo"]["data"]), 2 * 1024 * 1024)
+
+    def test_solicitudes_encadenadas(self):
+        responses = self.pool.request_many([{"n": i} for i in range(10)])
+        self.assertEqual([r["echo"]["n"] for r in responses], list(range(10)))
+
+    def test_cliente_sin_tramas(self):
+        with socket.create_connection(('127.0.0.1', self.server.port)) as sock:
+            sock.sendall(b'{"action": "eco"}')
+            response = JSONReader(sock).read()
+        self.assertEqual(response["echo"], {"action": "eco"})
+
+    def test_socket_unix(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'eco.sock')
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, path)
+        server = EchoServer(path)
+        self.addCleanup(server.close)
+        pool = ConnectionPool(path, None)
+        self.addCleanup(pool.close)
+        self.assertEqual(pool.request({"n": 1})["echo"], {"n": 1})
+        self.assertEqual(pool.request({"n": 2})["connection"], 1)
+
+class TestProtocol(unittest.TestCase):
+    def test_tramas_consecutivas(self):
+        a, b = socket.socketpair()
+        for i in range(3):
+            send_frame(a, {"n": i, "texto": "ñ" * i})
+        a.close()
+        self.assertEqual([doc["n"] for doc in FrameReader(b)], [0, 1, 2])
+        b.close()
+
+    def test_documentos_consecutivos_y_sin_delimitador(self):
+        a, b = socket.socketpair()
+        a.sendall(b'{"n": 1}\n{"n": 2}\n{"n": 3}')
+        a.close()
+        self.assertEqual([doc["n"] for doc in JSONReader(b)], [1, 2, 3])
+        b.close()
+
+class TestTokens(unittest.TestCase):
+    def test_token_valido(self):
+        token = issue_token(b'clave', 'ñandú|1')
+        # Viaja en una línea AUTH|<token>
+        self.assertNotIn('|', token)
+        self.assertEqual(verify_token(b'clave', token), 'ñandú|1')
+        self.assertEqual(verify_token('clave', token), 'ñandú|1')
+        self.assertEqual(token_username(token), 'ñandú|1')
+
+    def test_token_invalido(self):
+        token = issue_token(b'clave', 'ana')
+        user_part, expires, signature = token.split('.')
+        self.assertIsNone(verify_token(b'otra', token))
+        self.assertIsNone(verify_token(b'clave', f"{user_part}.{int(expires) + 60}.{signature}"))
+        self.assertIsNone(verify_token(b'clave', issue_token(b'clave', 'ana', ttl=-1)))
+        for text in ('ana', 'a.b', 'a.b.c', '..', ''):
+            self.assertIsNone(verify_token(b'clave', text))
+
+class TestMetrics(unittest.TestCase):
+    def test_formato_prometheus(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("pruebas_total", "Pruebas", ("action",))
+        counter.inc(action="a")
+        counter.inc(2, action='con "comillas"')
+        self.assertIs(registry.counter("pruebas_total", "Pruebas", ("action",)), counter)
+        registry.gauge("abiertas", "Conexiones").set_function(lambda: 3)
+        histogram = registry.histogram("latencia_seconds", "Latencia", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+        lines = registry.render().splitlines()
+        self.assertIn('pruebas_total{action="a"} 1', lines)
+        self.assertIn('pruebas_total{action="con \\"comillas\\""} 2', lines)
+        self.assertIn('# TYPE abiertas gauge', lines)
+        self.assertIn('abiertas 3', lines)
+        self.assertIn('latencia_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latencia_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('latencia_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('latencia_seconds_sum 5.55', lines)
+        self.assertIn('latencia_seconds_count 3', lines)
+        with self.assertRaises(ValueError):
+            counter.inc(otra="a")
+
+    def test_solicitudes_y_caches(self):
+        registry = MetricsRegistry()
+        metrics = RequestMetrics("servicio", {"leer"}, registry)
+        metrics.handle(lambda request: {"status": "success"}, {"action": "leer"})
+        metrics.handle(lambda request: {"status": "error"}, {"action": "inventada"})
+        cache = LRUCache(10)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        track_caches("servicio", {"usuarios": cache}, registry)
+        text = registry.render()
+        self.assertIn('servicio_request_seconds_count{action="leer"} 1', text)
+        self.assertIn('servicio_request_errors_total{action="otra"} 1', text)
+        self.assertNotIn('servicio_request_errors_total{action="leer"}', text)
+        self.assertIn('servicio_cache_hit_ratio{cache="usuarios"} 0.5', text)
+
+    def test_puerto_http(self):
+        registry = MetricsRegistry()
+        registry.counter("visitas_total", "Visitas").inc()
+        server = serve_metrics(0, registry=registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+            self.assertIn("visitas_total 1", response.read().decode())
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.records = queue.Queue(3)
+        self.logger = logging.getLogger(f"pruebas.{self.id()}")
+        self.logger.propagate = False
+        self.logger.addHandler(NonBlockingQueueHandler(self.records))
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        self.addCleanup(log_config, {"sample_rate": log_config({})["sample_rate"]})
+
+    def test_json_con_campos(self):
+        self.logger.warning("Error con %s", "ana", extra={"recipient": "beto"})
+        entry = json.loads(JSONFormatter("mensajeria").format(self.records.get_nowait()))
+        self.assertEqual(entry["msg"], "Error con ana")
+        self.assertEqual(entry["level"], "WARNING")
+        self.assertEqual(entry["service"], "mensajeria")
+        self.assertEqual(entry["recipient"], "beto")
+
+    def test_cola_llena_descarta(self):
+        def dropped():
+            return sum(value for _, _, _, value in DROPPED.samples())
+
+        before = dropped()
+        for i in range(5):
+            self.logger.warning("Mensaje %s", i)
+        self.assertEqual(self.records.qsize(), 3)
+        self.assertEqual(dropped() - before, 2)
+
+    def test_nivel_y_muestreo_en_caliente(self):
+        self.assertEqual(log_config({"level": "info", "sample_rate": 1})["level"], "INFO")
+        log_request(self.logger, "Conexión %s", 1)
+        self.assertTrue(self.records.empty())
+        log_config({"level": "DEBUG"})
+        log_request(self.logger, "Conexión %s", 2, addr="x")
+        self.assertEqual(self.records.get_nowait().addr, "x")
+        log_config({"sample_rate": 0})
+        log_request(self.logger, "Conexión %s", 3)
+        self.assertTrue(self.records.empty())
+        self.assertEqual(log_config({"level": "NO_EXISTE"})["status"], "error")
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'trazas.jsonl')
+        configure_tracing(self.path, sample_rate=1)
+        self.addCleanup(stop_tracing)
+        self.server = EchoServer()
+        self.addCleanup(self.server.close)
+        self.pool = ConnectionPool('127.0.0.1', self.server.port)
+        self.addCleanup(self.pool.close)
+
+    def spans(self):
+        flush_traces()
+        return {record["name"]: record for record in trace_report.load_spans(self.path)}
+
+    def test_propaga_la_traza_por_el_pool(self):
+        with start_trace("mensajeria", "SEND", user="ana"):
+            with span("validar"):
+                response = self.pool.request({"action": "eco"})
+            # Lo que haría el servicio con la solicitud recibida
+            with continue_trace(response["echo"], "almacenamiento", "guardar"):
+                pass
+        self.assertNotIn("trace", self.pool.request({"action": "eco"})["echo"])
+
+        spans = self.spans()
+        self.assertEqual(set(spans), {"SEND", "validar", "eco", "guardar"})
+        self.assertEqual(len({record["trace_id"] for record in spans.values()}), 1)
+        self.assertIsNone(spans["SEND"]["parent_id"])
+        self.assertEqual(spans["SEND"]["user"], "ana")
+        self.assertEqual(spans["validar"]["parent_id"], spans["SEND"]["span_id"])
+        self.assertEqual(spans["eco"]["parent_id"], spans["validar"]["span_id"])
+        self.assertEqual(spans["eco"]["peer"], f"127.0.0.1:{self.server.port}")
+        self.assertEqual(spans["guardar"]["parent_id"], spans["eco"]["span_id"])
+        self.assertEqual((spans["eco"]["service"], spans["guardar"]["service"]), ("mensajeria", "almacenamiento"))
+
+    def test_sin_muestreo_no_registra_ni_propaga(self):
+        configure_tracing(self.path, sample_rate=0)
+        with start_trace("mensajeria", "SEND") as tags:
+            self.assertIsNone(tags)
+            self.assertNotIn("trace", self.pool.request({"action": "eco"})["echo"])
+        self.assertEqual(self.spans(), {})
+
+    def test_camino_critico(self):
+        def record(name, parent, start_ms, duration_ms):
+            return {"trace_id": "t", "span_id": name, "parent_id": parent, "service": "s", "name": name,
+                    "start": 100 + start_ms / 1000, "duration_ms": duration_ms}
+
+        # "a" corre en paralelo con "b" y termina antes: no está en el camino crítico
+        roots = trace_report.build_traces([
+            record("raiz", None, 0, 10), record("a", "raiz", 0, 3),
+            record("b", "raiz", 1, 7), record("c", "raiz", 8, 1.5), record("b1", "b", 2, 4),
+        ])
+        path = trace_report.critical_path(roots["t"])
+        self.assertEqual([(depth, node.record["name"]) for depth, node, _ in path],
+                         [(0, "raiz"), (1, "b"), (2, "b1"), (1, "c")])
+        self.assertEqual([round(own, 3) for _, _, own in path], [1.5, 3.0, 4.0, 1.5])
+
+class TestThreadPoolServer(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.addCleanup(self.server.close)
+
+    def start(self, **kwargs):
+        pool = ThreadPoolServer(self.handle, name=self.id(), **kwargs)
+        threading.Thread(target=pool.serve, args=(self.server,), daemon=True).start()
+        return pool
+
+    def handle(self, conn, addr):
+        with conn:
+            stream = MessageStream(conn)
+            for request in stream:
+                self.release.wait(5)
+                stream.send({"status": "success", "echo": request})
+
+    def connect(self):
+        conn = socket.create_connection(self.server.getsockname(), timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_rechaza_al_superar_el_limite(self):
+        pool = self.start(max_workers=1, max_pending=0)
+        busy = self.connect()
+        send_frame(busy, {"n": 1})
+        rejected = self.connect()
+        send_frame(rejected, {"n": 2})
+        self.assertEqual(FrameReader(rejected).read(), SATURATED)
+        self.assertEqual(pool.rejected, 1)
+        self.assertIn(f'server_rejected_total{{server="{pool.name}"}} 1', REGISTRY.render())
+        self.release.set()
+        self.assertEqual(FrameReader(busy).read()["echo"], {"n": 1})
+
+    def test_hilos_para_los_pools_de_los_clientes(self):
+        # El servidor cierra las conexiones ociosas antes de que el pool las reutilice
+        self.assertLess(IDLE_TIMEOUT, POOL_MAX_IDLE)
+        self.assertEqual(workers_for_peers(3, pool_size=8, minimum=0), 24)
+        self.assertEqual(workers_for_peers(1), MAX_WORKERS)
+
+    def test_cierra_conexiones_ociosas(self):
+        self.release.set()
+        pool = self.start(max_workers=1, max_pending=0, idle_timeout=0.2)
+        idle = self.connect()
+        self.assertEqual(idle.recv(1), b'')
+        # El handler cierra la conexión un instante antes de que el hilo se libere
+        deadline = time.monotonic() + 5
+        while pool.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # El hilo quedó libre para la siguiente conexión
+        conn = self.connect()
+        send_frame(conn, {"n": 3})
+        self.assertEqual(FrameReader(conn).read()["echo"], {"n": 3})
+
+if __name__ == "__main__":
+    unittest.main()
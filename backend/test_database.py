@@ -1,11 +1,46 @@
 import unittest
+import contextlib
+import io
 import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import partial
 
-from servicioAlmacenamiento.database import save_user, get_user, save_message, get_messages, init_db, DB_NAME
+from servicioAlmacenamiento.database import (
+    save_user, get_user, save_message, get_messages, get_conversation_history,
+    get_pending_messages, ack_messages, register_user, register_users, read_conversation_history,
+    init_db, engine, message_batcher, DB_NAME as database_path,
+    PENDING_MESSAGES_QUERY, CONVERSATION_HISTORY_QUERY, ARCHIVE_HISTORY_QUERY,
+)
+from servicioAlmacenamiento.batcher import WriteBatcher
+from servicioAlmacenamiento.compaction import (
+    AUTO_VACUUM_INCREMENTAL, MessageCompactor, archive_messages, release_free_pages,
+)
+from servicioAlmacenamiento import compaction
+from servicioAlmacenamiento.engine import SQLiteEngine
+from servicioAlmacenamiento.migrations import MIGRATIONS, apply_migrations, schema_version
+from comun.cache import MISSING, LRUCache
+from servicioAlmacenamiento import database
+from servicioAlmacenamiento.backends import MemoryBackend, SQLiteBackend, StorageBackend, create_backend
+from servicioAlmacenamiento.main import process_request, serve, start_prefork
+from comun.pool import ConnectionPool
 
-if os.path.exists(DB_NAME):
-    os.remove(DB_NAME)
-init_db()
+# Las pruebas usan una base temporal, no la del servicio
+_directory = None
+
+def setUpModule():
+    global _directory
+    _directory = tempfile.mkdtemp()
+    database.use_database(os.path.join(_directory, "pruebas.db"))
+    init_db()
+
+def tearDownModule():
+    database.use_database(database_path)
+    shutil.rmtree(_directory)
 
 class TestDatabase(unittest.TestCase):
     def setUp(self):
@@ -17,10 +52,450 @@ class TestDatabase(unittest.TestCase):
         self.assertIsNotNone(user)
         self.assertTrue(user["password_hash"] == "password123")
 
+    def test_registro_atomico_concurrente(self):
+        results = {}
+        threads = [
+            threading.Thread(target=lambda i=i: results.__setitem__(f"hash{i}", register_user("unico", f"hash{i}")))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        winners = [password_hash for password_hash, registered in results.items() if registered]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(get_user("unico")["password_hash"], winners[0])
+
+    def test_registro_masivo_omite_existentes(self):
+        register_user("masivo1", "h")
+        registered = register_users([("masivo1", "otro"), ("masivo2", "h2"), ("masivo3", "h3")])
+        self.assertEqual(registered, ["masivo2", "masivo3"])
+        self.assertEqual(get_user("masivo1")["password_hash"], "h")
+        self.assertEqual(get_user("masivo3")["password_hash"], "h3")
+
     def test_save_message(self):
         save_message("test_user", "receiver", "Hello!")
         messages = get_messages("receiver")
         self.assertIn("Hello!", messages)
 
+    def test_modo_wal(self):
+        with engine.read() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_lectura_durante_escritura(self):
+        save_message("ana", "beto", "Primero")
+        with engine.write() as conn:
+            conn.execute(
+                "INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)",
+                ("ana", "beto", "Sin confirmar")
+            )
+            # La transacción de escritura sigue abierta y la lectura no se bloquea
+            history = get_conversation_history("ana", "beto")
+        self.assertEqual([m["message"] for m in history], ["Primero"])
+
+    def test_guardado_concurrente_en_lotes(self):
+        rows = message_batcher.rows
+        threads = [
+            threading.Thread(target=save_message, args=(f"remitente{i}", "lote", f"Mensaje {i}"))
+            for i in range(40)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with engine.read() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM messages WHERE receiver = 'lote'").fetchone()[0]
+        self.assertEqual(count, 40)
+        self.assertEqual(message_batcher.rows - rows, 40)
+
+    def test_lote_agrupa_filas_concurrentes(self):
+        # Con una espera larga, 40 filas que llegan juntas comparten transacción
+        batcher = WriteBatcher(
+            engine, "INSERT INTO messages (sender, receiver, message) VALUES (?, ?, ?)", max_delay=0.2
+        )
+        barrier = threading.Barrier(40)
+
+        def submit(i):
+            barrier.wait()
+            batcher.submit((f"remitente{i}", "agrupado", f"Mensaje {i}"))
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(40)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(batcher.rows, 40)
+        self.assertLessEqual(batcher.commits, 2)
+
+    def test_fila_invalida_no_afecta_al_lote(self):
+        with self.assertRaises(Exception):
+            save_message(None, "receiver", "Sin remitente")
+        save_message("test_user", "receiver2", "Válido")
+        self.assertIn("Válido", get_messages("receiver2"))
+
+    def test_migraciones_aplicadas(self):
+        with engine.read() as conn:
+            self.assertEqual(schema_version(conn), len(MIGRATIONS))
+
+    def explain(self, query, params):
+        with engine.read() as conn:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        return " ".join(row[-1] for row in rows)
+
+    def test_plan_mensajes_pendientes(self):
+        plan = self.explain(PENDING_MESSAGES_QUERY, ("receiver", 0, 500))
+        self.assertIn("idx_messages_pending", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_plan_historial(self):
+        plan = self.explain(CONVERSATION_HISTORY_QUERY, ("ana", "beto", 1000, 50))
+        self.assertIn("idx_messages_conversation", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_historial_en_ambos_sentidos(self):
+        save_message("carla", "dario", "Hola Dario")
+        save_message("dario", "carla", "Hola Carla")
+        history = get_conversation_history("dario", "carla")
+        self.assertEqual([m["message"] for m in history], ["Hola Dario", "Hola Carla"])
+
+    def test_historial_paginado(self):
+        for i in range(7):
+            save_message("elena", "fabio", f"Mensaje {i}")
+        page = get_conversation_history("fabio", "elena", limit=3)
+        self.assertEqual([m["message"] for m in page], ["Mensaje 4", "Mensaje 5", "Mensaje 6"])
+        page = get_conversation_history("fabio", "elena", before_id=page[0]["id"], limit=3)
+        self.assertEqual([m["message"] for m in page], ["Mensaje 1", "Mensaje 2", "Mensaje 3"])
+        page = get_conversation_history("fabio", "elena", before_id=page[0]["id"], limit=3)
+        self.assertEqual([m["message"] for m in page], ["Mensaje 0"])
+
+    def test_usuario_desconocido_en_cache_negativa(self):
+        self.assertIsNone(get_user("fantasma"))
+        misses = database.user_cache.misses
+        self.assertIsNone(get_user("fantasma"))
+        self.assertEqual(database.user_cache.misses, misses)
+        save_user("fantasma", "hash")
+        self.assertEqual(get_user("fantasma")["password_hash"], "hash")
+
+    def test_mensajes_entregados_no_se_repiten(self):
+        save_message("test_user", "receiver3", "Una vez")
+        self.assertEqual(get_messages("receiver3"), ["Una vez"])
+        self.assertEqual(get_messages("receiver3"), [])
+        save_message("test_user", "receiver3", "Otra")
+        self.assertEqual(get_messages("receiver3"), ["Otra"])
+
+    def test_pendientes_por_bloques_con_ack(self):
+        for i in range(5):
+            save_message("gina", "hugo", f"Pendiente {i}")
+        page = get_pending_messages("hugo", limit=3)
+        self.assertEqual([m["message"] for m in page], ["Pendiente 0", "Pendiente 1", "Pendiente 2"])
+        self.assertEqual(page[0]["sender"], "gina")
+        self.assertIsNotNone(page[0]["timestamp"])
+        rest = get_pending_messages("hugo", after_id=page[-1]["id"], limit=3)
+        self.assertEqual([m["message"] for m in rest], ["Pendiente 3", "Pendiente 4"])
+
+        # Sin ack, una reconexión vuelve a recibir todo
+        self.assertEqual(len(get_pending_messages("hugo")), 5)
+        self.assertEqual(ack_messages("hugo", page[-1]["id"]), 3)
+        self.assertEqual(ack_messages("hugo", page[-1]["id"]), 0)
+        self.assertEqual([m["message"] for m in get_pending_messages("hugo")], ["Pendiente 3", "Pendiente 4"])
+        ack_messages("hugo", rest[-1]["id"])
+        self.assertEqual(get_pending_messages("hugo"), [])
+
+        save_message("gina", "hugo", "Nueva")
+        self.assertEqual([m["message"] for m in get_pending_messages("hugo")], ["Nueva"])
+
+class BackendContract:
+    """Semántica común a todos los motores; cada subclase da `make_backend`."""
+
+    def setUp(self):
+        self.backend = self.make_backend()
+        self.backend.init()
+        # La base SQLite se comparte entre pruebas: nombres únicos por prueba
+        self.prefix = f"{self.backend.name}_{self._testMethodName}_"
+
+    def user(self, name):
+        return self.prefix + name
+
+    def test_usuarios(self):
+        ana, beto = self.user("ana"), self.user("beto")
+        self.assertTrue(self.backend.register_user(ana, "h1"))
+        self.assertFalse(self.backend.register_user(ana, "otro"))
+        self.assertEqual(self.backend.register_users([(ana, "x"), (beto, "h2")]), [beto])
+        self.assertEqual(self.backend.get_user(ana)["password_hash"], "h1")
+        self.assertIsNone(self.backend.get_user(self.user("nadie")))
+        self.assertFalse(self.backend.update_password(ana, "viejo", "h3"))
+        self.assertTrue(self.backend.update_password(ana, "h1", "h3"))
+        self.assertEqual(self.backend.get_user(ana)["password_hash"], "h3")
+        self.assertLessEqual({ana, beto}, set(self.backend.get_all_users()))
+
+    def test_pendientes_con_ack(self):
+        sender, receiver = self.user("emisor"), self.user("receptor")
+        for i in range(5):
+            self.backend.save_message(sender, receiver, f"Pendiente {i}")
+        page = self.backend.get_pending_messages(receiver, limit=3)
+        self.assertEqual([m["message"] for m in page], ["Pendiente 0", "Pendiente 1", "Pendiente 2"])
+        self.assertEqual(page[0]["sender"], sender)
+        rest = self.backend.get_pending_messages(receiver, after_id=page[-1]["id"])
+        self.assertEqual([m["message"] for m in rest], ["Pendiente 3", "Pendiente 4"])
+        self.assertEqual(self.backend.ack_messages(receiver, page[-1]["id"]), 3)
+        self.assertEqual(self.backend.ack_messages(receiver, page[-1]["id"]), 0)
+        self.assertEqual(self.backend.get_messages(receiver), ["Pendiente 3", "Pendiente 4"])
+        self.assertEqual(self.backend.get_pending_messages(receiver), [])
+
+    def test_historial_paginado(self):
+        elena, fabio = self.user("elena"), self.user("fabio")
+        for i in range(7):
+            self.backend.save_message(*((elena, fabio) if i % 2 else (fabio, elena)), f"Mensaje {i}")
+        page = self.backend.get_conversation_history(fabio, elena, limit=3)
+        self.assertEqual([m["message"] for m in page], ["Mensaje 4", "Mensaje 5", "Mensaje 6"])
+        page = self.backend.get_conversation_history(elena, fabio, before_id=page[0]["id"], limit=4)
+        self.assertEqual([m["message"] for m in page], [f"Mensaje {i}" for i in range(4)])
+        self.assertEqual(len(self.backend.get_conversation_history(elena, fabio)), 7)
+
+class TestSQLiteBackend(BackendContract, unittest.TestCase):
+    make_backend = SQLiteBackend
+
+    def test_latencia_de_lote_configurable(self):
+        self.addCleanup(database.set_save_batch_delay, database.SAVE_MESSAGE_MAX_DELAY)
+        backend = create_backend("sqlite", save_batch_delay=0.3)
+        backend.init()
+        self.assertEqual(message_batcher.max_delay, 0.3)
+        # Dos mensajes a 0.1 s de distancia caen en la ventana del primero:
+        # con la latencia por omisión serían dos transacciones
+        commits = message_batcher.commits
+        sender, receiver = self.user("ventana"), self.user("lote")
+        threads = [
+            threading.Thread(target=backend.save_message, args=(sender, receiver, f"Mensaje {i}"))
+            for i in range(2)
+        ]
+        for t in threads:
+            t.start()
+            time.sleep(0.1)
+        for t in threads:
+            t.join()
+        self.assertEqual(message_batcher.commits - commits, 1)
+
+class TestMemoryBackend(BackendContract, unittest.TestCase):
+    make_backend = MemoryBackend
+
+    def test_motor_por_nombre(self):
+        self.assertIsInstance(create_backend("memory"), MemoryBackend)
+        self.assertIs(create_backend(self.backend), self.backend)
+        with self.assertRaises(ValueError):
+            create_backend("papel")
+
+    def test_motor_incompleto_falla_al_crearse(self):
+        class SoloUsuarios(StorageBackend):
+            get_user = MemoryBackend.get_user
+
+        with self.assertRaises(TypeError):
+            SoloUsuarios()
+
+    def test_servicio_sobre_memoria(self):
+        server = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(
+            target=serve, args=(server, partial(process_request, backend=self.backend)),
+            kwargs={"backend": self.backend}, daemon=True
+        ).start()
+        pool = ConnectionPool("127.0.0.1", server.getsockname()[1])
+        self.addCleanup(pool.close)
+        response = pool.request({"action": "registrar_usuario_atomic", "username": "mem", "password_hash": "h"})
+        self.assertEqual(response["status"], "success")
+        pool.request({"action": "save_message", "sender": "mem", "receiver": "otro", "message": "Hola"})
+        self.assertEqual(pool.request({"action": "get_messages", "receiver": "otro"})["messages"], ["Hola"])
+        # Nada llegó a la base SQLite
+        self.assertIsNone(get_user("mem"))
+
+class TestCompaction(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "compactacion.db")
+        self.engine = SQLiteEngine(self.path)
+        self.addCleanup(self.engine.reset)
+        with self.engine.write() as conn:
+            apply_migrations(conn)
+
+    def insert(self, timestamp, delivered=True, count=1, size=10):
+        with self.engine.write() as conn:
+            conn.executemany(
+                "INSERT INTO messages (sender, receiver, message, is_delivered, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [("ana", "beto", "x" * size, int(delivered), timestamp)] * count
+            )
+
+    def query(self, sql):
+        with self.engine.read() as conn:
+            return conn.execute(sql).fetchall()
+
+    def history(self, *args, **kwargs):
+        with self.engine.read() as conn:
+            return read_conversation_history(conn, *args, **kwargs)
+
+    def test_archiva_entregados_viejos_por_mes(self):
+        self.insert("2025-12-10 10:00:00", count=2)
+        self.insert("2025-12-11 10:00:00", delivered=False)
+        self.insert("2026-01-05 10:00:00", count=3)
+        self.insert(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()), count=2)
+
+        moved = archive_messages(self.engine, max_age_days=30, batch_size=2)
+        self.assertEqual(moved, {"messages_archive_2025_12": 2, "messages_archive_2026_01": 3})
+        # Quedan el pendiente (aunque sea viejo) y los recientes
+        self.assertEqual([row[0] for row in self.query("SELECT id FROM messages ORDER BY id")], [3, 7, 8])
+        self.assertEqual(self.query("SELECT * FROM message_archives ORDER BY name"), [
+            ("messages_archive_2025_12", 1, 2, 2), ("messages_archive_2026_01", 4, 6, 3),
+        ])
+        self.assertEqual(archive_messages(self.engine, max_age_days=30), {})
+
+        plan = " ".join(row[-1] for row in self.query(
+            "EXPLAIN QUERY PLAN " + ARCHIVE_HISTORY_QUERY.format(table="messages_archive_2026_01").replace("?", "1")
+        ))
+        self.assertIn("idx_messages_archive_2026_01_conversation", plan)
+
+    def test_devuelve_las_paginas_libres(self):
+        self.assertEqual(self.query("PRAGMA auto_vacuum")[0][0], AUTO_VACUUM_INCREMENTAL)
+        self.insert("2025-12-10 10:00:00", count=200, size=4000)
+        archive_messages(self.engine, max_age_days=30)
+        self.assertGreater(release_free_pages(self.engine, pages=50), 0)
+        self.assertEqual(self.query("PRAGMA freelist_count")[0][0], 0)
+
+    def test_conversion_de_una_base_existente(self):
+        # Una base creada sin auto_vacuum lo conserva hasta el comando de mantenimiento
+        self.engine.reset()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        apply_migrations(conn)
+        conn.close()
+        self.assertEqual(self.query("PRAGMA auto_vacuum")[0][0], 0)
+        self.insert("2025-12-10 10:00:00", count=50, size=4000)
+        archive_messages(self.engine, max_age_days=30)
+        self.assertEqual(release_free_pages(self.engine), 0)
+
+        self.engine.reset()
+        with contextlib.redirect_stdout(io.StringIO()):
+            compaction.main([self.path])
+        self.assertEqual(self.query("PRAGMA auto_vacuum")[0][0], AUTO_VACUUM_INCREMENTAL)
+
+    def test_historial_combina_archivo_y_pendientes(self):
+        # El primero queda pendiente con un id menor que los archivados
+        now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        with self.engine.write() as conn:
+            conn.execute(
+                "INSERT INTO messages (sender, receiver, message, is_delivered, timestamp) VALUES (?, ?, ?, 0, ?)",
+                ("irene", "julio", "Mensaje 0", now)
+            )
+            conn.executemany(
+                "INSERT INTO messages (sender, receiver, message, is_delivered, timestamp) VALUES (?, ?, ?, 1, ?)",
+                [("julio", "irene", f"Mensaje {i}", now) for i in range(1, 7)]
+            )
+        before = self.history("irene", "julio")
+
+        result = MessageCompactor(self.engine).run(max_age_days=30, now=time.time() + 40 * 86400)
+        self.assertEqual(sum(result["archived"].values()), 6)
+        self.assertEqual(self.query("SELECT message FROM messages"), [("Mensaje 0",)])
+
+        self.assertEqual(self.history("julio", "irene"), before)
+        pages = []
+        page = self.history("irene", "julio", limit=3)
+        while page:
+            pages.insert(0, [m["message"] for m in page])
+            page = self.history("irene", "julio", before_id=page[0]["id"], limit=3)
+        self.assertEqual(pages, [["Mensaje 0"], ["Mensaje 1", "Mensaje 2", "Mensaje 3"],
+                                 ["Mensaje 4", "Mensaje 5", "Mensaje 6"]])
+
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        init_db()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.processes = start_prefork(2, writer_socket=os.path.join(directory, "writer.sock"), port=8100)
+        self.pool = ConnectionPool("127.0.0.1", 8100)
+        for _ in range(100):
+            try:
+                self.pool.request({"action": "obtener_usuarios"})
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        self.pool.close()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+    def test_trabajadores_comparten_la_base(self):
+        pools = [ConnectionPool("127.0.0.1", 8100) for _ in range(8)]
+        try:
+            for i, pool in enumerate(pools):
+                response = pool.request({"action": "guardar_usuario", "username": f"pf{i}", "password_hash": "h"})
+                self.assertEqual(response["status"], "success")
+            # Cada conexión puede caer en otro proceso: todas ven lo escrito
+            for pool in pools:
+                self.assertEqual(pool.request({"action": "obtener_usuario", "username": "pf7"})["status"], "success")
+            pools[0].request({"action": "save_message", "sender": "pf0", "receiver": "pf1", "message": "Hola"})
+            for pool in pools:
+                history = pool.request({"action": "get_conversation_history", "user1": "pf1", "user2": "pf0"})
+                self.assertEqual([m["message"] for m in history["messages"]], ["Hola"])
+            pending = pools[3].request({"action": "get_pending_messages", "receiver": "pf1"})["messages"]
+            self.assertEqual(len(pending), 1)
+        finally:
+            for pool in pools:
+                pool.close()
+
+    def test_usuario_registrado_tras_consultarlo(self):
+        # Consulta, registro y consulta por la misma conexión (mismo trabajador)
+        self.assertEqual(self.pool.request({"action": "obtener_usuario", "username": "nuevo"})["status"], "error")
+        self.pool.request({"action": "guardar_usuario", "username": "nuevo", "password_hash": "h"})
+        self.assertEqual(self.pool.request({"action": "obtener_usuario", "username": "nuevo"})["status"], "success")
+
+class TestPreforkMemoria(unittest.TestCase):
+    def test_el_escritor_atiende_todo(self):
+        # El motor en memoria vive en el escritor: los trabajadores le reenvían cada acción
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        processes = start_prefork(2, writer_socket=os.path.join(directory, "writer.sock"), port=8101,
+                                  backend="memory")
+        pools = []
+        try:
+            for _ in range(4):
+                pool = ConnectionPool("127.0.0.1", 8101)
+                pools.append(pool)
+                for _ in range(100):
+                    try:
+                        pool.request({"action": "obtener_usuarios"})
+                        break
+                    except OSError:
+                        time.sleep(0.05)
+            pools[0].request({"action": "guardar_usuario", "username": "efimero", "password_hash": "h"})
+            for pool in pools:
+                self.assertEqual(pool.request({"action": "obtener_usuario", "username": "efimero"})["status"],
+                                 "success")
+        finally:
+            for pool in pools:
+                pool.close()
+            for process in processes:
+                process.terminate()
+                process.join()
+
+class TestLRUCache(unittest.TestCase):
+    def test_expulsa_el_menos_usado(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expiracion(self):
+        cache = LRUCache(10, ttl=60, negative_ttl=0.01)
+        cache.set("existe", {"x": 1})
+        cache.set("no_existe", None)
+        self.assertIsNone(cache.get("no_existe"))
+        time.sleep(0.02)
+        self.assertIs(cache.get("no_existe"), MISSING)
+        self.assertEqual(cache.get("existe"), {"x": 1})
+
 if __name__ == "__main__":
     unittest.main()
@@ -4,64 +4,283 @@ import time
 import socket
 import os
 import json
-from servicioMensajeria.main import MessagingService
+import tempfile
+from servicioMensajeria.main import MessagingService, PENDING_PAGE_SIZE
+from servicioMensajeria.async_service import AsyncMessagingService
+from servicioMensajeria.sharding import HashRing, MessagingRouter, ShardedMessagingService
+from servicioMensajeria.broadcast import NewUserBroadcaster, MAX_USERS_PER_LINE
+from servicioMensajeria.connection import ClientConnection, LineReader, LineTooLong, OVERFLOW_DISCONNECT, OVERFLOW_DROP, OVERFLOW_SPILL
 from servicioAutenticacion.main import iniciar_servidor as iniciar_autenticacion
 from servicioAlmacenamiento.main import start_server as iniciar_almacenamiento
-from servicioAlmacenamiento.database import init_db, DB_NAME
+from comun.tokens import issue_token
+from comun.protocol import FrameReader, send_frame
+from comun.tracing import configure_tracing, flush_traces, stop_tracing
+import benchmark
+import trace_report
 
-class IntegrationTestMessagingService(unittest.TestCase):
-    @classmethod
-    def setUpClass(cls):
-        # Limpiar la base de datos antes de iniciar las pruebas
-        if os.path.exists(DB_NAME):
-            os.remove(DB_NAME)
-        init_db()
+# Clave compartida por autenticación y mensajería en las pruebas
+SESSION_KEY = 'clave-de-pruebas'
 
-        # Iniciar el servicio de almacenamiento en un hilo
-        cls.almacenamiento_thread = threading.Thread(target=iniciar_almacenamiento, daemon=True)
-        cls.almacenamiento_thread.start()
+_backend_started = False
 
-        time.sleep(1)
+def start_backend_services():
+    """Inicia almacenamiento y autenticación una sola vez para todas las clases de prueba."""
+    global _backend_started
+    if _backend_started:
+        return
+    _backend_started = True
 
-        # Iniciar el servicio de autenticación en un hilo
-        cls.autenticacion_thread = threading.Thread(target=iniciar_autenticacion, args=('127.0.0.1', 7000), daemon=True)
-        cls.autenticacion_thread.start()
+    # Iniciar el servicio de almacenamiento en un hilo, con el motor en
+    # memoria: las pruebas no tocan la base del servicio
+    threading.Thread(target=iniciar_almacenamiento, kwargs={'backend': 'memory'}, daemon=True).start()
 
-        time.sleep(1)
+    time.sleep(1)
+
+    # Iniciar el servicio de autenticación en un hilo
+    threading.Thread(
+        target=iniciar_autenticacion, args=('127.0.0.1', 7000), kwargs={'clave_sesion': SESSION_KEY}, daemon=True
+    ).start()
+
+    time.sleep(1)
+
+class IntegrationTestMessagingService(unittest.TestCase):
+    service_class = MessagingService
+    messaging_port = 5001
+    user_prefix = 'user'
+    # Contraseñas de los usuarios registrados, para iniciar sesión y obtener su token
+    passwords = {}
+
+    @classmethod
+    def setUpClass(cls):
+        start_backend_services()
 
         # Iniciar el servicio de mensajería en un hilo
-        cls.messaging_service = MessagingService(
-            host='127.0.0.1', port=5001,
+        cls.messaging_service = cls.service_class(
+            host='127.0.0.1', port=cls.messaging_port,
             auth_host='127.0.0.1', auth_port=7000,
-            storage_host='127.0.0.1', storage_port=8000
+            storage_host='127.0.0.1', storage_port=8000,
+            session_key=SESSION_KEY
         )
         cls.messaging_thread = threading.Thread(target=cls.messaging_service.start, daemon=True)
         cls.messaging_thread.start()
 
         time.sleep(1)
 
+    def user(self, suffix):
+        return f"{self.user_prefix}{suffix}"
+
     def test_message_flow(self):
         # Registrar usuarios necesarios
-        self.register_user('user1', 'password1')
-        self.register_user('user2', 'password2')
+        self.register_user(self.user('1'), 'password1')
+        self.register_user(self.user('2'), 'password2')
 
         # Iniciar dos clientes simulando user1 y user2
-        user1_socket = self.connect_and_authenticate('user1')
-        user2_socket = self.connect_and_authenticate('user2')
+        user1_socket = self.connect_and_authenticate(self.user('1'))
+        user2_socket = self.connect_and_authenticate(self.user('2'))
 
         # user1 envía un mensaje a user2
-        message = 'Hola, user2!'
-        self.send_message(user1_socket, 'user2', message)
+        message = f"Hola, {self.user('2')}!"
+        self.send_message(user1_socket, self.user('2'), message)
 
         # Verificar que user2 recibe el mensaje
         received_message = self.receive_message(user2_socket)
-        expected_message = f"user1 dice: {message}"
+        expected_message = f"{self.user('1')} dice: {message}"
         self.assertEqual(received_message.strip(), expected_message)
 
         # Cerrar las conexiones de los clientes
         user1_socket.close()
         user2_socket.close()
 
+    def test_auth_requires_valid_token(self):
+        self.register_user(self.user('t1'), 'passwordt1')
+        # Sin legacy_auth no alcanza con el nombre, ni con un token firmado con otra clave
+        for credential in (self.user('t1'), issue_token('otra-clave', self.user('t1')),
+                           issue_token(SESSION_KEY, self.user('t1'), ttl=-1)):
+            sock = socket.create_connection(('127.0.0.1', self.messaging_port))
+            sock.sendall(f"AUTH|{credential}\n".encode())
+            lines = self.read_until(sock, 'Error: Autenticación fallida')
+            self.assertEqual(lines[-1], 'Error: Autenticación fallida')
+            sock.close()
+
+    def test_history_pagination(self):
+        self.register_user(self.user('3'), 'password3')
+        self.register_user(self.user('4'), 'password4')
+        user3_socket = self.connect_and_authenticate(self.user('3'))
+        for i in range(5):
+            self.send_message(user3_socket, self.user('4'), f'Mensaje {i}')
+
+        user3_socket.sendall(f"GET_HISTORY|{self.user('4')}||3\n".encode())
+        lines = self.read_until(user3_socket, 'HISTORY_END|')
+        history = [line.split('|') for line in lines if line.startswith('HISTORY|')]
+        self.assertEqual([h[3] for h in history], ['Mensaje 2', 'Mensaje 3', 'Mensaje 4'])
+        end = lines[-1].split('|')
+        self.assertEqual(end[1:], [self.user('4'), history[0][1], '1'])
+
+        user3_socket.sendall(f"GET_HISTORY|{self.user('4')}|{end[2]}|3\n".encode())
+        lines = self.read_until(user3_socket, 'HISTORY_END|')
+        history = [line.split('|') for line in lines if line.startswith('HISTORY|')]
+        self.assertEqual([h[3] for h in history], ['Mensaje 0', 'Mensaje 1'])
+        self.assertTrue(lines[-1].endswith('|0'))
+        user3_socket.close()
+
+    def test_pipelined_commands(self):
+        self.register_user(self.user('6'), 'password6')
+        self.register_user(self.user('7'), 'password7')
+        user7_socket = self.connect_and_authenticate(self.user('7'))
+
+        # AUTH, SEND y SEND_BATCH en una sola escritura, con un mensaje de más de 1 KB
+        long_message = 'x' * 4000
+        user6_socket = socket.create_connection(('127.0.0.1', self.messaging_port))
+        user6_socket.sendall((
+            f"AUTH|{self.login(self.user('6'))}\n"
+            f"SEND|{self.user('7')}|{long_message}\n"
+            f"SEND_BATCH|{self.user('7')}|uno|nadie|perdido|{self.user('7')}|dos\n"
+        ).encode())
+        lines = self.read_until(user6_socket, 'Mensajes procesados|')
+        self.assertIn('Mensaje procesado', lines)
+        self.assertEqual(lines[-1], 'Mensajes procesados|2|1')
+
+        expected = [f"{self.user('6')} dice: {content}" for content in (long_message, 'uno', 'dos')]
+        lines = self.read_until(user7_socket, expected[-1])
+        self.assertEqual([line for line in lines if ' dice: ' in line], expected)
+        user6_socket.close()
+        user7_socket.close()
+
+    def test_offline_delivery(self):
+        self.register_user(self.user('8'), 'password8')
+        self.register_user(self.user('9'), 'password9')
+        user8_socket = self.connect_and_authenticate(self.user('8'))
+        # Más mensajes que PENDING_PAGE_SIZE para que la entrega use varios bloques
+        contents = [f"Pendiente {i}" for i in range(PENDING_PAGE_SIZE + 20)]
+        batch = '|'.join(f"{self.user('9')}|{content}" for content in contents)
+        user8_socket.sendall(f"SEND_BATCH|{batch}\n".encode())
+        self.assertEqual(self.read_until(user8_socket, 'Mensajes procesados|')[-1],
+                         f"Mensajes procesados|{len(contents)}|0")
+
+        # Los pendientes llegan antes que la respuesta al GET_USERS encadenado
+        user9_socket = self.connect_and_authenticate(self.user('9'), read_reply=False)
+        lines = self.read_until(user9_socket, 'USER_LIST|')
+        expected = [f"{self.user('8')} dice: {content}" for content in contents]
+        self.assertEqual([line for line in lines if ' dice: ' in line], expected)
+        user9_socket.close()
+
+        # Los bloques ya escritos se confirmaron: una reconexión no los repite
+        user9_socket = self.connect_and_authenticate(self.user('9'), read_reply=False)
+        lines = self.read_until(user9_socket, 'USER_LIST|')
+        self.assertEqual([line for line in lines if ' dice: ' in line], [])
+        user8_socket.close()
+        user9_socket.close()
+
+    def test_stats_and_log_config_on_notification_port(self):
+        self.register_user(self.user('s1'), 'passwords1')
+        sock = self.connect_and_authenticate(self.user('s1'))
+        self.send_message(sock, self.user('s1'), 'Hola')
+        sock.close()
+        with socket.create_connection(('127.0.0.1', self.messaging_port + 1), timeout=5) as conn:
+            send_frame(conn, {'action': 'stats'})
+            response = FrameReader(conn).read()
+            # El nivel de log se cambia en caliente por el mismo puerto
+            send_frame(conn, {'action': 'log_config', 'level': 'INFO', 'sample_rate': 0.5})
+            config = FrameReader(conn).read()
+        self.assertEqual((config['level'], config['sample_rate']), ('INFO', 0.5))
+        with socket.create_connection(('127.0.0.1', self.messaging_port + 1), timeout=5) as conn:
+            send_frame(conn, {'action': 'log_config', 'sample_rate': 1})
+            FrameReader(conn).read()
+        self.assertEqual(response['status'], 'success')
+        # Servicios y pruebas comparten el proceso, y con él el registro de métricas
+        for metric in ('messaging_command_seconds_count{command="SEND"}', 'messaging_connected_clients',
+                       'storage_request_seconds_count{action="registrar_usuario_atomic"}',
+                       'auth_request_seconds_count{action="registrar_usuario"}'):
+            self.assertIn(metric, response['metrics'])
+
+    def test_benchmark_delivers_everything(self):
+        config = benchmark.parse_args([
+            '--clients', '4', '--messages', '5', '--sizes', '16,2048', '--offline-users', '2',
+            '--offline-ratio', '0.4', '--storage-requests', '10', '--timeout', '10',
+            '--messaging-port', str(self.messaging_port), '--prefix', self.user('bench'),
+        ])
+        result = benchmark.run_benchmark(config)
+        self.assertEqual(result['delivery']['online']['expected'], 12)
+        self.assertEqual(result['delivery']['offline']['expected'], 8)
+        for delivery in result['delivery'].values():
+            self.assertEqual(delivery['completeness'], 1.0)
+            self.assertEqual(delivery['duplicates'], 0)
+        for operation in ('auth_login', 'storage_get_user', 'messaging_send_2048b', 'deliver_online'):
+            self.assertEqual(result['operations'][operation]['errors'], 0)
+            self.assertLessEqual(result['operations'][operation]['p50_ms'], result['operations'][operation]['p99_ms'])
+        json.dumps(result)
+
+    def test_traces_follow_every_hop(self):
+        path = os.path.join(tempfile.mkdtemp(), 'trazas.jsonl')
+        configure_tracing(path, sample_rate=1)
+        self.addCleanup(stop_tracing)
+        self.register_user(self.user('tr1'), 'clave')
+        self.register_user(self.user('tr2'), 'clave')
+        # El GET_USERS encadenado al AUTH pasa por autenticación y de ahí a almacenamiento
+        sock = self.connect_and_authenticate(self.user('tr1'))
+        # tr2 no está conectado: el mensaje se guarda como pendiente
+        self.send_message(sock, self.user('tr2'), 'Trazado')
+        sock.close()
+
+        # El span raíz se escribe después de responder al cliente
+        deadline = time.monotonic() + 5
+        while True:
+            flush_traces()
+            roots = trace_report.build_traces(trace_report.load_spans(path))
+            commands = {root.record['name']: root for root in roots.values()}
+            if {'AUTH', 'GET_USERS', 'SEND'} <= commands.keys() or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+
+        def hops(root):
+            return [(node.record['service'], node.record['name'], node.record.get('peer'))
+                    for _, node, _ in trace_report.critical_path(root)]
+
+        self.assertEqual(hops(commands['GET_USERS']), [
+            ('mensajeria', 'GET_USERS', None),
+            ('mensajeria', 'obtener_usuarios', '127.0.0.1:7000'),
+            ('autenticacion', 'obtener_usuarios', None),
+            ('autenticacion', 'obtener_usuarios', '127.0.0.1:8000'),
+            ('almacenamiento', 'obtener_usuarios', None),
+        ])
+        self.assertIn(('almacenamiento', 'save_message', None), hops(commands['SEND']))
+        self.assertEqual(commands['SEND'].record['user'], self.user('tr1'))
+
+    def test_user_directory(self):
+        self.register_user(self.user('5'), 'password5')
+        # La notificación de nuevo usuario llega de forma asíncrona
+        for _ in range(50):
+            if self.user('5') in self.messaging_service.known_users:
+                break
+            time.sleep(0.05)
+        self.assertIn(self.user('5'), self.messaging_service.known_users)
+
+        remote_calls = []
+        original = self.messaging_service.validate_user_remote
+        self.messaging_service.validate_user_remote = lambda username: remote_calls.append(username) or False
+        try:
+            self.assertTrue(self.messaging_service.validate_user(self.user('5')))
+            self.assertFalse(self.messaging_service.validate_user('nadie'))
+        finally:
+            self.messaging_service.validate_user_remote = original
+        self.assertEqual(remote_calls, ['nadie'])
+
+    def read_until(self, sock, prefix):
+        # Leer líneas hasta recibir una que empiece con el prefijo indicado; lo
+        # que llegue después queda guardado para la siguiente lectura
+        buffers = self.__dict__.setdefault('buffers', {})
+        data = buffers.pop(sock, '')
+        while True:
+            lines = data.split('\n')
+            for i, line in enumerate(lines[:-1]):
+                if line.startswith(prefix):
+                    buffers[sock] = '\n'.join(lines[i + 1:])
+                    return [line for line in lines[:i + 1] if line]
+            chunk = sock.recv(65536).decode()
+            if not chunk:
+                self.fail(f"Conexión cerrada antes de recibir {prefix}")
+            data += chunk
+
     def register_user(self, username, password):
         # Conectarse al servicio de autenticación para registrar un usuario
         try:
@@ -75,36 +294,229 @@ class IntegrationTestMessagingService(unittest.TestCase):
                 self.assertEqual(response['status'], 'success')
         except Exception as e:
             self.fail(f"Error al registrar el usuario {username}: {e}")
+        self.passwords[username] = password
+
+    def login(self, username):
+        # Iniciar sesión en el servicio de autenticación y devolver el token de sesión
+        with socket.create_connection(('127.0.0.1', 7000)) as sock:
+            sock.sendall(json.dumps({
+                'action': 'iniciar_sesion',
+                'username': username,
+                'password': self.passwords[username]
+            }).encode())
+            response = json.loads(sock.recv(1024).decode())
+        self.assertEqual(response['status'], 'success')
+        return response['token']
 
-    def connect_and_authenticate(self, username):
+    def connect_and_authenticate(self, username, read_reply=True):
         # Conectarse al servicio de mensajería y autenticarse
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('127.0.0.1', 5001))
+        sock.connect(('127.0.0.1', self.messaging_port))
 
         # Recibir el mensaje de autenticación
         auth_prompt = sock.recv(1024).decode()
         self.assertIn('Por favor, autentíquese', auth_prompt)
 
         # Enviar credenciales
-        sock.sendall(f"AUTH|{username}\n".encode())
+        # Encadenar un GET_USERS con el AUTH: su respuesta confirma que el
+        # servidor ya registró la conexión
+        sock.sendall(f"AUTH|{self.login(username)}\nGET_USERS\n".encode())
+        if read_reply:
+            self.read_until(sock, 'USER_LIST|')
         return sock
 
     def send_message(self, sock, recipient, content):
         # Enviar un mensaje en formato: SEND|<recipient>|<content>
         sock.sendall(f"SEND|{recipient}|{content}\n".encode())
         # Recibir confirmación
-        response = sock.recv(1024).decode()
-        self.assertIn('Mensaje procesado', response)
+        self.read_until(sock, 'Mensaje procesado')
 
     def receive_message(self, sock):
-        # Recibir un mensaje del socket
-        data = sock.recv(1024).decode()
-        return data
+        # Recibir un mensaje del socket, ignorando los avisos de usuarios nuevos
+        while True:
+            line = self.read_until(sock, '')[-1]
+            if not line.startswith('NEW_USER|'):
+                return line
 
     @classmethod
     def tearDownClass(cls):
         # Detener los servicios si es necesario (los hilos daemon terminarán con el programa)
         pass
 
+class AsyncIntegrationTestMessagingService(IntegrationTestMessagingService):
+    """Las mismas pruebas contra el servidor asyncio."""
+    service_class = AsyncMessagingService
+    messaging_port = 5011
+    user_prefix = 'async_user'
+
+    @unittest.skip("El servicio de autenticación notifica los registros solo al puerto 5002")
+    def test_user_directory(self):
+        pass
+
+class ShardedIntegrationTestMessagingService(IntegrationTestMessagingService):
+    """Las mismas pruebas a través del enrutador, con dos shards."""
+    messaging_port = 5021
+    user_prefix = 'shard_user'
+    shards = 2
+
+    @classmethod
+    def setUpClass(cls):
+        start_backend_services()
+        socket_dir = tempfile.mkdtemp(prefix='mensajeria-')
+        cls.shard_services = [
+            ShardedMessagingService(shard, cls.shards, socket_dir,
+                                    auth_host='127.0.0.1', auth_port=7000,
+                                    storage_host='127.0.0.1', storage_port=8000,
+                                    session_key=SESSION_KEY)
+            for shard in range(cls.shards)
+        ]
+        for service in cls.shard_services:
+            threading.Thread(target=service.start, daemon=True).start()
+        time.sleep(0.5)
+        router = MessagingRouter('127.0.0.1', cls.messaging_port, cls.shards, socket_dir, session_key=SESSION_KEY)
+        threading.Thread(target=router.start, daemon=True).start()
+        time.sleep(0.5)
+
+    def test_cross_shard_delivery(self):
+        ring = HashRing(self.shards)
+        candidates = [self.user(f"x{i}") for i in range(50)]
+        sender = candidates[0]
+        recipient = next(u for u in candidates if ring.shard_for(u) != ring.shard_for(sender))
+        self.register_user(sender, 'clave')
+        self.register_user(recipient, 'clave')
+
+        sender_socket = self.connect_and_authenticate(sender)
+        recipient_socket = self.connect_and_authenticate(recipient)
+        self.send_message(sender_socket, recipient, 'Entre shards')
+        self.assertEqual(self.receive_message(recipient_socket), f"{sender} dice: Entre shards")
+        self.assertIn(recipient, self.shard_services[ring.shard_for(recipient)].connected_clients)
+        self.assertNotIn(recipient, self.shard_services[ring.shard_for(sender)].connected_clients)
+        recipient_socket.close()
+        sender_socket.close()
+
+    @unittest.skip("El servicio de autenticación notifica los registros solo al puerto 5002")
+    def test_user_directory(self):
+        pass
+
+class TestResolveCredential(unittest.TestCase):
+    def test_token_sin_consultar_autenticacion(self):
+        service = MessagingService(auth_port=1, session_key=SESSION_KEY)
+        self.assertEqual(service.resolve_credential(issue_token(SESSION_KEY, 'ana')), 'ana')
+        # Sin legacy_auth el nombre solo no autentica (y no se consulta al puerto 1)
+        self.assertIsNone(service.resolve_credential('ana'))
+
+    def test_modo_heredado(self):
+        self.assertTrue(MessagingService().legacy_auth)
+        self.assertFalse(MessagingService(session_key=SESSION_KEY).legacy_auth)
+        self.assertTrue(MessagingService(session_key=SESSION_KEY, legacy_auth=True).legacy_auth)
+
+class TestHashRing(unittest.TestCase):
+    def test_reparto_estable(self):
+        users = [f"usuario{i}" for i in range(2000)]
+        ring = HashRing(4)
+        counts = [0] * 4
+        for user in users:
+            counts[ring.shard_for(user)] += 1
+        self.assertTrue(all(300 < count < 700 for count in counts), counts)
+
+        # Al agregar un shard solo se mueven los usuarios que pasan al nuevo
+        bigger = HashRing(5)
+        moved = [user for user in users if ring.shard_for(user) != bigger.shard_for(user)]
+        self.assertTrue(all(bigger.shard_for(user) == 4 for user in moved))
+        self.assertLess(len(moved), len(users) // 3)
+
+class TestClientConnection(unittest.TestCase):
+    """Cola de salida por cliente con un destinatario que no lee."""
+
+    def slow_client(self, policy):
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(client_side.close)
+        self.spilled = []
+        connection = ClientConnection(
+            'lento', server_side, max_queue=2, overflow_policy=policy,
+            on_spill=lambda *message: self.spilled.append(message)
+        )
+        # Una línea grande deja al escritor bloqueado en sendall
+        connection.send('x' * (8 * 1024 * 1024))
+        time.sleep(0.2)
+        return connection, client_side
+
+    def fill(self, connection, count):
+        return [connection.send(f"m{i}\n", ('otro', 'lento', f"m{i}")) for i in range(count)]
+
+    def test_spill_stores_overflow(self):
+        connection, _ = self.slow_client(OVERFLOW_SPILL)
+        results = self.fill(connection, 5)
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual(self.spilled, [('otro', 'lento', 'm2'), ('otro', 'lento', 'm3'), ('otro', 'lento', 'm4')])
+        connection.close()
+
+    def test_drop_discards_overflow(self):
+        connection, _ = self.slow_client(OVERFLOW_DROP)
+        self.fill(connection, 5)
+        self.assertEqual(connection.dropped, 3)
+        self.assertEqual(self.spilled, [])
+        connection.close()
+
+    def test_disconnect_closes_slow_client(self):
+        connection, client_side = self.slow_client(OVERFLOW_DISCONNECT)
+        self.fill(connection, 3)
+        self.assertTrue(connection.closed)
+        connection.writer.join(2)
+        self.assertFalse(connection.writer.is_alive())
+
+class TestLineReader(unittest.TestCase):
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.addCleanup(self.server_side.close)
+        self.addCleanup(self.client_side.close)
+
+    def test_split_and_coalesced_lines(self):
+        reader = LineReader(self.server_side)
+        self.client_side.sendall(b"SEND|a|hola\nGET_USERS\r\n\nSEND|b|ma")
+        self.assertEqual(reader.readline(), "SEND|a|hola")
+        self.assertEqual(reader.readline(), "GET_USERS")
+        self.client_side.sendall("ñana\n".encode())
+        self.assertEqual(reader.readline(), "SEND|b|mañana")
+        self.client_side.close()
+        self.assertIsNone(reader.readline())
+
+    def test_line_too_long(self):
+        reader = LineReader(self.server_side, max_line=16)
+        self.client_side.sendall(b"SEND|a|" + b"x" * 32)
+        with self.assertRaises(LineTooLong):
+            reader.readline()
+
+class RecordingClient:
+    def __init__(self):
+        self.lines = []
+
+    def send(self, text, message=None):
+        self.lines.append(text)
+        return True
+
+class TestNewUserBroadcaster(unittest.TestCase):
+    def test_registrations_are_coalesced(self):
+        clients = [RecordingClient(), RecordingClient()]
+        broadcaster = NewUserBroadcaster(lambda: clients, window=0.1)
+        for i in range(31):
+            broadcaster.publish(f"nuevo{i}")
+        broadcaster.publish("nuevo0")
+        time.sleep(0.3)
+        expected = "NEW_USER|" + "|".join(f"nuevo{i}" for i in range(31)) + "\n"
+        for client in clients:
+            self.assertEqual(client.lines, [expected])
+        self.assertEqual(broadcaster.batches, 1)
+
+    def test_large_batches_are_split_into_lines(self):
+        client = RecordingClient()
+        broadcaster = NewUserBroadcaster(lambda: [client], window=0.1)
+        for i in range(MAX_USERS_PER_LINE + 1):
+            broadcaster.publish(f"u{i}")
+        time.sleep(0.3)
+        lines = ''.join(client.lines).splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1], f"NEW_USER|u{MAX_USERS_PER_LINE}")
+
 if __name__ == '__main__':
     unittest.main()
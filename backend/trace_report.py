@@ -0,0 +1,145 @@
+"""
+Reconstruye el camino crítico de las solicitudes más lentas a partir del
+archivo de trazas que escriben los servicios (python main.py
+trace_file=trazas.jsonl, o TRACE_FILE=trazas.jsonl).
+
+Cada comando de cliente es una traza. Desde su span raíz, el camino crítico
+baja por los spans hijos que determinan cuándo termina cada span; el tiempo
+propio de un tramo es el que no pasó esperando a esos hijos (en un span de
+cliente, la red, la espera por una conexión del pool y la serialización):
+
+    python trace_report.py trazas.jsonl --top 5 --command SEND
+"""
+import argparse
+import json
+import time
+from collections import Counter, defaultdict
+
+# Tolerancia (segundos) al comparar el fin de spans medidos en procesos distintos
+CLOCK_SLACK = 0.0005
+
+class SpanNode:
+    """Un span de la traza con sus hijos."""
+
+    def __init__(self, record):
+        self.record = record
+        self.children = []
+
+    @property
+    def start(self):
+        return self.record["start"]
+
+    @property
+    def duration_ms(self):
+        return self.record["duration_ms"]
+
+    @property
+    def end(self):
+        return self.start + self.duration_ms / 1000
+
+    def describe(self):
+        text = f"{self.record.get('service', '?')} {self.record.get('name', '?')}"
+        if self.record.get("peer"):
+            text += f" -> {self.record['peer']}"
+        if self.record.get("error"):
+            text += f" [{self.record['error']}]"
+        return text
+
+def load_spans(path):
+    """Spans del archivo; omite las líneas incompletas (un proceso que terminó a mitad de escritura)."""
+    spans = []
+    with open(path, encoding="utf-8") as lines:
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and {"trace_id", "span_id", "start", "duration_ms"} <= record.keys():
+                spans.append(record)
+    return spans
+
+def build_traces(spans):
+    """Raíces de cada traza (spans sin padre) con sus hijos enlazados, por id de traza."""
+    by_trace = defaultdict(list)
+    for record in spans:
+        by_trace[record["trace_id"]].append(SpanNode(record))
+    roots = {}
+    for trace_id, nodes in by_trace.items():
+        by_id = {node.record["span_id"]: node for node in nodes}
+        for node in nodes:
+            parent = by_id.get(node.record.get("parent_id"))
+            if parent is not None:
+                parent.children.append(node)
+        for node in nodes:
+            if node.record.get("parent_id") is None:
+                roots[trace_id] = node
+    return roots
+
+def critical_children(node):
+    """
+    Hijos de `node` en su camino crítico: el que termina último y, hacia
+    atrás, el que termina último antes de que empiece el ya elegido. Si
+    los hijos se ejecutaron uno tras otro son todos; si fueron en paralelo,
+    solo el que marcó el final.
+    """
+    path = []
+    limit = None
+    for child in sorted(node.children, key=lambda child: child.end, reverse=True):
+        if limit is None or child.end <= limit + CLOCK_SLACK:
+            path.append(child)
+            limit = child.start
+    return path[::-1]
+
+def critical_path(root):
+    """Lista de (profundidad, span, tiempo propio en ms) a lo largo del camino crítico."""
+    path = []
+
+    def visit(node, depth):
+        children = critical_children(node)
+        own = max(node.duration_ms - sum(child.duration_ms for child in children), 0.0)
+        path.append((depth, node, own))
+        for child in children:
+            visit(child, depth + 1)
+
+    visit(root, 0)
+    return path
+
+def slowest(roots, top, command=None):
+    """Las `top` trazas más lentas, opcionalmente solo las del comando `command`."""
+    candidates = [root for root in roots.values() if command is None or root.record.get("name") == command]
+    return sorted(candidates, key=lambda root: root.duration_ms, reverse=True)[:top]
+
+def print_report(roots, top=10, command=None):
+    selected = slowest(roots, top, command)
+    if not selected:
+        print("No hay trazas completas en el archivo.")
+        return
+    own_by_hop = Counter()
+    for root in selected:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(root.start))
+        user = f", usuario {root.record['user']}" if root.record.get("user") else ""
+        print(f"\n--- {root.record.get('name')} {root.duration_ms:.2f} ms "
+              f"(traza {root.record['trace_id']}{user}, {when}) ---")
+        print(f"{'total ms':>10} {'propio ms':>10}  tramo")
+        for depth, node, own in critical_path(root):
+            own_by_hop[node.describe()] += own
+            print(f"{node.duration_ms:10.2f} {own:10.2f}  {'  ' * depth}{node.describe()}")
+
+    total = sum(own_by_hop.values()) or 1.0
+    print(f"\n--- Tiempo propio en los caminos críticos ({len(selected)} trazas) ---")
+    for hop, own in own_by_hop.most_common():
+        print(f"{own:10.2f} ms {own / total:7.1%}  {hop}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace_file", help="archivo de trazas (JSON por línea)")
+    parser.add_argument("--top", type=int, default=10, help="trazas más lentas que se muestran")
+    parser.add_argument("--command", help="solo las trazas de este comando (SEND, GET_HISTORY...)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    config = parse_args(argv)
+    print_report(build_traces(load_spans(config.trace_file)), config.top, config.command)
+
+if __name__ == "__main__":
+    main()
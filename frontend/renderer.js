@@ -1,9 +1,18 @@
 const net = require('net');
 
 let currentUser = null;
+// Token de sesión firmado por el servicio de autenticación, para el AUTH de mensajería
+let sessionToken = null;
 let currentRecipient = null;
 let contacts = [];
 
+// Estado del historial paginado de la conversación abierta
+const historyPageSize = 50;
+let historyOldestId = null;
+let historyHasMore = false;
+let historyLoading = false;
+let historyBatch = [];
+
 const authHost = '127.0.0.1';
 const authPort = 7000;
 const messagingHost = '127.0.0.1';
@@ -29,6 +38,12 @@ let messagingSocket = null;
 loginBtn.addEventListener('click', login);
 registerBtn.addEventListener('click', register);
 sendBtn.addEventListener('click', enviarMensaje);
+messagesDiv.addEventListener('scroll', () => {
+	// Cargar la página anterior al llegar al inicio de la conversación
+	if (messagesDiv.scrollTop === 0 && historyHasMore && !historyLoading) {
+		obtenerHistorialConversacion(currentRecipient, historyOldestId);
+	}
+});
 
 function login() {
 	const username = usernameInput.value.trim();
@@ -39,11 +54,12 @@ function login() {
 		return;
 	}
 
-	iniciarSesion(username, password, (err) => {
+	iniciarSesion(username, password, (err, token) => {
 		if (err) {
 			loginError.innerText = err;
 		} else {
 			currentUser = username;
+			sessionToken = token;
 			iniciarChat();
 		}
 	});
@@ -60,12 +76,46 @@ function seleccionarContacto(contact) {
 		}
 	});
 	messagesDiv.innerHTML = '';
-	obtenerHistorialConversacion(contact);
+	historyOldestId = null;
+	historyHasMore = false;
+	historyBatch = [];
+	obtenerHistorialConversacion(contact, null);
 }
 
-function obtenerHistorialConversacion(contact) {
+function obtenerHistorialConversacion(contact, beforeId) {
 	if (messagingSocket && messagingSocket.writable) {
-		messagingSocket.write(`GET_HISTORY|${contact}\n`);
+		historyLoading = true;
+		messagingSocket.write(`GET_HISTORY|${contact}|${beforeId || ''}|${historyPageSize}\n`);
+	}
+}
+
+function mostrarPaginaHistorial(contact, oldestId, hasMore) {
+	const batch = historyBatch;
+	historyBatch = [];
+	historyLoading = false;
+	if (contact !== currentRecipient) {
+		// Respuesta de una conversación que ya no está abierta
+		return;
+	}
+	const firstPage = historyOldestId === null;
+	if (oldestId) {
+		historyOldestId = oldestId;
+	}
+	historyHasMore = hasMore;
+
+	const fragment = document.createDocumentFragment();
+	batch.forEach(texto => {
+		const msgElement = document.createElement('p');
+		msgElement.innerText = texto;
+		fragment.appendChild(msgElement);
+	});
+	const previousHeight = messagesDiv.scrollHeight;
+	messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+	if (firstPage) {
+		messagesDiv.scrollTop = messagesDiv.scrollHeight;
+	} else {
+		// Mantener a la vista los mensajes que el usuario estaba leyendo
+		messagesDiv.scrollTop = messagesDiv.scrollHeight - previousHeight;
 	}
 }
 
@@ -78,11 +128,13 @@ function register() {
 		return;
 	}
 
-	registrarUsuario(username, password, (err) => {
+	// El registro deja la sesión iniciada y devuelve el token
+	registrarUsuario(username, password, (err, token) => {
 		if (err) {
 			loginError.innerText = err;
 		} else {
 			currentUser = username;
+			sessionToken = token;
 			iniciarChat();
 		}
 	});
@@ -102,7 +154,7 @@ function iniciarSesion(username, password, callback) {
 	client.on('data', (data) => {
 		const respuesta = JSON.parse(data.toString());
 		if (respuesta.status === 'success') {
-			callback(null);
+			callback(null, respuesta.token);
 		} else {
 			callback(respuesta.message);
 		}
@@ -128,7 +180,7 @@ function registrarUsuario(username, password, callback) {
 	client.on('data', (data) => {
 		const respuesta = JSON.parse(data.toString());
 		if (respuesta.status === 'success') {
-			callback(null);
+			callback(null, respuesta.token);
 		} else {
 			callback(respuesta.message);
 		}
@@ -173,29 +225,33 @@ function obtenerContactos() {
 	});
 }
 
-function actualizarListaContactos() {
-	contactList.innerHTML = '';
-	contacts.forEach(contact => {
-		const li = document.createElement('li');
-		li.innerText = contact;
-		li.addEventListener('click', () => {
-			seleccionarContacto(contact);
-		});
-		contactList.appendChild(li);
+function crearElementoContacto(contact) {
+	const li = document.createElement('li');
+	li.innerText = contact;
+	li.addEventListener('click', () => {
+		seleccionarContacto(contact);
 	});
+	return li;
 }
 
-function seleccionarContacto(contact) {
-	currentRecipient = contact;
-	const items = document.querySelectorAll('#contact-list li');
-	items.forEach(item => {
-		if (item.innerText === contact) {
-			item.classList.add('active');
-		} else {
-			item.classList.remove('active');
+function actualizarListaContactos() {
+	const fragment = document.createDocumentFragment();
+	contacts.forEach(contact => fragment.appendChild(crearElementoContacto(contact)));
+	contactList.replaceChildren(fragment);
+}
+
+// Agrega un lote de usuarios nuevos con una sola modificación del DOM
+function agregarContactos(users) {
+	const fragment = document.createDocumentFragment();
+	users.forEach(user => {
+		if (user && user !== currentUser && !contacts.includes(user)) {
+			contacts.push(user);
+			fragment.appendChild(crearElementoContacto(user));
 		}
 	});
-	messagesDiv.innerHTML = '';
+	if (fragment.childNodes.length > 0) {
+		contactList.appendChild(fragment);
+	}
 }
 
 function iniciarConexionMensajeria() {
@@ -205,51 +261,54 @@ function iniciarConexionMensajeria() {
 		console.log('Conectado al servicio de mensajería');
 	});
 
+	// El servidor puede partir una línea entre dos eventos 'data' (o juntar
+	// muchas en uno, como los bloques de pendientes): se guarda el resto
+	let buffer = '';
 	let authenticated = false;
 
+	messagingSocket.setEncoding('utf8');
 	messagingSocket.on('data', (data) => {
-		const mensajes = data.toString().trim().split('\n');
-		mensajes.forEach(mensaje => {
-			if (!authenticated) {
-				if (mensaje.includes('Por favor, autentíquese')) {
-					// Enviar credenciales
-					messagingSocket.write(`AUTH|${currentUser}\n`);
-				} else if (mensaje.includes('Error: Autenticación fallida')) {
-					console.log('Autenticación fallida en el servicio de mensajería');
-					messagingSocket.destroy();
-				} else {
-					authenticated = true;
-					console.log('Autenticado en el servicio de mensajería');
-					// Solicitar lista de usuarios
-					messagingSocket.write('GET_USERS\n');
-				}
+		buffer += data;
+		const lineas = buffer.split('\n');
+		buffer = lineas.pop();
+		lineas.forEach(mensaje => {
+			if (!mensaje) {
+				return;
+			}
+			if (!authenticated && mensaje.includes('Por favor, autentíquese')) {
+				// Enviar credenciales y pedir la lista de usuarios. El servidor no
+				// confirma el AUTH: la siguiente línea ya puede ser un mensaje
+				// pendiente, así que no se descarta.
+				authenticated = true;
+				messagingSocket.write(`AUTH|${sessionToken || currentUser}\nGET_USERS\n`);
+			} else if (mensaje.includes('Error: Autenticación fallida')) {
+				console.log('Autenticación fallida en el servicio de mensajería');
+				messagingSocket.destroy();
+			} else if (mensaje.startsWith('Error:')) {
+				console.log('Error:', mensaje);
+			} else if (mensaje === 'Mensaje procesado' || mensaje.startsWith('Mensajes procesados|')) {
+				// Mensaje (o lote SEND_BATCH) enviado correctamente
+			} else if (mensaje.startsWith('USER_LIST|')) {
+				// Recibir lista de usuarios
+				const users = mensaje.split('|').slice(1);
+				contacts = users.filter(user => user !== currentUser);
+				actualizarListaContactos();
+			} else if (mensaje.startsWith('NEW_USER|')) {
+				// Recibir lote de usuarios nuevos: NEW_USER|<usuario>[|<usuario>...]
+				agregarContactos(mensaje.split('|').slice(1));
+			} else if (mensaje.startsWith('HISTORY|')) {
+				// Acumular los mensajes de la página del historial: HISTORY|<id>|<remitente>|<mensaje>
+				const parts = mensaje.split('|');
+				const sender = parts[2];
+				const content = parts.slice(3).join('|'); // Por si el mensaje contiene '|'
+				historyBatch.push(`${sender}: ${content}`);
+			} else if (mensaje.startsWith('HISTORY_END|')) {
+				// Fin de la página: HISTORY_END|<contacto>|<id más antiguo>|<hay más>
+				const parts = mensaje.split('|');
+				mostrarPaginaHistorial(parts[1], parts[2], parts[3] === '1');
 			} else {
-				if (mensaje.startsWith('Error:')) {
-					console.log('Error:', mensaje);
-				} else if (mensaje === 'Mensaje procesado') {
-					// Mensaje enviado correctamente
-				} else if (mensaje.startsWith('USER_LIST|')) {
-					// Recibir lista de usuarios
-					const users = mensaje.split('|').slice(1);
-					contacts = users.filter(user => user !== currentUser);
-					actualizarListaContactos();
-				} else if (mensaje.startsWith('NEW_USER|')) {
-					// Recibir notificación de nuevo usuario
-					const newUser = mensaje.split('|')[1];
-					if (newUser !== currentUser && !contacts.includes(newUser)) {
-						contacts.push(newUser);
-						actualizarListaContactos();
-					}
-				} else if (mensaje.startsWith('HISTORY|')) {
-					// Recibir mensajes del historial
-					const parts = mensaje.split('|');
-					const sender = parts[1];
-					const content = parts.slice(2).join('|'); // Por si el mensaje contiene '|'
-					mostrarMensaje(`${sender}: ${content}`, true);
-				} else {
-					// Recibir mensaje nuevo
-					mostrarMensaje(mensaje, false);
-				}
+				// Recibir mensaje nuevo (también los pendientes que llegan tras el AUTH)
+				mostrarMensaje(mensaje, false);
 			}
 		});
 	});